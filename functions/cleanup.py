@@ -1,12 +1,22 @@
+import json
+import os
+import time
 from dcicutils import ff_utils
 from datetime import datetime
+from .wfr import parse_wfr_title
+from . import script_utils as scu
 
 
-# function to get workflow_details info from db
-# initial datastructure that is the same as that to get info for foursight is transformed
-# into the format used in the cleanup functions
-# workflow name, accepted revision numbers (0 if none), accetable run time (hours)
-def get_workflow_details(my_auth):
+# on disk cache of the accepted workflow catalog of each server - see get_workflow_catalog
+WORKFLOW_CATALOG_CACHE = os.path.join(os.path.expanduser('~'), '.dcicwrangling_workflow_catalog.json')
+WORKFLOW_CATALOG_MAX_AGE = 24 * 3600  # seconds
+# delete_wfrs never decides what to delete with a catalog older than this
+DELETE_CATALOG_MAX_AGE = 300
+
+
+def fetch_workflow_catalog(my_auth):
+    """Search the current accepted Workflows and return the catalog as a dictionary of
+    app_name: {'accepted_versions': list of app_versions, 'run_time': max_runtime (hours)}"""
     wf_details = {}
     wf_query = "search/?type=Workflow&tags=current&tags=accepted&field=max_runtime" \
         "&app_name!=No value&app_version!=No value&field=app_name&field=app_version"
@@ -22,14 +32,77 @@ def get_workflow_details(my_auth):
         # different run times - use max value
         if run_time > wf_details[app_name].get('run_time'):
             wf_details[app_name]['run_time'] = run_time
-    # here is the transformation
-    # workflow_details = []
-    # for wfname, wf_info in wf_details.items():
-    #    workflow_details.append((wfname, wf_info.get('accepted_versions'), [], wf_info.get('run_time')))
+    return wf_details
+
+
+def _read_catalog_cache(cache_file):
+    try:
+        with open(cache_file) as cached:
+            return json.load(cached)
+    except (IOError, ValueError):
+        return {}
+
+
+def get_workflow_catalog(my_auth, refresh=False, cache_file=WORKFLOW_CATALOG_CACHE,
+                         max_age=WORKFLOW_CATALOG_MAX_AGE):
+    """The workflow catalog (see fetch_workflow_catalog) of the server of my_auth from the on disk
+    cache, keyed by server, if it is younger than max_age seconds - otherwise or with refresh=True
+    it is searched again and the cache updated. cache_file=None skips the cache"""
+    if not cache_file:
+        return fetch_workflow_catalog(my_auth)
+    server = my_auth.get('server')
+    cache = _read_catalog_cache(cache_file)
+    cached = cache.get(server)
+    if not refresh and cached and time.time() - cached.get('fetched', 0) < max_age:
+        return cached['workflows']
+    workflows = fetch_workflow_catalog(my_auth)
+    # re-read so catalogs of other servers written meanwhile are kept
+    cache = _read_catalog_cache(cache_file)
+    cache[server] = {'fetched': time.time(), 'workflows': workflows}
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(tmp_file, 'w') as out:
+        json.dump(cache, out)
+    os.replace(tmp_file, cache_file)
+    return workflows
+
+
+# function to get workflow_details info from db
+# initial datastructure that is the same as that to get info for foursight is transformed
+# into the format used in the cleanup functions
+# workflow name, accepted revision numbers (0 if none), accetable run time (hours)
+def get_workflow_details(my_auth, refresh=False, cache_file=WORKFLOW_CATALOG_CACHE):
+    wf_details = get_workflow_catalog(my_auth, refresh=refresh, cache_file=cache_file)
     return [(wfname, wf_details[wfname].get('accepted_versions', []), wf_details[wfname].get('run_time'))
             for wfname in wf_details.keys()]
 
 
+def add_current_versions(workflows, my_key, max_age=DELETE_CATALOG_MAX_AGE):
+    """Add the accepted versions (and longer run times) of a catalog at most max_age seconds old
+    to a workflow index - so a version accepted since the workflow details were got from the cache
+    is not deleted as old. Workflows are not added, unlisted ones are still skipped"""
+    current = index_workflow_details(get_workflow_catalog(my_key, max_age=max_age))
+    updated = WorkflowIndex()
+    for name, (accepted_rev, run_time) in workflows.items():
+        current_rev, current_run_time = current.get(name, (set(), run_time))
+        updated[name] = (accepted_rev | current_rev, max(run_time or 0, current_run_time or 0))
+    return updated
+
+
+class WorkflowIndex(dict):
+    """workflow name: (set of accepted versions, accepted run time) - made by index_workflow_details"""
+
+
+def index_workflow_details(workflow_details):
+    """Index workflow_details, a list from get_workflow_details or a catalog from get_workflow_catalog,
+    for lookups by workflow name - an index can be made once and passed to delete_wfrs for many files"""
+    if isinstance(workflow_details, WorkflowIndex):
+        return workflow_details
+    if isinstance(workflow_details, dict):
+        return WorkflowIndex((name, (set(info.get('accepted_versions', [])), info.get('run_time')))
+                             for name, info in workflow_details.items())
+    return WorkflowIndex((name, (set(accepted_rev), run_time)) for name, accepted_rev, run_time in workflow_details)
+
+
 def fetch_pf_associated(pf_id_or_dict, my_key):
     """Given a file accession, find all related items
     1) QCs
@@ -79,21 +152,15 @@ def fetch_wfr_associated(wfr_id_or_resp, my_key):
 def get_wfr_report(wfrs):
     # for a given list of wfrs, produce a simpler report
     wfr_report = []
+    now = datetime.utcnow()
     for wfr_data in wfrs:
         wfr_rep = {}
         """For a given workflow_run item, grabs details, uuid, run_status, wfr name, date, and run time"""
-        wfr_type, time_info = wfr_data['display_title'].split(' run ')
+        title = parse_wfr_title(wfr_data['display_title'])
         # skip all style awsem runs
-        try:
-            wfr_type_base, wfr_version = wfr_type.strip().split(' ')
-        except Exception:
+        if title is None:
             continue
-        time_info = time_info.strip('on').strip()
-        try:
-            wfr_time = datetime.strptime(time_info, '%Y-%m-%d %H:%M:%S.%f')
-        except ValueError:
-            wfr_time = datetime.strptime(time_info, '%Y-%m-%d %H:%M:%S')
-        run_hours = (datetime.utcnow() - wfr_time).total_seconds() / 3600
+        run_hours = title.run_hours(now)
         output_files = wfr_data.get('output_files', None)
         output_uuids = []
         qc_uuids = []
@@ -111,9 +178,9 @@ def get_wfr_report(wfrs):
 
         wfr_rep = {'wfr_uuid': wfr_data['uuid'],
                    'wfr_status': wfr_data['run_status'],
-                   'wfr_name': wfr_type_base.strip(),
-                   'wfr_version': wfr_version.strip(),
-                   'wfr_date': wfr_time,
+                   'wfr_name': title.name,
+                   'wfr_version': title.version,
+                   'wfr_date': title.timestamp,
                    'run_time': run_hours,
                    'status': wfr_data['status'],
                    'outputs': output_uuids,
@@ -123,12 +190,207 @@ def get_wfr_report(wfrs):
     return wfr_report
 
 
-def delete_wfrs(file_resp, my_key, workflow_details, delete=False, stash=None):
+def group_wfr_report(wfr_report):
+    """Group a wfr_report (sorted by date) by wfr_name - returns a dictionary of
+    wfr_name: list of report entries, oldest first"""
+    grouped = {}
+    for wfr_rep in wfr_report:
+        grouped.setdefault(wfr_rep['wfr_name'], []).append(wfr_rep)
+    return grouped
+
+
+def prefetch_wfrs(file_resps, my_key, chunk_size=200, stash=None):
+    """Make a stash for delete_wfrs from a batch of file responses - all the workflow_run_inputs
+    of the files are fetched from ES in chunks. Returns a dictionary of uuid:wfr (embedded frame),
+    runs already in the given stash dictionary are not fetched again
+    """
+    if stash is None:
+        stash = {}
+    wfr_uuids = []
+    for file_resp in file_resps:
+        for wfr in file_resp.get('workflow_run_inputs') or []:
+            if wfr['uuid'] not in stash:
+                wfr_uuids.append(wfr['uuid'])
+    wfr_uuids = list(dict.fromkeys(wfr_uuids))
+    if wfr_uuids:
+        for hit in ff_utils.get_es_metadata(wfr_uuids, sources=['embedded.*'], chunk_size=chunk_size,
+                                            is_generator=True, key=my_key):
+            stash[hit['embedded']['uuid']] = hit['embedded']
+    return stash
+
+
+class DeletionPlan(object):
+    """Status changes collected by delete_wfrs, for one or many files, to be applied together
+    with apply_deletion_plan. Items are indexed by uuid so a run, output file or qc reached from
+    several files is only planned (and patched) once. Every change keeps the reason it was planned
+    and the file it was found from, runs that were left alone (eg. still running) are kept as notes.
+    A plan can be saved as a jsonl file with write and loaded back with read to be applied later
+    without fetching anything again
+    """
+    WFR_PATCH = {'description': "This workflow run is deleted", 'status': "deleted"}
+
+    def __init__(self):
+        self.changes = {}  # uuid: {'item_type': wfr/file/qc, 'patch': patch body, 'reason':, 'file':}
+        self.field_deletions = {}  # uuid: {'delete_fields': list of fields, 'reason':, 'file':}
+        self.notes = []  # {'uuid':, 'item_type':, 'reason':, 'file':} for items not changed
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __contains__(self, uuid):
+        return uuid in self.changes
+
+    def add(self, uuid, item_type, patch=None, reason=None, file=None, wfr=None, needs=None):
+        """Plan a status change, returns False if the item is already planned
+        needs - uuids of field deletions that must succeed before the change is made"""
+        if uuid in self.changes:
+            if needs:
+                self.changes[uuid].setdefault('needs', []).extend(n for n in needs
+                                                                  if n not in self.changes[uuid]['needs'])
+            return False
+        change = {'item_type': item_type, 'patch': patch or {'status': "deleted"}, 'reason': reason, 'file': file}
+        if wfr:
+            change['wfr'] = wfr
+        if needs:
+            change['needs'] = list(needs)
+        self.changes[uuid] = change
+        return True
+
+    def add_field_deletion(self, uuid, field, reason=None, file=None):
+        deletion = self.field_deletions.setdefault(uuid, {'delete_fields': [], 'reason': reason, 'file': file})
+        if field not in deletion['delete_fields']:
+            deletion['delete_fields'].append(field)
+
+    def add_wfr(self, wfr_to_del, reason=None, file=None):
+        """Plan deletion of a run from a get_wfr_report entry with its output files and qcs,
+        returns the uuids that were not planned yet"""
+        added = []
+        wfr_uuid = wfr_to_del['wfr_uuid']
+        if self.add(wfr_uuid, 'wfr', dict(self.WFR_PATCH), reason=reason, file=file):
+            added.append(wfr_uuid)
+        for out_file_uuid in wfr_to_del.get('outputs') or []:
+            if self.add(out_file_uuid, 'file', reason=reason, file=file, wfr=wfr_uuid):
+                added.append(out_file_uuid)
+        for out_qc_uuid in wfr_to_del.get('qcs') or []:
+            if self.add(out_qc_uuid, 'qc', reason=reason, file=file, wfr=wfr_uuid):
+                added.append(out_qc_uuid)
+        return added
+
+    def note(self, uuid, reason, file=None, item_type='wfr'):
+        """Record an item that was looked at but is not changed"""
+        self.notes.append({'uuid': uuid, 'item_type': item_type, 'reason': reason, 'file': file})
+
+    def uuids(self, item_type):
+        return [uuid for uuid, change in self.changes.items() if change['item_type'] == item_type]
+
+    def lines(self):
+        """Generator of the plan as json serializable dicts - one per field deletion, status change and note"""
+        for uuid, deletion in self.field_deletions.items():
+            yield dict(uuid=uuid, item_type='file', **deletion)
+        for uuid, change in self.changes.items():
+            yield dict(uuid=uuid, **change)
+        for note in self.notes:
+            yield note
+
+    def write(self, path):
+        with open(path, 'w') as plan_file:
+            for line in self.lines():
+                plan_file.write(json.dumps(line) + '\n')
+
+    @classmethod
+    def read(cls, path):
+        plan = cls()
+        with open(path) as plan_file:
+            for line in plan_file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                uuid = entry.pop('uuid')
+                if 'delete_fields' in entry:
+                    entry.pop('item_type', None)
+                    plan.field_deletions[uuid] = entry
+                elif 'patch' in entry:
+                    plan.changes[uuid] = entry
+                else:
+                    plan.notes.append(dict(uuid=uuid, **entry))
+        return plan
+
+
+def apply_deletion_plan(plan, my_key, workers=8, rate=scu.MAX_REQUESTS_PER_SECOND, journal=None):
+    """Apply a DeletionPlan (or a plan file saved with DeletionPlan.write) with a bounded pool of
+    concurrent patches (scu.run_patches) - field deletions first, then the status changes, except
+    those that need a field deletion that failed. Nothing is fetched from the database. Writes already
+    confirmed in a scu.WriteJournal are skipped.
+    Returns a report with the uuids of the deleted 'wfrs', 'files' and 'qcs' and the 'errors'
+    (uuid: exception, response or reason not patched) of failed or skipped changes
+    """
+    if not isinstance(plan, DeletionPlan):
+        plan = DeletionPlan.read(plan)
+    report = {'wfrs': [], 'files': [], 'qcs': [], 'errors': {}}
+    if plan.field_deletions:
+        summary = scu.run_patches(
+            ((uuid, deletion['delete_fields']) for uuid, deletion in plan.field_deletions.items()),
+            my_key, workers=workers, rate=rate, journal=journal,
+            action=lambda iid, fields: ff_utils.delete_field(iid, ','.join(fields), key=my_key))
+        report['errors'].update(summary['errors'])
+    failed_fields = set(report['errors'])
+    to_patch = []
+    for uuid, change in plan.changes.items():
+        failed_needs = [n for n in change.get('needs', []) if n in failed_fields]
+        if failed_needs:
+            report['errors'][uuid] = 'not patched - field deletion failed for {}'.format(', '.join(failed_needs))
+        else:
+            to_patch.append((uuid, change['patch']))
+    summary = scu.run_patches(to_patch, my_key, workers=workers, rate=rate, journal=journal)
+    report['errors'].update(summary['errors'])
+    done = set(summary['success'] + summary['skipped'])
+    for uuid, change in plan.changes.items():
+        if uuid in done:
+            report[change['item_type'] + 's'].append(uuid)
+    for uuid, error in report['errors'].items():
+        print('failed to delete', uuid, error)
+    return report
+
+
+def plan_cleanup(file_resps, my_key, workflow_details, plan=None, stash=None, current_versions=True):
+    """Dry run of delete_wfrs over many files (embedded frame) collecting what would be deleted, and why,
+    in a DeletionPlan - the input runs of all the files are prefetched into the stash first and, with
+    current_versions, the accepted versions of a catalog at most DELETE_CATALOG_MAX_AGE old are added to
+    the workflow details once for all the files.
+    Save the plan with plan.write(path) to review it and apply it later with apply_deletion_plan"""
+    if plan is None:
+        plan = DeletionPlan()
+    if stash is not None and not isinstance(stash, dict):
+        stash = {i['uuid']: i for i in stash}
+    stash = prefetch_wfrs(file_resps, my_key, stash=stash)
+    workflows = index_workflow_details(workflow_details)
+    if current_versions:
+        workflows = add_current_versions(workflows, my_key)
+    for file_resp in file_resps:
+        delete_wfrs(file_resp, my_key, workflows, stash=stash, plan=plan)
+    return plan
+
+
+def delete_wfrs(file_resp, my_key, workflow_details, delete=False, stash=None, plan=None, workers=8,
+                current_versions=False):
     # file_resp in embedded frame
-    # stash: all related wfrs for file_resp
-    deleted_wfrs = []  # reports WorkflowRun items deleted by this function
-    deleted_files = []  # reports File items deleted by this function because outputs of wfr deleted by this function
-    deleted_qc = []  # reports QualityMetric items deleted by this function because linked to wfr deleted by this function
+    # workflow_details: from get_workflow_details, get_workflow_catalog or index_workflow_details - used as given
+    # current_versions: add the accepted versions of a catalog at most DELETE_CATALOG_MAX_AGE old before planning
+    # deletions - when looping over many files do it once instead with add_current_versions (as plan_cleanup does)
+    # stash: related wfrs for file_resp - a dictionary of uuid:wfr from prefetch_wfrs, made once for many files
+    # runs missing from the stash are fetched and added to it
+    # plan: a DeletionPlan shared over many files - deletions are only added to it and the caller
+    # applies them all at once with apply_deletion_plan, the uuids newly planned for this file are returned
+    # without a plan and with delete=True the deletions of this file are applied with 'workers' concurrent
+    # patches and the deleted WorkflowRun, File (outputs of deleted runs) and QualityMetric uuids are returned
+    # - if any of them fail an Exception is raised (after the others are done) listing the failed and deleted uuids
+    if stash is not None and not isinstance(stash, dict):
+        raise TypeError('stash must be a dictionary of uuid:wfr - make it once with prefetch_wfrs')
+    apply_plan = plan is None
+    if apply_plan:
+        plan = DeletionPlan()
+    to_plan = delete or not apply_plan
+    planned = []  # uuids planned for deletion from this file
     wfr_report = []
     file_type = file_resp['@id'].split('/')[1]
     # special clause until we sort input_wfr_switch issue
@@ -150,8 +412,10 @@ def delete_wfrs(file_resp, my_key, workflow_details, delete=False, stash=None):
     if wfr_uuids:
         # fetch them from stash
         if stash:
-            wfrs = [i for i in stash if i['uuid'] in wfr_uuids]
-            assert len(wfrs) == len(wfr_uuids)
+            missing = [i for i in wfr_uuids if i not in stash]
+            if missing:
+                prefetch_wfrs([{'workflow_run_inputs': [{'uuid': i} for i in missing]}], my_key, stash=stash)
+            wfrs = [stash[i] for i in wfr_uuids if i in stash]
         # if no stash, get from database
         else:
             wfrs = [i['embedded'] for i in ff_utils.get_es_metadata(wfr_uuids, sources=['embedded.*'], key=my_key)]
@@ -165,41 +429,44 @@ def delete_wfrs(file_resp, my_key, workflow_details, delete=False, stash=None):
     wfrs = [i for i in wfrs if not i['@id'].startswith('/workflow-runs-sbg/')]
     wfrs = [i for i in wfrs if not i['display_title'].startswith('File Provenance Tracking')]
 
-    def _delete_action(wfr_to_del):
-        # delete the Workflow Run
-        patch_data = {'description': "This workflow run is deleted", 'status': "deleted"}
-        deleted_wfrs.append(wfr_to_del['wfr_uuid'])
-        ff_utils.patch_metadata(patch_data, obj_id=wfr_to_del['wfr_uuid'], key=my_key)
-        # delete output files of the deleted workflow run
-        if wfr_to_del['outputs']:
-            for out_file_uuid in wfr_to_del['outputs']:
-                deleted_files.append(out_file_uuid)
-                ff_utils.patch_metadata({'status': "deleted"}, obj_id=out_file_uuid, key=my_key)
-        # delete QualityMetric of the deleted workflow run or of the deleted output files
-        if wfr_to_del.get('qcs'):
-            for out_qc_uuid in wfr_to_del['qcs']:
-                deleted_qc.append(out_qc_uuid)
-                ff_utils.patch_metadata({'status': "deleted"}, obj_id=out_qc_uuid, key=my_key)
-        return
+    def _delete_action(wfr_to_del, reason):
+        # plan deletion of the Workflow Run, its output files and QualityMetrics
+        planned.extend(plan.add_wfr(wfr_to_del, reason=reason, file=file_resp['accession']))
+
+    def _finish():
+        if not apply_plan:
+            return planned
+        if not delete or not (plan.changes or plan.field_deletions):
+            return []
+        report = apply_deletion_plan(plan, my_key, workers=workers)
+        deleted = report['wfrs'] + report['files'] + report['qcs']
+        if report['errors']:
+            raise Exception('{} deletions failed for {}: {} - deleted: {}'.format(
+                len(report['errors']), file_resp['accession'], ', '.join(report['errors']), ', '.join(deleted)))
+        return deleted
 
     # CLEAN UP IF FILE IS DELETED
-    workflow_names = [wfinfo[0] for wfinfo in workflow_details]
+    workflows = index_workflow_details(workflow_details)
+    if to_plan and current_versions:
+        workflows = add_current_versions(workflows, my_key)
     if file_resp['status'] == 'deleted':
         if file_resp.get('quality_metric'):
-            if delete:
+            if to_plan:
                 qc_uuid = file_resp['quality_metric']['uuid']
-                ff_utils.delete_field(file_resp, 'quality_metric', key=my_key)
+                plan.add_field_deletion(file_resp['uuid'], 'quality_metric', reason='deleted file qc',
+                                        file=file_resp['accession'])
                 # delete quality metrics object
-                patch_data = {'status': "deleted"}
-                ff_utils.patch_metadata(patch_data, obj_id=qc_uuid, key=my_key)
+                if plan.add(qc_uuid, 'qc', reason='deleted file qc', file=file_resp['accession'],
+                            needs=[file_resp['uuid']]):
+                    planned.append(qc_uuid)
         # delete all workflows for deleted files
         if not wfrs:
-            return
+            return _finish()
         else:
             wfr_report = get_wfr_report(wfrs)
             for wfr_to_del in wfr_report:
                 if wfr_to_del['status'] != 'deleted':
-                    if wfr_to_del['wfr_name'] not in workflow_names:
+                    if wfr_to_del['wfr_name'] not in workflows:
                         print('Unlisted Workflow', wfr_to_del['wfr_name'], 'deleted file workflow',
                               wfr_to_del['wfr_uuid'], file_resp['accession'])
                     ####################################################
@@ -207,15 +474,17 @@ def delete_wfrs(file_resp, my_key, workflow_details, delete=False, stash=None):
                     if wfr_to_del['status'] == 'released to project':
                         print('saved from deletion', wfr_to_del['wfr_name'], 'deleted file workflow',
                               wfr_to_del['wfr_uuid'], file_resp['accession'])
-                        return
+                        plan.note(wfr_to_del['wfr_uuid'], 'saved from deletion', file_resp['accession'])
+                        return _finish()
                     if wfr_to_del['status'] == 'released':
                         print('delete released!!!!!', wfr_to_del['wfr_name'], 'deleted file workflow',
                               wfr_to_del['wfr_uuid'], file_resp['accession'])
-                        return
+                        plan.note(wfr_to_del['wfr_uuid'], 'released', file_resp['accession'])
+                        return _finish()
                     #####################################################
                     print(wfr_to_del['wfr_name'], 'deleted file workflow', wfr_to_del['wfr_uuid'], file_resp['accession'])
-                    if delete:
-                        _delete_action(wfr_to_del)
+                    if to_plan:
+                        _delete_action(wfr_to_del, 'deleted file workflow')
 
     else:
         # get a report on all workflow_runs
@@ -225,47 +494,51 @@ def delete_wfrs(file_resp, my_key, workflow_details, delete=False, stash=None):
             wfr_report = get_wfr_report(wfrs)
             # printTable(wfr_report, ['wfr_name', 'run_time', 'wfr_version', 'run_time', 'wfr_status'])
             # check if any unlisted wfr in report
-            my_wfr_names = [i['wfr_name'] for i in wfr_report]
-            unlisted = [x for x in my_wfr_names if x not in workflow_names]
+            wfrs_by_name = group_wfr_report(wfr_report)
+            unlisted = wfrs_by_name.keys() - workflows.keys()
             # report the unlisted ones
             if unlisted:
-                print('Unlisted Workflow', unlisted, 'skipped in', file_resp['accession'])
-            for wf_name, accepted_rev, accepted_run_time in workflow_details:
+                print('Unlisted Workflow', sorted(unlisted), 'skipped in', file_resp['accession'])
+            for wf_name, sub_wfrs in wfrs_by_name.items():
+                if wf_name in unlisted:
+                    continue
+                accepted_rev, accepted_run_time = workflows[wf_name]
                 # for each type of worklow make a list of old ones, and patch status and description
-                sub_wfrs = [i for i in wfr_report if i['wfr_name'] == wf_name]
-                if sub_wfrs:
-                    active_wfr = sub_wfrs[-1]
-                    old_wfrs = sub_wfrs[:-1]
-                    # check the status of the most recent workflow
-                    if active_wfr['wfr_status'] != 'complete':
-                        if (active_wfr['wfr_status'] in ['running', 'started'] and active_wfr['run_time'] < accepted_run_time):
-                            print(wf_name, 'still running for', file_resp['accession'])
-                        else:
-                            old_wfrs.append(active_wfr)
-                    elif active_wfr['wfr_version'] not in accepted_rev:
+                active_wfr = sub_wfrs[-1]
+                old_wfrs = sub_wfrs[:-1]
+                # check the status of the most recent workflow
+                if active_wfr['wfr_status'] != 'complete':
+                    if (active_wfr['wfr_status'] in ['running', 'started'] and active_wfr['run_time'] < accepted_run_time):
+                        print(wf_name, 'still running for', file_resp['accession'])
+                        plan.note(active_wfr['wfr_uuid'], 'still running', file_resp['accession'])
+                    else:
                         old_wfrs.append(active_wfr)
-                    if old_wfrs:
-                        for wfr_to_del in old_wfrs:
-                            if wfr_to_del['status'] != 'deleted':
-                                if wfr_to_del['status'] in ['archived', 'replaced']:
-                                    print(wfr_to_del['wfr_name'], wfr_to_del['status'], ' wfr found, skipping ',
-                                          wfr_to_del['wfr_uuid'], file_resp['accession'])
-                                    continue
-                                ####################################################
-                                # TEMPORARY PIECE
-                                if wfr_to_del['status'] == 'released to project':
-                                    print('saved from deletion', wfr_to_del['wfr_name'], 'old style or dub',
-                                          wfr_to_del['wfr_uuid'], file_resp['accession'])
-                                    continue
-                                if wfr_to_del['status'] == 'released':
-                                    print('delete released????', wfr_to_del['wfr_name'], 'old style or dub',
-                                          wfr_to_del['wfr_uuid'], file_resp['accession'])
-                                    continue
-                                ####################################################
-
-                                print(wfr_to_del['wfr_name'], 'old style or dub',
+                elif active_wfr['wfr_version'] not in accepted_rev:
+                    old_wfrs.append(active_wfr)
+                if old_wfrs:
+                    for wfr_to_del in old_wfrs:
+                        if wfr_to_del['status'] != 'deleted':
+                            if wfr_to_del['status'] in ['archived', 'replaced']:
+                                print(wfr_to_del['wfr_name'], wfr_to_del['status'], ' wfr found, skipping ',
                                       wfr_to_del['wfr_uuid'], file_resp['accession'])
-                                if delete:
-                                    _delete_action(wfr_to_del)
-    deleted_items = deleted_wfrs + deleted_files + deleted_qc
-    return deleted_items
+                                plan.note(wfr_to_del['wfr_uuid'], wfr_to_del['status'], file_resp['accession'])
+                                continue
+                            ####################################################
+                            # TEMPORARY PIECE
+                            if wfr_to_del['status'] == 'released to project':
+                                print('saved from deletion', wfr_to_del['wfr_name'], 'old style or dub',
+                                      wfr_to_del['wfr_uuid'], file_resp['accession'])
+                                plan.note(wfr_to_del['wfr_uuid'], 'saved from deletion', file_resp['accession'])
+                                continue
+                            if wfr_to_del['status'] == 'released':
+                                print('delete released????', wfr_to_del['wfr_name'], 'old style or dub',
+                                      wfr_to_del['wfr_uuid'], file_resp['accession'])
+                                plan.note(wfr_to_del['wfr_uuid'], 'released', file_resp['accession'])
+                                continue
+                            ####################################################
+
+                            print(wfr_to_del['wfr_name'], 'old style or dub',
+                                  wfr_to_del['wfr_uuid'], file_resp['accession'])
+                            if to_plan:
+                                _delete_action(wfr_to_del, 'old style or dub')
+    return _finish()
@@ -7,13 +7,18 @@ import openpyxl
 import warnings  # to suppress openpxl warning about headers
 from openpyxl.utils.exceptions import InvalidFileException
 import datetime
+import functools
 
 
-def digest_xlsx(filename):
+def digest_xlsx(filename, read_only=False):
+    """Load an xlsx workbook and return it with its sheet names
+    read_only=True streams the sheets instead of loading all the cells in memory
+    - much faster for big sheets but the workbook can't be edited and should be
+    closed with book.close() when done"""
     try:
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            book = openpyxl.load_workbook(filename)
+            book = openpyxl.load_workbook(filename, read_only=read_only)
     except InvalidFileException as e:
         if filename.endswith('.xls'):
             print("WARNING - Old xls format not supported - please save your workbook as xlsx")
@@ -39,6 +44,8 @@ def reader(workbook, sheetname=None):
     # Generator that gets rows from excel sheet
     # NB we have a lot of empty no formatting rows added (can we get rid of that)
     # or do we need to be careful to check for the first totally emptyvalue row?
+    if getattr(workbook, 'read_only', False):
+        return row_values_generator(sheet)
     return row_generator(sheet)
 
 
@@ -55,6 +62,42 @@ def row_generator(sheet):
             yield vals
 
 
+def row_values_generator(sheet):
+    """Same as row_generator but only reads the cell values - to use with
+    sheets of workbooks loaded in read only mode
+    """
+    for row in sheet.iter_rows(values_only=True):
+        vals = [typed_value(value) for value in row]
+        if not any([v for v in vals]):
+            return
+        else:
+            yield vals
+
+
+def typed_value(value):
+    """Convert a cell value read without its cell the same way as cell_value
+    NB: without the cell data type cell errors (eg. #N/A) are returned as strings"""
+    if value is None:
+        return ''
+    elif isinstance(value, bool):
+        return value
+    elif isinstance(value, (int, float)):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if not value:
+            return ''
+        return value
+    elif isinstance(value, datetime.datetime):
+        if value.time() == datetime.time(0, 0, 0):
+            return value.date().isoformat()
+        return value.isoformat()
+    elif isinstance(value, openpyxl.cell.cell.TIME_TYPES):
+        return value.isoformat()
+    elif isinstance(value, str):
+        return value.strip()
+    raise ValueError('Value %s is not an acceptable cell type' % str(value))  # pragma: no cover
+
+
 def cell_value(cell):
     """Get cell value from excel. [From Submit4DN]"""
     ctype = cell.data_type
@@ -157,43 +200,53 @@ def append_xlsx_rows_formatted(sheet, formatted_items, row_index):
 
 
 def append_items_to_xlsx(input_xlsx, add_items, schema_names, comment=True):
+    '''
+        Write a copy of the input workbook with the items appended to the sheets
+        of their type. The input is streamed in read only mode and the output
+        written in write only mode, row by row, so memory doesn't grow with the
+        size of the sheets.
+    '''
     output_file_name = "_with_items.".join(input_xlsx.split('.'))
-    bookread = openpyxl.load_workbook(input_xlsx)
-    book_w = openpyxl.Workbook()
-    book_w.remove(book_w.active)  # removes the empty sheet created by default named Sheet
+    bookread = openpyxl.load_workbook(input_xlsx, read_only=True)
+    book_w = openpyxl.Workbook(write_only=True)  # no default sheet in write only mode
 
     for sheet in bookread.sheetnames:
-        active_sheet = bookread[sheet]
-        first_row_values = list_column_titles(active_sheet)
-
-        # create a new sheet and write the data
-        new_sheet, n_copied_rows = copy_xlsx_sheet(active_sheet, book_w, sheet)
+        rows = bookread[sheet].values
+        first_row_values = list(next(rows, ()))
+        new_sheet = book_w.create_sheet(title=sheet)
 
         # get items to add
         items_to_add = add_items.get(schema_names[sheet])
-        if items_to_add:
+        if items_to_add and sheet == 'ExperimentMic':
             # exception for imaging paths
-            if sheet == 'ExperimentMic':
-                new_sheet, first_row_values = add_extra_path_columns(new_sheet, first_row_values, items_to_add)
+            rows, first_row_values = add_extra_path_columns(rows, first_row_values, items_to_add)
+        # copy the data
+        new_sheet.append(first_row_values)
+        for row in rows:
+            new_sheet.append(row)
+        if items_to_add:
             # append rows at the bottom
-            formatted_items = format_items(items_to_add, first_row_values, comment)
-            new_sheet = append_xlsx_rows_formatted(new_sheet, formatted_items, n_copied_rows)
+            for row in format_items(items_to_add, first_row_values, comment):
+                new_sheet.append(row)
 
+    bookread.close()
     book_w.save(output_file_name)
     print('new excel is stored as', output_file_name)
     return
 
 
-def add_extra_path_columns(new_sheet, first_row_values, items_to_add):
+def get_path_columns(first_row_values, items_to_add):
     '''
-        Duplicates the imaging_paths.channel and imaging_paths.path columns
-        in new_sheet if there is more than one path in items_to_add
+        Works out the imaging_paths.channel and imaging_paths.path columns that need to be
+        added for items with more than one path. Returns the new column titles and for each
+        column the index of the column in the original row to get its values from
+        - or None if no columns need to be added
     '''
     # find the longest number of imaging_paths in items_to_add
     img_path_keys = []
     for item in items_to_add:
         if item.get('imaging_paths'):
-            current_img_path_keys = list(items_to_add[0]['imaging_paths'][0].keys())
+            current_img_path_keys = list(item['imaging_paths'][0].keys())
             if len(current_img_path_keys) > len(img_path_keys):
                 img_path_keys = current_img_path_keys
 
@@ -202,86 +255,107 @@ def add_extra_path_columns(new_sheet, first_row_values, items_to_add):
         imgpth_channel_index = first_row_values.index('imaging_paths.channel')
         # assume imaging_paths.path is at index imgpth_channel_index + 1
     except ValueError:
-        return new_sheet, first_row_values
+        return None
 
-    # insert missing columns
+    titles = list(first_row_values)
+    columns = list(range(len(titles)))
     insert_index = imgpth_channel_index + 2
     for img_path in img_path_keys:
         full_img_path = 'imaging_paths.' + img_path
-        if full_img_path in first_row_values:
-            insert_index = first_row_values.index(full_img_path) + 1
+        if full_img_path in titles:
+            insert_index = titles.index(full_img_path) + 1
         else:
-            first_row_values.insert(insert_index, full_img_path)
-            new_sheet.insert_cols(insert_index + 1)  # workbooks count from 1, not 0
+            titles.insert(insert_index, full_img_path)
             if img_path.startswith('channel'):
-                index_column_to_duplicate = imgpth_channel_index + 1
+                columns.insert(insert_index, imgpth_channel_index)
             else:
-                index_column_to_duplicate = imgpth_channel_index + 2
-            column_to_duplicate = [v for (v,) in new_sheet.iter_rows(min_col=index_column_to_duplicate,
-                                                                     max_col=index_column_to_duplicate,
-                                                                     values_only=True)]
-            column_to_duplicate[0] = full_img_path  # replace title
-            for row_index, cell_value in enumerate(column_to_duplicate, start=1):
-                new_sheet.cell(row=row_index, column=insert_index + 1, value=cell_value)
+                columns.insert(insert_index, imgpth_channel_index + 1)
             insert_index += 1
+    if len(titles) == len(first_row_values):
+        return None
+    return titles, columns
 
-    return new_sheet, first_row_values
-
-
-def format_items(items_list, field_list, comment):
-    """For a given sheet, get all released items"""
-    all_items = []
-    # filter for fields that exist on the excel sheet
-    for item in items_list:
-        item_info = []
-        for field in field_list:
-            write_value = ''
-            # required fields will have a star
-            field = field.strip('*')
-            # add # to skip existing items during submission
-            if field == "#Field Name:":
-                if comment:
-                    item_info.append("#")
-                else:
-                    item_info.append("")
-            # the attachment field returns a dictionary
-            elif field == "attachment":
-                item_info.append("")
-            else:
-                # add sub-embedded objects
-                # 1) only add if the field is not enumerated
-                # 2) only add the first item if there are multiple
-                # if you want to add more, accumulate all key value pairs in a single dictionary
-                # [{main.sub1:a, main.sub2:b ,main.sub1-1:c, main.sub2-1:d,}]
-                # and prepare the excel with these fields
-                if "." in field:
-
-                    main_field, sub_field = field.split('.')
-                    temp_value = item.get(main_field)
-                    if temp_value:
-                        write_value = temp_value[0].get(sub_field, '')
-
-                # usual cases
-                else:
-                    write_value = item.get(field, '')
-
-                # take care of empty lists
-                if not write_value:
-                    write_value = ''
-
-                # check for linked items
-                if isinstance(write_value, dict):
-                    write_value = write_value.get('@id')
-
-                # when writing values, check for the lists and turn them into string
-                if isinstance(write_value, list):
-                    # check for linked items
-                    if isinstance(write_value[0], dict):
-                        write_value = [i.get('@id') for i in write_value]
-                    write_value = ','.join(write_value)
-                item_info.append(write_value)
-        all_items.append(item_info)
-    return all_items
+
+def add_extra_path_columns(rows, first_row_values, items_to_add):
+    '''
+        Duplicates the imaging_paths.channel and imaging_paths.path columns
+        in rows (the values of the rows of a sheet after the title row)
+        if there is more than one path in items_to_add.
+        The new columns are worked out once and rows are laid out as they are read
+        returns the new rows and column titles
+    '''
+    path_columns = get_path_columns(first_row_values, items_to_add)
+    if path_columns is None:
+        return rows, first_row_values
+    titles, columns = path_columns
+
+    def _lay_out():
+        for row in rows:
+            yield [row[i] if i < len(row) else None for i in columns]
+    return _lay_out(), titles
+
+
+def _format_value(write_value):
+    # take care of empty lists
+    if not write_value:
+        return ''
+    # check for linked items
+    if isinstance(write_value, dict):
+        return write_value.get('@id')
+    # when writing values, check for the lists and turn them into string
+    if isinstance(write_value, list):
+        # check for linked items
+        if isinstance(write_value[0], dict):
+            write_value = [i.get('@id') for i in write_value]
+        write_value = ','.join(write_value)
+    return write_value
+
+
+def _column_extractor(field, comment):
+    """function that gets the value to write in the column with the field title from an item"""
+    # required fields will have a star
+    field = (field or '').strip('*')
+    # add # to skip existing items during submission
+    if field == "#Field Name:":
+        mark = "#" if comment else ""
+        return lambda item: mark
+    # the attachment field returns a dictionary
+    if field == "attachment":
+        return lambda item: ""
+    # add sub-embedded objects
+    # 1) only add if the field is not enumerated
+    # 2) only add the first item if there are multiple
+    # if you want to add more, accumulate all key value pairs in a single dictionary
+    # [{main.sub1:a, main.sub2:b ,main.sub1-1:c, main.sub2-1:d,}]
+    # and prepare the excel with these fields
+    if "." in field:
+        main_field, sub_field = field.split('.')
+
+        def extract_sub(item):
+            temp_value = item.get(main_field)
+            return _format_value(temp_value[0].get(sub_field, '') if temp_value else '')
+        return extract_sub
+    # usual cases
+    return lambda item: _format_value(item.get(field, ''))
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_column_plan(fields, comment):
+    return tuple(_column_extractor(field, comment) for field in fields)
+
+
+def get_column_plan(field_list, comment):
+    """The list of column titles of a sheet compiled to a function per column that gets
+    the value to write from an item - plans are cached so sheets with the same columns share them"""
+    return _compile_column_plan(tuple(field_list), comment)
+
+
+def format_items(items_list, field_list, comment, plan=None):
+    """For a given sheet, get all released items
+    the column plan is compiled from field_list if not given"""
+    if plan is None:
+        plan = get_column_plan(field_list, comment)
+    return [[extract(item) for extract in plan] for item in items_list]
 
 
 def is_uuid(value):
@@ -3,11 +3,26 @@ import copy
 import argparse
 import sys
 import ast
+import hashlib
 import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
-from dcicutils.ff_utils import search_metadata, get_metadata, get_authentication_with_server
+from urllib.parse import urlencode
+from dcicutils.ff_utils import search_metadata, get_metadata, patch_metadata, get_authentication_with_server
 from .notebook_functions import get_key
 
+# types whose linked items are not followed by get_linked_items by default
+NO_CHILDREN = ['Publication', 'Lab', 'User', 'Award']
+# max number of threads used for concurrent requests
+DEFAULT_WORKERS = 8
+# max number of write requests per second sent to a server by run_patches
+MAX_REQUESTS_PER_SECOND = 10
+
 
 def create_ff_arg_parser():
     ff_arg_parser = argparse.ArgumentParser(add_help=False)
@@ -41,6 +56,27 @@ def create_input_arg_parser():
     return input_arg_parser
 
 
+def create_workers_arg_parser():
+    workers_arg_parser = argparse.ArgumentParser(add_help=False)
+    workers_arg_parser.add_argument('--workers',
+                                    type=int,
+                                    default=1,
+                                    help="Number of requests to the database to run concurrently. Default is 1")
+    return workers_arg_parser
+
+
+def create_journal_arg_parser():
+    journal_arg_parser = argparse.ArgumentParser(add_help=False)
+    journal_arg_parser.add_argument('--journal',
+                                    default=None,
+                                    help="File to append a record of every attempted write to")
+    journal_arg_parser.add_argument('--resume',
+                                    default=False,
+                                    action='store_true',
+                                    help="Skip writes already recorded as successful in the --journal file")
+    return journal_arg_parser
+
+
 def authenticate(key=None, keyfile=None, env=None):
     if (not key) == (not env):
         raise Exception("You must provide a single valid keyname or env value and not both for authentication")
@@ -78,13 +114,139 @@ def get_item_ids_from_args(id_input, auth, is_search=False):
         return id_input
 
 
+class MetadataCache(object):
+    """Size bounded LRU cache of item metadata with a time to live
+        Entries are keyed by (server, item id, frame) and any of the uuid, accession
+        or @id of a cached item (or the id used to fetch it) will find the same entry.
+        Writes made through run_patches invalidate the written item - other writes must call
+        invalidate_cached themselves. No write refreshes the copies of an item embedded in
+        other cached items, so the default time to live is kept short
+    """
+    def __init__(self, maxsize=5000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # (server, uuid, frame) -> (time stored, item, aliases)
+        self._aliases = {}  # (server, any id, frame) -> (server, uuid, frame)
+        self._frames = set()  # frames that have been cached
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _norm(iid):
+        return str(iid).strip('/')
+
+    @classmethod
+    def _item_ids(cls, item):
+        return [cls._norm(item[f]) for f in ['uuid', 'accession', '@id'] if item.get(f)]
+
+    def get(self, server, iid, frame='embedded'):
+        """return a copy of the cached item or None if not cached or expired"""
+        with self._lock:
+            key = self._aliases.get((server, self._norm(iid), frame))
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored, item, _ = entry
+            if self.ttl is not None and time.monotonic() - stored > self.ttl:
+                self._evict(key)
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(item)
+
+    def set(self, server, iid, item, frame='embedded'):
+        """store an item - only items that have a uuid are cached"""
+        try:
+            uid = item['uuid']
+        except (KeyError, TypeError):
+            return
+        with self._lock:
+            key = (server, self._norm(uid), frame)
+            if key in self._items:
+                self._evict(key)
+            aliases = [(server, a, frame) for a in set([self._norm(iid)] + self._item_ids(item))]
+            self._frames.add(frame)
+            self._items[key] = (time.monotonic(), copy.deepcopy(item), aliases)
+            for alias in aliases:
+                self._aliases[alias] = key
+            while len(self._items) > self.maxsize:
+                self._evict(next(iter(self._items)))
+
+    def invalidate(self, server, iid):
+        """drop the item cached under any of its ids, in all frames"""
+        with self._lock:
+            for frame in self._frames:
+                key = self._aliases.get((server, self._norm(iid), frame))
+                if key in self._items:
+                    self._evict(key)
+
+    def _evict(self, key):
+        _, _, aliases = self._items.pop(key)
+        for alias in aliases:
+            if self._aliases.get(alias) == key:
+                del self._aliases[alias]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._aliases.clear()
+            self._frames.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+
+# shared by all lookups in the process
+METADATA_CACHE = MetadataCache()
+
+
+def _get_server(auth):
+    try:
+        return auth.get('server')
+    except AttributeError:
+        return None
+
+
+def get_metadata_cached(iid, auth, frame='embedded'):
+    """get_metadata that checks and fills the process wide METADATA_CACHE
+        only successfully retrieved items are cached. An item written in the same process is
+        only fetched again if the write went through run_patches or invalidate_cached was called
+        for it - otherwise a stale copy can be returned for up to METADATA_CACHE.ttl seconds"""
+    server = _get_server(auth)
+    item = METADATA_CACHE.get(server, iid, frame)
+    if item is not None:
+        return item
+    if frame == 'embedded':
+        item = get_metadata(iid, auth)
+    else:
+        item = get_metadata(iid, auth, add_on='frame=' + frame)
+    METADATA_CACHE.set(server, iid, item, frame)
+    return item
+
+
+def invalidate_cached(iid, auth, res=None):
+    """drop a written item from METADATA_CACHE - also by the uuid in the write response
+        in case it was written using an id it wasn't cached with"""
+    server = _get_server(auth)
+    METADATA_CACHE.invalidate(server, iid)
+    try:
+        METADATA_CACHE.invalidate(server, res['@graph'][0]['uuid'])
+    except (KeyError, IndexError, TypeError):
+        pass
+
+
 def get_item_if_you_can(auth, value, itype=None):
     try:
         value.get('uuid')
         return value
     except AttributeError:
         svalue = str(value)
-        item = get_metadata(svalue, auth)
+        item = get_metadata_cached(svalue, auth)
         try:
             item.get('uuid')
             return item
@@ -94,11 +256,61 @@ def get_item_if_you_can(auth, value, itype=None):
                 return get_metadata(svalue, auth)
 
 
+def search_type_name(itype):
+    """search type for a snake case item type name eg. experiment_hi_c -> ExperimentHiC"""
+    return ''.join(w.capitalize() for w in itype.split('_'))
+
+
+# statuses searches leave out unless asked for explicitly
+HIDDEN_STATUSES = ('deleted', 'replaced')
+
+
+def find_existing_items(auth, itype, items, idfields, chunk_size=100):
+    """Look up which items already exist in the database by their uuid or the values of their
+        identifying properties (idfields) using batched searches rather than a request per value.
+        Each chunk of values is also searched with the HIDDEN_STATUSES so deleted and replaced
+        items are found as they were by a GET.
+        Returns an index of (field, value): uuid of existing item"""
+    idfields = [f for f in idfields or [] if f != 'uuid']
+    values = {}
+    for item in items:
+        for field in ['uuid'] + idfields:
+            val = item.get(field)
+            if val:
+                values.setdefault(field, set()).update(val if isinstance(val, list) else [val])
+    index = {}
+    for field, valset in values.items():
+        vals = sorted(valset)
+        for i in range(0, len(vals), chunk_size):
+            chunk = vals[i:i + chunk_size]
+            query = [('type', search_type_name(itype))] + [(field, v) for v in chunk]
+            query += [('field', f) for f in sorted(set(['uuid', field]))]
+            hidden = [('status', status) for status in HIDDEN_STATUSES]
+            for status_query in [query, query + hidden]:
+                for found in search_metadata('search/?' + urlencode(status_query), auth):
+                    found_vals = found.get(field)
+                    for v in found_vals if isinstance(found_vals, list) else [found_vals]:
+                        if v in valset:
+                            index[(field, v)] = found['uuid']
+    return index
+
+
+def get_existing_uuid(item, idfields, index):
+    """uuid of an existing item that matches the item uuid or one of its identifying
+        property values in an index from find_existing_items"""
+    for field in ['uuid'] + (idfields or []):
+        val = item.get(field)
+        for v in val if isinstance(val, list) else [val]:
+            if (field, v) in index:
+                return index[(field, v)]
+    return None
+
+
 def get_item_uuid(iid, auth):
     """return a uuid for an item passed another id type"""
     if is_uuid(iid):
         return iid
-    res = get_metadata(iid, auth)
+    res = get_metadata_cached(iid, auth)
     return res.get('uuid')
 
 
@@ -135,7 +347,7 @@ def get_item_type(auth, item):
     try:
         return item['@type'].pop(0)
     except (KeyError, TypeError):
-        res = get_metadata(item, auth)
+        res = get_metadata_cached(item, auth)
         try:
             return res['@type'][0]
         except (AttributeError, KeyError):  # noqa: E722
@@ -200,46 +412,66 @@ def get_types_that_can_have_field(auth, field):
     return types_w_field
 
 
-def get_linked_items(auth, itemid, found_items={},
-                     no_children=['Publication', 'Lab', 'User', 'Award']):
+def _get_linked_frames(itemid, auth):
+    """raw frame (for the linked uuids) and embedded frame (for the type) of an item"""
+    res = get_metadata_cached(itemid, auth, frame='raw')
+    if 'error' in res['status']:
+        return res, None
+    return res, get_metadata_cached(itemid, auth)
+
+
+def get_linked_items(auth, itemid, found_items=None, no_children=None,
+                     max_depth=None, max_items=None, workers=DEFAULT_WORKERS):
     """Given an ID for an item all descendant linked item uuids (as given in 'frame=raw')
         are stored in a dict with each item type as the value.
-        All descendants are retrieved recursively except the children of the types indicated
+        All descendants are retrieved except the children of the types indicated
         in the no_children argument.
+        The item graph is walked level by level and the items in each level are fetched
+        concurrently by up to 'workers' threads - max_depth limits the number of levels
+        below itemid that are followed and max_items stops the walk once that many items
+        are found.
         The relationships between descendant linked items are not preserved - i.e. you don't
         know who are children, grandchildren, great grandchildren ... """
-    unk = 'Unknown'
-    no_children.append(unk)
-    if not found_items.get(itemid):
-        res = get_metadata(itemid, auth, add_on='frame=raw')
-        if 'error' not in res['status']:
-            # create an entry for this item in found_items
-            try:
-                object = get_metadata(itemid, auth)
-                obj_type = object.get('@type')[0]
-                found_items[itemid] = obj_type
-            except (AttributeError, KeyError, TypeError):  # noqa: E722
-                print("Can't find a type for item %s" % itemid)
-                obj_type = unk
-                object = None
-            if obj_type not in no_children:
-                if obj_type in ['FileFastq', 'FileProcessed'] and object is not None:
-                    wfrs = object.get('workflow_run_inputs')
-                    for wfr in wfrs:
+    if found_items is None:
+        found_items = {}
+    if no_children is None:
+        no_children = NO_CHILDREN
+    seen = set(found_items)
+    level = [] if itemid in seen else [itemid]
+    seen.update(level)
+    depth = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            next_level = []
+            for iid, (res, object) in zip(level, executor.map(lambda i: _get_linked_frames(i, auth), level)):
+                if 'error' in res['status']:
+                    continue
+                # create an entry for this item in found_items
+                try:
+                    obj_type = object.get('@type')[0]
+                    found_items[iid] = obj_type
+                except (AttributeError, KeyError, TypeError):  # noqa: E722
+                    print("Can't find a type for item %s" % iid)
+                    continue
+                if obj_type in no_children or (max_depth is not None and depth >= max_depth):
+                    continue
+                if obj_type in ['FileFastq', 'FileProcessed']:
+                    for wfr in object.get('workflow_run_inputs', []):
                         found_items[wfr.get('uuid')] = 'WorkflowRun'
-                fields_to_check = copy.deepcopy(res)
-                id_list = []
-                for key, val in fields_to_check.items():
+                        seen.add(wfr.get('uuid'))
+                for key, val in res.items():
                     if key == 'attachment':
                         continue
                     # could be more than one item in a value
-                    foundids = find_uuids(val)
-                    if foundids:
-                        id_list.extend(foundids)
-                if id_list:
-                    id_list = [i for i in list(set(id_list)) if i not in found_items]
-                    for uid in id_list:
-                        found_items.update(get_linked_items(auth, uid, found_items))  # pragma: no cover
+                    for uid in find_uuids(val) or []:
+                        if uid not in seen:
+                            seen.add(uid)
+                            next_level.append(uid)
+            if max_items is not None and len(found_items) + len(next_level) > max_items:
+                next_level = next_level[:max(max_items - len(found_items), 0)]
+                print("Reached limit of %s linked items for %s" % (max_items, itemid))
+            level = next_level
+            depth += 1
     return found_items
 
 
@@ -252,3 +484,203 @@ def chunk_list(item_list, chunk_size=None):
         # chunk = item_list[curr_pos: new_end]
         # do something with the chunk
         curr_pos = new_end
+
+
+class RateLimiter(object):
+    """Spaces out calls to wait so that at most 'rate' calls per second get through
+        can be shared by many threads"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            go_at = max(self._next, now)
+            self._next = go_at + self.interval
+        if go_at > now:
+            time.sleep(go_at - now)
+
+
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(server, rate):
+    """the RateLimiter shared by all writes to a server"""
+    with _RATE_LIMITERS_LOCK:
+        if (server, rate) not in _RATE_LIMITERS:
+            _RATE_LIMITERS[(server, rate)] = RateLimiter(rate)
+        return _RATE_LIMITERS[(server, rate)]
+
+
+def is_connection_error(error):
+    """True for errors raised by ff_utils requests that timed out or couldn't connect"""
+    return str(error).startswith('Error with ')
+
+
+def get_error_status(error):
+    """the http status code of an error raised by an ff_utils request for a bad response - or None"""
+    status = re.search(r'^Bad status code for \w+ request for .*?: (\d{3})\.', str(error))
+    return int(status.group(1)) if status else None
+
+
+def is_retryable_error(error):
+    """Errors raised by ff_utils requests that are worth retrying - timeouts or
+        connection problems and 5xx responses"""
+    if is_connection_error(error):
+        return True
+    status = get_error_status(error)
+    return status is not None and status >= 500
+
+
+def _is_success(res):
+    try:
+        return res.get('status', 'success').lower() == 'success'
+    except AttributeError:
+        return True
+
+
+def read_input_lines(lines, parse_line, problems=None):
+    """Generator of the parsed lines of an input file - lines are read as they are needed
+        so a big file is never held in memory.
+        parse_line(line) should raise ValueError, KeyError or TypeError for a malformed line
+        - these are reported with their line number, added to problems and skipped.
+        Blank lines are ignored"""
+    for lineno, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield parse_line(line)
+        except (ValueError, KeyError, TypeError) as e:
+            print("MALFORMED LINE {}: {}".format(lineno, e))
+            if problems is not None:
+                problems.append(lineno)
+
+
+def payload_hash(payload):
+    """stable hash of a json payload"""
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class WriteJournal(object):
+    """Append only file with a json line for every attempted write giving the item id,
+        the hash of the payload and the result.
+        With resume=True the writes already recorded as successful in an existing journal
+        are loaded so they can be skipped.
+        Lines are flushed as written but only fsync'd every 'sync_every' records and on close
+    """
+    def __init__(self, path, resume=False, sync_every=100):
+        self.path = path
+        self.sync_every = sync_every
+        self.confirmed = set()
+        if resume and os.path.exists(path):
+            with open(path) as jfile:
+                for line in jfile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # a partly written last line
+                        continue
+                    if entry.get('result') == 'success':
+                        self.confirmed.add((entry['id'], entry['hash']))
+        self._file = open(path, 'a')
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def is_confirmed(self, iid, phash):
+        return (iid, phash) in self.confirmed
+
+    def record(self, iid, phash, error=None):
+        entry = {'id': iid, 'hash': phash, 'result': 'success' if error is None else 'failed'}
+        if error is not None:
+            entry['error'] = str(error)
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self.sync()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_patches(patches, auth, action=None, workers=1, rate=MAX_REQUESTS_PER_SECOND,
+                retries=3, backoff=1.0, callback=None, journal=None):
+    """Run many writes to the database with a bounded pool of worker threads.
+        patches is an iterable of (item id, payload) - it is consumed as work is done so can be
+        a generator. action is called as action(item id, payload) and defaults to patching the
+        item with the payload. Requests to a server are limited to 'rate' per second and requests
+        that time out or get a 5xx response are retried up to 'retries' times with exponential backoff.
+        callback(item id, response, error) is called in the calling thread as each write finishes.
+        Items written (or attempted) are dropped from METADATA_CACHE so later lookups see the changes.
+        If a WriteJournal is passed every write is recorded in it and writes it has confirmed are skipped.
+        Returns a summary dict with lists of 'success', 'failed' and 'skipped' ids, the 'errors'
+        (exception or response) for the failed ids and the total number of 'retries'
+    """
+    if action is None:
+        def action(iid, payload):
+            return patch_metadata(payload, iid, auth)
+    limiter = get_rate_limiter(_get_server(auth), rate) if rate else None
+    summary = {'success': [], 'failed': [], 'skipped': [], 'errors': {}, 'retries': 0}
+
+    def _run(iid, payload):
+        tries = 0
+        while True:
+            if limiter:
+                limiter.wait()
+            try:
+                return action(iid, payload), None, tries
+            except Exception as e:
+                if tries >= retries or not is_retryable_error(e):
+                    return None, e, tries
+                time.sleep(backoff * 2 ** tries)
+                tries += 1
+
+    def _collect(future, iid, phash):
+        res, error, tries = future.result()
+        invalidate_cached(iid, auth, res)
+        summary['retries'] += tries
+        if error is None and _is_success(res):
+            summary['success'].append(iid)
+        else:
+            summary['failed'].append(iid)
+            summary['errors'][iid] = error if error is not None else res
+        if journal is not None:
+            journal.record(iid, phash, summary['errors'].get(iid))
+        if callback is not None:
+            callback(iid, res, error)
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for iid, payload in patches:
+            phash = payload_hash(payload) if journal is not None else None
+            if journal is not None and journal.is_confirmed(iid, phash):
+                summary['skipped'].append(iid)
+                continue
+            pending[executor.submit(_run, iid, payload)] = (iid, phash)
+            if len(pending) >= workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _collect(future, *pending.pop(future))
+        for future in list(pending):
+            _collect(future, *pending.pop(future))
+    return summary
+
+
+def print_patch_summary(summary):
+    print("{} succeeded, {} failed, {} skipped, {} retries".format(
+        len(summary['success']), len(summary['failed']), len(summary['skipped']), summary['retries']))
@@ -1,38 +1,162 @@
 from dcicutils import ff_utils
 from dcicutils import s3_utils
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import functools
+import heapq
 import json
+import os
+import re
+import threading
 from IPython.core.display import display, HTML
+from . import script_utils as scu
 from operator import itemgetter
 
 # Reference Files
-bwa_index = {"human": "4DNFIZQZ39L9",
-             "mouse": "4DNFI823LSI8",
-             "fruit-fly": '4DNFIO5MGY32',
-             "chicken": "4DNFIVGRYVQF"}
-
-chr_size = {"human": "4DNFI823LSII",
-            "mouse": "4DNFI3UBJ3HZ",
-            "fruit-fly": '4DNFIBEEN92C',
-            "chicken": "4DNFIQFZW4DX"}
-
-re_nz = {"human": {'MboI': '/files-reference/4DNFI823L812/',
-                   'DpnII': '/files-reference/4DNFIBNAPW3O/',
-                   'HindIII': '/files-reference/4DNFI823MBKE/',
-                   'NcoI': '/files-reference/4DNFI3HVU2OD/',
-                   'MspI': '/files-reference/4DNFI2JHR3OI/',
-                   'NcoI_MspI_BspHI': '/files-reference/4DNFI6HA6EH9/',
-                   'AluI': '/files-reference/4DNFIN4DB5O8/'
-                   },
-         "mouse": {'MboI': '/files-reference/4DNFIONK4G14/',
-                   'DpnII': '/files-reference/4DNFI3HVC1SE/',
-                   "HindIII": '/files-reference/4DNFI6V32T9J/'
-                   },
-         "fruit-fly": {'MboI': '/files-reference/4DNFIS1ZVUWO/'
-                       },
-         "chicken": {"HindIII": '/files-reference/4DNFITPCJFWJ/'
-                     }
-         }
+REFERENCE_FILES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    'files', 'reference_files.json')
+
+
+class ReferenceRegistry(object):
+    """Organism specific reference files and settings of the pipelines indexed by
+    (organism, pipeline, argument). Arguments with a file (a dictionary with uuid and object_key)
+    are used as pipeline inputs - input_files gives them in the extract_file_info format
+    """
+    def __init__(self, data):
+        self._index = {}
+        self._arguments = {}
+        for organism, pipelines in data.items():
+            for pipeline, arguments in pipelines.items():
+                self._arguments[(organism, pipeline)] = list(arguments)
+                for argument, value in arguments.items():
+                    self._index[(organism, pipeline, argument)] = value
+        self._templates = {}
+
+    @classmethod
+    def from_file(cls, path=REFERENCE_FILES_PATH):
+        with open(path) as registry_file:
+            return cls(json.load(registry_file))
+
+    def get(self, organism, pipeline, argument, default=None):
+        return self._index.get((organism, pipeline, argument), default)
+
+    def table(self, pipeline, argument):
+        """organism:value for all organisms with the argument"""
+        return {org: value for (org, pipe, arg), value in self._index.items() if pipe == pipeline and arg == argument}
+
+    def has_pipeline(self, organism, pipeline):
+        return (organism, pipeline) in self._arguments
+
+    def input_files(self, organism, pipeline, env, arguments=None):
+        """The reference files of a pipeline for an organism as input files for env - all of them or
+        only the given arguments. The templates are only made once per env - a new list of copies is returned
+        """
+        ctx = get_env_context(env)
+        key = (ctx.env, organism, pipeline)
+        if key not in self._templates:
+            templates = []
+            for argument in self._arguments.get((organism, pipeline), []):
+                ref = self._index[(organism, pipeline, argument)]
+                if not (isinstance(ref, dict) and 'uuid' in ref):
+                    continue
+                template = {"object_key": ref['object_key']}
+                if ref.get('rename'):
+                    template['rename'] = ref['rename']
+                template.update({"bucket_name": ctx.raw_bucket,
+                                 "workflow_argument_name": argument,
+                                 "uuid": ref['uuid']})
+                templates.append(template)
+            self._templates[key] = templates
+        return [dict(i) for i in self._templates[key]
+                if arguments is None or i['workflow_argument_name'] in arguments]
+
+
+REFERENCE_FILES = ReferenceRegistry.from_file()
+
+bwa_index = REFERENCE_FILES.table('hic', 'bwa_index')
+
+chr_size = REFERENCE_FILES.table('hic', 'chr_size')
+
+re_nz = REFERENCE_FILES.table('hic', 'restriction_enzyme')
+
+
+# WorkflowRun display_title - 'name version run 2019-01-01 10:00:00.123456'
+# user submitted ones use 'run on' instead of 'run'
+WFR_TITLE_RE = re.compile(r'^\s*(\S+)\s+(\S+)\s+run\s+(?:on\s+)?'
+                          r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?\s*$')
+
+
+class WfrTitle(object):
+    """workflow name, version and start time parsed from a WorkflowRun display_title"""
+    __slots__ = ('name', 'version', 'timestamp')
+
+    def __init__(self, name, version, timestamp):
+        self.name = name
+        self.version = version
+        self.timestamp = timestamp
+
+    def run_hours(self, now=None):
+        """hours since the run started"""
+        now = now or datetime.utcnow()
+        return (now - self.timestamp).total_seconds() / 3600
+
+    def __eq__(self, other):
+        return isinstance(other, WfrTitle) and (self.name, self.version, self.timestamp) == (
+            other.name, other.version, other.timestamp)
+
+    def __repr__(self):
+        return 'WfrTitle({!r}, {!r}, {!r})'.format(self.name, self.version, self.timestamp)
+
+
+@functools.lru_cache(maxsize=2 ** 17)
+def parse_wfr_title(display_title):
+    """Parse a WorkflowRun display_title into a WfrTitle - None if the title is not of the form
+    'name version run(on) timestamp' (eg. old style runs without a version)
+    The records are cached so should not be changed
+    """
+    match = WFR_TITLE_RE.match(display_title)
+    if not match:
+        return None
+    name, version, year, month, day, hour, minute, second, fraction = match.groups()
+    microsecond = int(fraction.ljust(6, '0')[:6]) if fraction else 0
+    try:
+        timestamp = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond)
+    except ValueError:  # not a real date
+        return None
+    return WfrTitle(name, version, timestamp)
+
+
+class WfrEnv(object):
+    """The buckets and auth of an environment - get them with get_env_context so
+    they are only looked up once per env. The auth is only looked up when first used
+    """
+    def __init__(self, env, auth=None):
+        self.env = env
+        self.s3 = s3_utils(env=env)
+        self.raw_bucket = self.s3.raw_file_bucket
+        self.out_bucket = self.s3.outfile_bucket
+        self._auth = auth
+
+    @property
+    def auth(self):
+        if self._auth is None:
+            self._auth = ff_utils.get_authentication_with_server({}, ff_env=self.env)
+        return self._auth
+
+
+_ENV_CONTEXTS = {}
+_ENV_CONTEXTS_LOCK = threading.Lock()
+
+
+def get_env_context(env):
+    """The cached WfrEnv for an env name - a WfrEnv is returned as is
+    so functions can take either"""
+    if isinstance(env, WfrEnv):
+        return env
+    with _ENV_CONTEXTS_LOCK:
+        if env not in _ENV_CONTEXTS:
+            _ENV_CONTEXTS[env] = WfrEnv(env)
+        return _ENV_CONTEXTS[env]
 
 
 def get_attribution(file_json):
@@ -64,11 +188,10 @@ def get_attribution(file_json):
 
 
 def extract_file_info(obj_id, arg_name, env, rename=[]):
-    auth = ff_utils.get_authentication_with_server({}, ff_env=env)
-    my_s3_util = s3_utils(env=env)
-
-    raw_bucket = my_s3_util.raw_file_bucket
-    out_bucket = my_s3_util.outfile_bucket
+    ctx = get_env_context(env)
+    auth = ctx.auth
+    raw_bucket = ctx.raw_bucket
+    out_bucket = ctx.out_bucket
     """Creates the formatted dictionary for files.
     """
     # start a dictionary
@@ -120,8 +243,8 @@ def extract_file_info(obj_id, arg_name, env, rename=[]):
 
 
 def run_json(input_files, env, wf_info, run_name):
-    my_s3_util = s3_utils(env=env)
-    out_bucket = my_s3_util.outfile_bucket
+    ctx = get_env_context(env)
+    out_bucket = ctx.out_bucket
     """Creates the trigger json that is used by foufront endpoint.
     """
     input_json = {'input_files': input_files,
@@ -141,7 +264,7 @@ def run_json(input_files, env, wf_info, run_name):
                              "log_bucket": "tibanna-output",
                              "key_name": "4dn-encode"
                              },
-                  "_tibanna": {"env": env,
+                  "_tibanna": {"env": ctx.env,
                                "run_type": wf_info['wf_name'],
                                "run_id": run_name}
                   }
@@ -152,11 +275,57 @@ def run_json(input_files, env, wf_info, run_name):
     return input_json
 
 
-def find_pairs(my_rep_set, my_env, lookfor='pairs', exclude_miseq=True):
-    auth = ff_utils.get_authentication_with_server({}, ff_env=my_env)
-    my_s3_util = s3_utils(env=my_env)
+# (bucket, key) of files found on s3 - files don't go away so only need checking once a session
+_S3_KEYS_FOUND = set()
+
+
+def s3_key_exists(my_s3_util, upload_key, bucket):
+    """does_key_exist with the keys found cached for the session"""
+    if (bucket, upload_key) in _S3_KEYS_FOUND:
+        return True
+    if my_s3_util.does_key_exist(upload_key, bucket):
+        _S3_KEYS_FOUND.add((bucket, upload_key))
+        return True
+    return False
+
+
+def find_pairs(my_rep_set, my_env, lookfor='pairs', exclude_miseq=True, workers=8):
+    ctx = get_env_context(my_env)
+    auth = ctx.auth
+    my_s3_util = ctx.s3
     """Find fastq files from experiment set, exclude miseq.
+    The metadata of all the files in the set are fetched concurrently, then the s3 checks of only
+    the files _find_pairs looks for on s3 - checks not started when it stops early are cancelled
     """
+    rep_resp = my_rep_set['experiments_in_set']
+    file_uuids = list(dict.fromkeys(f['uuid'] for exp in rep_resp for f in exp['files']))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        file_resps = dict(zip(file_uuids, executor.map(
+            lambda f: ff_utils.get_metadata(f, key=auth), file_uuids)))
+        in_s3 = {}
+        # the loop stops at the first experiment if it doesn't have a single organism
+        if rep_resp and len(set(bs['individual']['organism']['name']
+                                for bs in rep_resp[0]['biosample']['biosource'])) == 1:
+            for file_resp in file_resps.values():
+                if _needs_s3_check(file_resp, exclude_miseq) and file_resp['upload_key'] not in in_s3:
+                    in_s3[file_resp['upload_key']] = executor.submit(
+                        s3_key_exists, my_s3_util, file_resp['upload_key'], my_s3_util.raw_file_bucket)
+        return _find_pairs(my_rep_set, file_resps, in_s3, lookfor, exclude_miseq)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _needs_s3_check(file_resp, exclude_miseq):
+    """the same checks find_pairs makes before it looks for a file on s3"""
+    return (file_resp.get('paired_end') != '2' and
+            not (exclude_miseq and file_resp.get('instrument') == 'Illumina MiSeq') and
+            file_resp['status'] != 'deleted' and bool(file_resp.get('filename')) and
+            bool(file_resp.get('upload_key')))
+
+
+def _find_pairs(my_rep_set, file_resps, in_s3, lookfor, exclude_miseq):
+    """find_pairs with the file metadata and futures of the s3 checks by upload_key"""
     report = {}
     rep_resp = my_rep_set['experiments_in_set']
     lab = [my_rep_set['lab']['@id']]
@@ -180,7 +349,7 @@ def find_pairs(my_rep_set, my_env, lookfor='pairs', exclude_miseq=True):
             enzymes.append(enzyme['display_title'])
 
         for fastq_file in exp_files:
-            file_resp = ff_utils.get_metadata(fastq_file['uuid'], key=auth)
+            file_resp = file_resps[fastq_file['uuid']]
             if not file_resp.get('file_size'):
                 print("WARNING!", file_resp['accession'], 'does not have filesize')
             else:
@@ -204,9 +373,8 @@ def find_pairs(my_rep_set, my_env, lookfor='pairs', exclude_miseq=True):
                 continue
             # check if file is in s3
 
-            head_info = my_s3_util.does_key_exist(file_resp['upload_key'], my_s3_util.raw_file_bucket)
-
-            if not head_info:
+            in_s3_check = in_s3.get(file_resp.get('upload_key'))
+            if in_s3_check is None or not in_s3_check.result():
                 print(file_resp['accession'], "does not have a file in S3")
                 continue
             # check that file has a pair
@@ -272,131 +440,153 @@ def find_pairs(my_rep_set, my_env, lookfor='pairs', exclude_miseq=True):
     return report, organism, enz, bwa, chrsize, enz_file, int(total_f_size / (1024 * 1024 * 1024)), lab
 
 
-def get_wfr_out(file_id, wfr_name, auth, versions, md_qc=False, run=100):
-    """For a given files, fetches the status of last wfr_name
-    If there is a successful run it will return the output files as a dictionary of
-    file_format:file_id, else, will return the status. Some runs, like qc and md5,
-    does not have any file_format output, so they will simply return 'complete'
+def get_es_items(item_ids, auth, fields=None):
+    """Get many items in one bulk ES request (embedded frame) - only the given fields (and uuid)
+    if fields are given. Ids that are not uuids or items not indexed yet are fetched one by one.
+    Returns a dictionary of item_id:item
     """
-    emb_file = ff_utils.get_metadata(file_id, key=auth)
-    workflows = emb_file.get('workflow_run_inputs')
-    wfr = {}
-    run_status = 'did not run'
-
+    item_ids = list(dict.fromkeys(item_ids))
+    uuids = [i for i in item_ids if scu.is_uuid(i)]
+    items = {}
+    if uuids:
+        sources = None
+        if fields:
+            sources = ['embedded.' + f for f in ['uuid'] + list(fields)]
+        for hit in ff_utils.get_es_metadata(uuids, sources=sources, key=auth):
+            items[hit['embedded']['uuid']] = hit['embedded']
+    for item_id in item_ids:
+        if item_id not in items:
+            items[item_id] = ff_utils.get_metadata(item_id, key=auth)
+    return items
+
+
+def _select_last_wfr(emb_file, wfr_name, versions):
+    """Find the last run of wfr_name with an accepted version in the workflow_run_inputs of a file
+    returns the run (with run_hours, run_type and run_version added) and None, or None and a status
+    dictionary if there is no such run
+    """
+    workflows = emb_file.get('workflow_run_inputs') or []
     my_workflows = [i for i in workflows if i['display_title'].startswith(wfr_name)]
     if not my_workflows:
-        return {'status': "no workflow in file"}
+        return None, {'status': "no workflow in file"}
+    now = datetime.utcnow()
     for a_wfr in my_workflows:
-        wfr_type, time_info = a_wfr['display_title'].split(' run ')
-        wfr_type_base, wfr_version = wfr_type.strip().split(' ')
-        # user submitted ones use run on insteand of run
-        time_info = time_info.strip('on').strip()
-        try:
-            wfr_time = datetime.strptime(time_info, '%Y-%m-%d %H:%M:%S.%f')
-        except ValueError:
-            wfr_time = datetime.strptime(time_info, '%Y-%m-%d %H:%M:%S')
-        a_wfr['run_hours'] = (datetime.utcnow() - wfr_time).total_seconds() / 3600
-        a_wfr['run_type'] = wfr_type_base.strip()
-        a_wfr['run_version'] = wfr_version.strip()
-    my_workflows = [i for i in my_workflows if i['run_version'] in versions]
+        title = parse_wfr_title(a_wfr['display_title'])
+        if title is None:
+            continue
+        a_wfr['run_hours'] = title.run_hours(now)
+        a_wfr['run_type'] = title.name
+        a_wfr['run_version'] = title.version
+    my_workflows = [i for i in my_workflows if i.get('run_version') in versions and i.get('run_type') == wfr_name]
     if not my_workflows:
-        return {'status': "no workflow in file with accepted version"}
-    my_workflows = sorted(my_workflows, key=lambda k: k['run_hours'])
-    last_wfr = [i for i in my_workflows if i['run_type'] == wfr_name][0]
+        return None, {'status': "no workflow in file with accepted version"}
+    return min(my_workflows, key=lambda k: k['run_hours']), None
 
-    wfr = ff_utils.get_metadata(last_wfr['uuid'], key=auth)
-    run_duration = last_wfr['run_hours']
-    run_status = wfr['run_status']
 
+def _output_format(output):
+    # with new file format objects, we need to parse the name
+    f_format = output['format']
+    if isinstance(f_format, dict):  # embedded file format item
+        f_format = f_format['@id']
+    try:  # the new expected file format
+        return f_format.split('/')[2]
+    except IndexError:  # the old format
+        return f_format
+
+
+def _wfr_out_status(wfr, run_hours, md_qc=False, run=100, by_arg_name=False):
+    """Status of a run - for a complete run a dictionary of the output files keyed by
+    file_format (or argument name if by_arg_name) with the status
+    """
+    run_status = wfr['run_status']
     if run_status == 'complete':
-        outputs = wfr.get('output_files')
+        outputs = wfr.get('output_files') or []
         # some runs, like qc, don't have a real file output
         if md_qc:
             return {'status': 'complete'}
-        # if expected output files, return a dictionary of file_type:file_id
+        # if expected output files, return a dictionary of file_type (or argname):file_id
+        out_files = {}
+        for output in outputs:
+            if output.get('format'):
+                if by_arg_name:
+                    out_key = output['workflow_argument_name']
+                else:
+                    out_key = _output_format(output)
+                out_files[out_key] = output['value']['@id']
+        if out_files:
+            out_files['status'] = 'complete'
+            return out_files
         else:
-            out_files = {}
-            for output in outputs:
-                if output.get('format'):
-                    # with new file format objects, we need to parse the name
-                    try:  # the new expected file format
-                        f_format = output['format'].split('/')[2]
-                    except IndexError:  # the old format
-                        f_format = output['format']
-                    out_files[f_format] = output['value']['@id']
-            if out_files:
-                out_files['status'] = 'complete'
-                return out_files
-            else:
-                print('no output file was found, maybe this run is a qc?')
-                return {'status': "no file found"}
-    elif run_status != 'error' and run_duration < run:
-        # print(run_duration)
+            print('no output file was found, maybe this run is a qc?')
+            return {'status': "no file found"}
+    elif run_status != 'error' and run_hours < run:
         return {'status': "running"}
     else:
         return {'status': "no completed run"}
 
 
+def _get_wfr_out(file_id, wfr_name, auth, versions, md_qc=False, run=100, by_arg_name=False):
+    emb_file = ff_utils.get_metadata(file_id, key=auth)
+    last_wfr, status = _select_last_wfr(emb_file, wfr_name, versions)
+    if status:
+        return status
+    wfr = ff_utils.get_metadata(last_wfr['uuid'], key=auth)
+    return _wfr_out_status(wfr, last_wfr['run_hours'], md_qc, run, by_arg_name)
+
+
+def get_wfr_out(file_id, wfr_name, auth, versions, md_qc=False, run=100):
+    """For a given files, fetches the status of last wfr_name
+    If there is a successful run it will return the output files as a dictionary of
+    file_format:file_id, else, will return the status. Some runs, like qc and md5,
+    does not have any file_format output, so they will simply return 'complete'
+    """
+    return _get_wfr_out(file_id, wfr_name, auth, versions, md_qc=md_qc, run=run)
+
+
 def get_wfr_out_file(file_id, wfr_name, auth, versions, md_qc=False, run=100):
     """For a given files, fetches the status of last wfr_name
     If there is a successful run it will return the output files as a dictionary of
     argument_name:file_id, else, will return the status. Some runs, like qc and md5,
     does not have any file_format output, so they will simply return 'complete'
     """
-    emb_file = ff_utils.get_metadata(file_id, key=auth)
-    workflows = emb_file.get('workflow_run_inputs')
-    wfr = {}
-    run_status = 'did not run'
+    return _get_wfr_out(file_id, wfr_name, auth, versions, md_qc=md_qc, run=run, by_arg_name=True)
 
-    my_workflows = [i for i in workflows if i['display_title'].startswith(wfr_name)]
-    if not my_workflows:
-        return {'status': "no workflow in file"}
-    for a_wfr in my_workflows:
-        wfr_type, time_info = a_wfr['display_title'].split(' run ')
-        wfr_type_base, wfr_version = wfr_type.strip().split(' ')
-        # user submitted ones use run on insteand of run
-        time_info = time_info.strip('on').strip()
-        try:
-            wfr_time = datetime.strptime(time_info, '%Y-%m-%d %H:%M:%S.%f')
-        except ValueError:
-            wfr_time = datetime.strptime(time_info, '%Y-%m-%d %H:%M:%S')
-        a_wfr['run_hours'] = (datetime.utcnow() - wfr_time).total_seconds() / 3600
-        a_wfr['run_type'] = wfr_type_base.strip()
-        a_wfr['run_version'] = wfr_version.strip()
-    my_workflows = [i for i in my_workflows if i['run_version'] in versions]
-    if not my_workflows:
-        return {'status': "no workflow in file with accepted version"}
-    my_workflows = sorted(my_workflows, key=lambda k: k['run_hours'])
-    last_wfr = [i for i in my_workflows if i['run_type'] == wfr_name][0]
 
-    wfr = ff_utils.get_metadata(last_wfr['uuid'], key=auth)
-    run_duration = last_wfr['run_hours']
-    run_status = wfr['run_status']
+def get_wfr_out_batch(file_ids, wfr_name, auth, versions, md_qc=False, run=100, by_arg_name=False, workers=8):
+    """get_wfr_out (or get_wfr_out_file with by_arg_name=True) for many files
+    The files are fetched concurrently and the last runs of all of them in bulk from ES
+    (runs not indexed yet are fetched one by one). Returns a dictionary of file_id:result
+    """
+    file_ids = list(dict.fromkeys(file_ids))
 
-    if run_status == 'complete':
-        outputs = wfr.get('output_files')
-        # some runs, like qc, don't have a real file output
-        if md_qc:
-            return {'status': 'complete'}
-        # if expected output files, return a dictionary of argname:file_id
+    def _get_file(file_id):
+        try:
+            return ff_utils.get_metadata(file_id, key=auth)
+        except Exception as e:
+            print('can not get', file_id, e)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        files = dict(zip(file_ids, executor.map(_get_file, file_ids)))
+
+    results = {}
+    last_wfrs = {}
+    for file_id, emb_file in files.items():
+        if emb_file is None:
+            results[file_id] = {'status': "file not found"}
+            continue
+        last_wfr, status = _select_last_wfr(emb_file, wfr_name, versions)
+        if status:
+            results[file_id] = status
         else:
-            out_files = {}
-            for output in outputs:
-                if output.get('format'):
-                    # get the arg name
-                    arg_name = output['workflow_argument_name']
-                    out_files[arg_name] = output['value']['@id']
-            if out_files:
-                out_files['status'] = 'complete'
-                return out_files
-            else:
-                print('no output file was found, maybe this run is a qc?')
-                return {'status': "no file found"}
-    elif run_status != 'error' and run_duration < run:
-        # print(run_duration)
-        return {'status': "running"}
-    else:
-        return {'status': "no completed run"}
+            last_wfrs[file_id] = last_wfr
+
+    wfr_uuids = [i['uuid'] for i in last_wfrs.values()]
+    wfrs = get_es_items(wfr_uuids, auth, fields=['run_status', 'output_files'])
+
+    for file_id, last_wfr in last_wfrs.items():
+        results[file_id] = _wfr_out_status(wfrs[last_wfr['uuid']], last_wfr['run_hours'],
+                                           md_qc, run, by_arg_name)
+    return results
 
 
 def add_processed_files(item_id, list_pc, auth):
@@ -476,7 +666,136 @@ def release_files(set_id, list_items, auth, status=None):
             ff_utils.patch_metadata({"status": item_status}, obj_id=a_file, key=auth)
 
 
-def run_missing_wfr(wf_info, input_files, run_name, auth, env):
+def launch_run(input_json, auth):
+    """Post an input json to WorkflowRun/run and show the link to the run"""
+    e = ff_utils.post_metadata(input_json, 'WorkflowRun/run', key=auth)
+    url = json.loads(e['input'])['_tibanna']['url']
+    display(HTML("<a href='{}' target='_blank'>{}</a>".format(url, e['status'])))
+    return e
+
+
+def _flatten(values):
+    if isinstance(values, list):
+        return [v for i in values for v in _flatten(i)]
+    return [values]
+
+
+def validate_run_jsons(input_jsons, auth):
+    """Check prepared WorkflowRun/run input jsons before launching them - the input files
+    must be complete, in the buckets of the env and exist with the given object keys
+    (all files are fetched in bulk). Returns a dictionary of index:list of problems for the
+    input jsons that have problems
+    """
+    problems = {}
+    expected = {}  # file uuid: [(json index, object_key, bucket)]
+    for idx, input_json in enumerate(input_jsons):
+        json_problems = problems.setdefault(idx, [])
+        for a_key in ['workflow_uuid', 'app_name', 'output_bucket']:
+            if not input_json.get(a_key):
+                json_problems.append('missing ' + a_key)
+        env = input_json.get('_tibanna', {}).get('env')
+        if not env:
+            json_problems.append('missing _tibanna env')
+            continue
+        ctx = get_env_context(env)
+        if input_json.get('output_bucket') != ctx.out_bucket:
+            json_problems.append('output bucket is not {}'.format(ctx.out_bucket))
+        for inp in input_json.get('input_files', []):
+            # extract_file_info returns None for files from different buckets
+            if not inp:
+                json_problems.append('missing input files (files from different buckets?)')
+                continue
+            arg = inp.get('workflow_argument_name')
+            if inp.get('bucket_name') not in [ctx.raw_bucket, ctx.out_bucket]:
+                json_problems.append('{} bucket {} not in {}'.format(arg, inp.get('bucket_name'), ctx.env))
+            uuids = _flatten(inp.get('uuid'))
+            object_keys = _flatten(inp.get('object_key'))
+            if len(uuids) != len(object_keys) or not all(uuids):
+                json_problems.append('{} uuids do not match object keys'.format(arg))
+                continue
+            for uuid, object_key in zip(uuids, object_keys):
+                expected.setdefault(uuid, []).append((idx, object_key, inp.get('bucket_name'), ctx))
+
+    found = {}
+    if expected:
+        sources = ['embedded.uuid', 'embedded.display_title', 'embedded.@type']
+        for hit in ff_utils.get_es_metadata(list(expected), sources=sources, key=auth):
+            found[hit['embedded']['uuid']] = hit['embedded']
+    for uuid, uses in expected.items():
+        file_resp = found.get(uuid)
+        if file_resp is None:  # not indexed yet
+            try:
+                file_resp = ff_utils.get_metadata(uuid, key=auth)
+            except Exception:
+                for idx, _, _, _ in uses:
+                    problems[idx].append('file {} not found'.format(uuid))
+                continue
+        for idx, object_key, bucket, ctx in uses:
+            if file_resp['display_title'] != object_key:
+                problems[idx].append('object key {} is not the file {}'.format(object_key, uuid))
+            if 'FileProcessed' in file_resp['@type']:
+                file_bucket = ctx.out_bucket
+            else:  # covers cases of FileFastq, FileReference, FileMicroscopy
+                file_bucket = ctx.raw_bucket
+            if bucket != file_bucket:
+                problems[idx].append('file {} is not in {}'.format(object_key, bucket))
+    return {idx: probs for idx, probs in problems.items() if probs}
+
+
+def submit_runs(input_jsons, auth, workers=4, rate=1):
+    """Launch many prepared WorkflowRun/run input jsons (eg. made by the run_missing_* functions
+    with launch=False). All are validated first and those with problems are not launched,
+    the others are posted with up to 'workers' at a time and at most 'rate' launches a second.
+    Returns a summary table - a list of dictionaries with run_id, app_name, status and url or problem
+    """
+    input_jsons = [i for i in input_jsons if i]
+    invalid = validate_run_jsons(input_jsons, auth)
+    summary = []
+    for idx, input_json in enumerate(input_jsons):
+        summary.append({'run_id': input_json.get('_tibanna', {}).get('run_id'),
+                        'app_name': input_json.get('app_name'),
+                        'status': 'invalid' if idx in invalid else 'not launched',
+                        'url': '',
+                        'problem': '; '.join(invalid.get(idx, []))})
+
+    def _launch(idx, input_json):
+        return ff_utils.post_metadata(input_json, 'WorkflowRun/run', key=auth)
+
+    def _report(idx, res, error):
+        # must not raise - the other launches go on and need reporting
+        if error is not None:
+            summary[idx].update({'status': 'error', 'problem': str(error)})
+            return
+        status = res.get('status') if isinstance(res, dict) else None
+        try:
+            url = json.loads(res['input'])['_tibanna']['url']
+        except (KeyError, TypeError, ValueError):
+            url = ''
+        summary[idx].update({'status': status or 'error', 'url': url})
+        if not url:
+            summary[idx]['problem'] = 'no run url in response: {}'.format(str(res)[:200])
+
+    to_launch = ((idx, i) for idx, i in enumerate(input_jsons) if idx not in invalid)
+    # no retries - a timed out launch may still have started the run
+    scu.run_patches(to_launch, auth, action=_launch, workers=workers, rate=rate, retries=0, callback=_report)
+    return summary
+
+
+def display_run_summary(summary):
+    """Show the summary table of submit_runs with links to the launched runs"""
+    rows = []
+    for run in summary:
+        status = run['status']
+        if run['url']:
+            status = "<a href='{}' target='_blank'>{}</a>".format(run['url'], status)
+        rows.append('<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>'.format(
+            run['run_id'], run['app_name'], status, run['problem']))
+    display(HTML('<table><tr><th>run</th><th>workflow</th><th>status</th><th>problem</th></tr>{}</table>'.format(
+        ''.join(rows))))
+
+
+def run_missing_wfr(wf_info, input_files, run_name, auth, env, launch=True):
+    env = get_env_context(env)
     all_inputs = []
     for arg, files in input_files.items():
         inp = extract_file_info(files, arg, env)
@@ -485,10 +804,9 @@ def run_missing_wfr(wf_info, input_files, run_name, auth, env):
     all_inputs = sorted(all_inputs, key=itemgetter('workflow_argument_name'))
 
     input_json = run_json(all_inputs, env, wf_info, run_name)
-    e = ff_utils.post_metadata(input_json, 'WorkflowRun/run', key=auth)
-
-    url = json.loads(e['input'])['_tibanna']['url']
-    display(HTML("<a href='{}' target='_blank'>{}</a>".format(url, e['status'])))
+    if not launch:
+        return input_json
+    launch_run(input_json, auth)
     return
 
 
@@ -613,54 +931,17 @@ def get_chip_files(exp_resp, my_auth):
     return files, obj_key, paired
 
 
-def run_missing_chip1(control, wf_info, organism, target_type, paired, files, obj_keys, my_env, my_key, run_name):
-    my_s3_util = s3_utils(env=my_env)
-    raw_bucket = my_s3_util.raw_file_bucket
-    out_bucket = my_s3_util.outfile_bucket
-
-    if organism == "human":
-        org = 'hs'
-        input_files = [{
-            "object_key": "4DNFIZQB369V.bwaIndex.tar",
-            "rename": "GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta.tar",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.bwa_idx_tar",
-            "uuid": "38077b98-3862-45cd-b4be-8e28e9494549"
-        },
-            {
-            "object_key": "4DNFIZ1TGJZR.bed.gz",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.blacklist",
-            "uuid": "9562ffbd-9f7a-4bd7-9c10-c335137d8966"
-        },
-            {
-            "object_key": "4DNFIZJB62D1.chrom.sizes",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.chrsz",
-            "uuid": "9866d158-da3c-4d9b-96a9-1d59632eabeb"
-        }]
-
-    elif organism == "mouse":
-        org = 'mm'
-        input_files = [{
-            "object_key": "4DNFIZ2PWCC2.bwaIndex.tar",
-            "rename": "mm10_no_alt_analysis_set_ENCODE.fasta.tar",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.bwa_idx_tar",
-            "uuid": "f4b63d31-65d8-437f-a76a-6bedbb52ae6f"
-        },
-            {
-            "object_key": "4DNFIZ3FBPK8.bed.gz",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.blacklist",
-            "uuid": "a32747a3-8a9e-4a9e-a7a1-4db0e8b65925"
-        },
-            {
-            "object_key": "4DNFIBP173GC.chrom.sizes",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.chrsz",
-            "uuid": "be0a9819-d2ce-4422-be4b-234fb1677dd9"
-        }]
+def run_missing_chip1(control, wf_info, organism, target_type, paired, files, obj_keys, my_env, my_key, run_name,
+                      launch=True):
+    ctx = get_env_context(my_env)
+    raw_bucket = ctx.raw_bucket
+    out_bucket = ctx.out_bucket
+
+    if not REFERENCE_FILES.has_pipeline(organism, 'chip'):
+        print('no reference files for', organism)
+        return
+    org = REFERENCE_FILES.get(organism, 'chip', 'gensz')
+    input_files = REFERENCE_FILES.input_files(organism, 'chip', ctx)
     if control:
         input_files.append({"object_key": obj_keys,
                             "bucket_name": raw_bucket,
@@ -719,60 +1000,35 @@ def run_missing_chip1(control, wf_info, organism, target_type, paired, files, ob
                   "parameters": parameters,
                   "config": wf_info['config'],
                   "custom_pf_fields": wf_info['custom_pf_fields'],
-                  "_tibanna": {"env": my_env,
+                  "_tibanna": {"env": ctx.env,
                                "run_type": wf_info['wf_name'],
                                "run_id": run_name},
                   "tag": tag
                   }
     # r = json.dumps(input_json)
     # print(r)
-    e = ff_utils.post_metadata(input_json, 'WorkflowRun/run', key=my_key)
-    url = json.loads(e['input'])['_tibanna']['url']
-    display(HTML("<a href='{}' target='_blank'>{}</a>".format(url, e['status'])))
+    if not launch:
+        return input_json
+    launch_run(input_json, my_key)
 
 
 def run_missing_chip2(control_set, wf_info, organism, target_type, paired,
-                      ta, ta_xcor, ta_cnt, my_env, my_key, run_ids):
-    my_s3_util = s3_utils(env=my_env)
-    raw_bucket = my_s3_util.raw_file_bucket
-    out_bucket = my_s3_util.outfile_bucket
-
-    if organism == "human":
-        org = 'hs'
-        input_files = [{
-            "object_key": "4DNFIZ1TGJZR.bed.gz",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.blacklist",
-            "uuid": "9562ffbd-9f7a-4bd7-9c10-c335137d8966"
-        },
-            {
-            "object_key": "4DNFIZJB62D1.chrom.sizes",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.chrsz",
-            "uuid": "9866d158-da3c-4d9b-96a9-1d59632eabeb"
-        }]
-
-    elif organism == "mouse":
-        org = 'mm'
-        input_files = [{
-            "object_key": "4DNFIZ3FBPK8.bed.gz",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.blacklist",
-            "uuid": "a32747a3-8a9e-4a9e-a7a1-4db0e8b65925"
-        },
-            {
-            "object_key": "4DNFIBP173GC.chrom.sizes",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "chip.chrsz",
-            "uuid": "be0a9819-d2ce-4422-be4b-234fb1677dd9"
-        }]
-
-    ta_f = extract_file_info(ta, 'chip.tas', my_env, rename=['bed', 'tagAlign'])
+                      ta, ta_xcor, ta_cnt, my_env, my_key, run_ids, launch=True):
+    ctx = get_env_context(my_env)
+    out_bucket = ctx.out_bucket
+
+    if not REFERENCE_FILES.has_pipeline(organism, 'chip'):
+        print('no reference files for', organism)
+        return
+    org = REFERENCE_FILES.get(organism, 'chip', 'gensz')
+    input_files = REFERENCE_FILES.input_files(organism, 'chip', ctx, arguments=['chip.blacklist', 'chip.chrsz'])
+
+    ta_f = extract_file_info(ta, 'chip.tas', ctx, rename=['bed', 'tagAlign'])
     input_files.append(ta_f)
-    ta_xcor_f = extract_file_info(ta_xcor, 'chip.bam2ta_no_filt_R1.ta', my_env, rename=['bed', 'tagAlign'])
+    ta_xcor_f = extract_file_info(ta_xcor, 'chip.bam2ta_no_filt_R1.ta', ctx, rename=['bed', 'tagAlign'])
     input_files.append(ta_xcor_f)
     if control_set:
-        ta_cnt = extract_file_info(ta_cnt, 'chip.ctl_tas', my_env, rename=['bed', 'tagAlign'])
+        ta_cnt = extract_file_info(ta_cnt, 'chip.ctl_tas', ctx, rename=['bed', 'tagAlign'])
         input_files.append(ta_cnt)
 
     if paired == 'single':
@@ -811,66 +1067,28 @@ def run_missing_chip2(control_set, wf_info, organism, target_type, paired,
                   "parameters": parameters,
                   "config": wf_info['config'],
                   "custom_pf_fields": wf_info['custom_pf_fields'],
-                  "_tibanna": {"env": my_env,
+                  "_tibanna": {"env": ctx.env,
                                "run_type": wf_info['wf_name'],
                                "run_id": run_ids['run_name']},
                   "tag": tag
                   }
     # r = json.dumps(input_json)
     # print(r)
-    e = ff_utils.post_metadata(input_json, 'WorkflowRun/run', key=my_key)
-    url = json.loads(e['input'])['_tibanna']['url']
-    display(HTML("<a href='{}' target='_blank'>{}</a>".format(url, e['status'])))
+    if not launch:
+        return input_json
+    launch_run(input_json, my_key)
 
 
-def run_missing_atac1(wf_info, organism, paired, files, obj_keys, my_env, my_key, run_name):
-    my_s3_util = s3_utils(env=my_env)
-    raw_bucket = my_s3_util.raw_file_bucket
-    out_bucket = my_s3_util.outfile_bucket
-
-    if organism == "human":
-        org = 'hs'
-        input_files = [{
-            "object_key": "4DNFIMQPTYDY.bowtie2Index.tar",
-            "rename": "GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta.tar",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.bowtie2_idx_tar",
-            "uuid": "28ab6265-f426-4a23-bb8a-f28467ad505b"
-        },
-            {
-            "object_key": "4DNFIZ1TGJZR.bed.gz",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.blacklist",
-            "uuid": "9562ffbd-9f7a-4bd7-9c10-c335137d8966"
-        },
-            {
-            "object_key": "4DNFIZJB62D1.chrom.sizes",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.chrsz",
-            "uuid": "9866d158-da3c-4d9b-96a9-1d59632eabeb"
-        }]
-
-    elif organism == "mouse":
-        org = 'mm'
-        input_files = [{
-            "object_key": "4DNFI2493SDN.bowtie2Index.tar",
-            "rename": "mm10_no_alt_analysis_set_ENCODE.fasta.tar",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.bowtie2_idx_tar",
-            "uuid": "63e22058-79c6-4e24-8231-ca4afac29dda"
-        },
-            {
-            "object_key": "4DNFIZ3FBPK8.bed.gz",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.blacklist",
-            "uuid": "a32747a3-8a9e-4a9e-a7a1-4db0e8b65925"
-        },
-            {
-            "object_key": "4DNFIBP173GC.chrom.sizes",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.chrsz",
-            "uuid": "be0a9819-d2ce-4422-be4b-234fb1677dd9"
-        }]
+def run_missing_atac1(wf_info, organism, paired, files, obj_keys, my_env, my_key, run_name, launch=True):
+    ctx = get_env_context(my_env)
+    raw_bucket = ctx.raw_bucket
+    out_bucket = ctx.out_bucket
+
+    if not REFERENCE_FILES.has_pipeline(organism, 'atac'):
+        print('no reference files for', organism)
+        return
+    org = REFERENCE_FILES.get(organism, 'atac', 'gensz')
+    input_files = REFERENCE_FILES.input_files(organism, 'atac', ctx)
 
     input_files.append({"object_key": obj_keys,
                         "bucket_name": raw_bucket,
@@ -912,55 +1130,30 @@ def run_missing_atac1(wf_info, organism, paired, files, obj_keys, my_env, my_key
                   "parameters": parameters,
                   "config": wf_info['config'],
                   "custom_pf_fields": wf_info['custom_pf_fields'],
-                  "_tibanna": {"env": my_env,
+                  "_tibanna": {"env": ctx.env,
                                "run_type": wf_info['wf_name'],
                                "run_id": run_name},
                   "tag": tag
                   }
     # r = json.dumps(input_json)
     # print(r)
-    e = ff_utils.post_metadata(input_json, 'WorkflowRun/run', key=my_key)
-    url = json.loads(e['input'])['_tibanna']['url']
-    display(HTML("<a href='{}' target='_blank'>{}</a>".format(url, e['status'])))
+    if not launch:
+        return input_json
+    launch_run(input_json, my_key)
 
 
 def run_missing_atac2(wf_info, organism, paired, ta,
-                      my_env, my_key, run_name):
-    my_s3_util = s3_utils(env=my_env)
-    raw_bucket = my_s3_util.raw_file_bucket
-    out_bucket = my_s3_util.outfile_bucket
-
-    if organism == "human":
-        org = 'hs'
-        input_files = [{
-            "object_key": "4DNFIZ1TGJZR.bed.gz",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.blacklist",
-            "uuid": "9562ffbd-9f7a-4bd7-9c10-c335137d8966"
-        },
-            {
-            "object_key": "4DNFIZJB62D1.chrom.sizes",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.chrsz",
-            "uuid": "9866d158-da3c-4d9b-96a9-1d59632eabeb"
-        }]
-
-    elif organism == "mouse":
-        org = 'mm'
-        input_files = [{
-            "object_key": "4DNFIZ3FBPK8.bed.gz",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.blacklist",
-            "uuid": "a32747a3-8a9e-4a9e-a7a1-4db0e8b65925"
-        },
-            {
-            "object_key": "4DNFIBP173GC.chrom.sizes",
-            "bucket_name": raw_bucket,
-            "workflow_argument_name": "atac.chrsz",
-            "uuid": "be0a9819-d2ce-4422-be4b-234fb1677dd9"
-        }]
-
-    ta_f = extract_file_info(ta, 'atac.tas', my_env, rename=['bed', 'tagAlign'])
+                      my_env, my_key, run_name, launch=True):
+    ctx = get_env_context(my_env)
+    out_bucket = ctx.out_bucket
+
+    if not REFERENCE_FILES.has_pipeline(organism, 'atac'):
+        print('no reference files for', organism)
+        return
+    org = REFERENCE_FILES.get(organism, 'atac', 'gensz')
+    input_files = REFERENCE_FILES.input_files(organism, 'atac', ctx, arguments=['atac.blacklist', 'atac.chrsz'])
+
+    ta_f = extract_file_info(ta, 'atac.tas', ctx, rename=['bed', 'tagAlign'])
     input_files.append(ta_f)
 
     if paired == 'single':
@@ -992,35 +1185,44 @@ def run_missing_atac2(wf_info, organism, paired, ta,
                   "parameters": parameters,
                   "config": wf_info['config'],
                   "custom_pf_fields": wf_info['custom_pf_fields'],
-                  "_tibanna": {"env": my_env,
+                  "_tibanna": {"env": ctx.env,
                                "run_type": wf_info['wf_name'],
                                "run_id": run_name},
                   "tag": tag
                   }
     # r = json.dumps(input_json)
     # print(r)
-    e = ff_utils.post_metadata(input_json, 'WorkflowRun/run', key=my_key)
-    url = json.loads(e['input'])['_tibanna']['url']
-    display(HTML("<a href='{}' target='_blank'>{}</a>".format(url, e['status'])))
+    if not launch:
+        return input_json
+    launch_run(input_json, my_key)
 
 
 def select_best_2(file_list, my_key):
-    scores = []
+    """Of a list of (at least 3) processed files pick the 2 with the most mapped reads
+    in their qc - the files and then their qcs are each fetched in one bulk request
+    and the scores of all files are reported
+    """
     # run it for list with at least 3 elements
     if len(file_list) < 3:
         return(file_list)
 
+    f_resps = get_es_items(file_list, my_key, fields=['quality_metric.uuid'])
+    qc_uuids = {}
     for f in file_list:
-        f_resp = ff_utils.get_metadata(f, my_key)
-        qc = f_resp.get('quality_metric')
+        qc = f_resps[f].get('quality_metric')
         if not qc:
             print('No qc found on file', f)
             return
-        qc_resp = ff_utils.get_metadata(qc['uuid'], my_key)
+        qc_uuids[f] = qc['uuid']
+    qc_resps = get_es_items(qc_uuids.values(), my_key, fields=['nodup_flagstat_qc', 'ctl_nodup_flagstat_qc'])
+    scores = []
+    for f in file_list:
+        qc_resp = qc_resps[qc_uuids[f]]
         try:
             score = qc_resp['nodup_flagstat_qc'][0]['mapped']
         except Exception:
             score = qc_resp['ctl_nodup_flagstat_qc'][0]['mapped']
+        print(f, score)
         scores.append((score, f))
-    scores = sorted(scores, key=lambda x: -x[0])
-    return [scores[0][1], scores[1][1]]
+    best = heapq.nlargest(2, scores, key=lambda x: x[0])
+    return [best[0][1], best[1][1]]
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+''' Apply a workflow run cleanup plan saved as jsonl by functions.cleanup (plan_cleanup or
+    delete_wfrs with a DeletionPlan, then plan.write) - the planned status changes and field
+    deletions are made with concurrent patches without fetching anything from the database
+'''
+
+import sys
+import argparse
+from collections import Counter
+from datetime import datetime
+from functions.script_utils import (
+    create_ff_arg_parser,
+    create_workers_arg_parser,
+    create_journal_arg_parser,
+    authenticate,
+    WriteJournal,
+)
+from functions.cleanup import DeletionPlan, apply_deletion_plan
+
+
+def get_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Given a cleanup plan jsonl file apply the status changes it contains',
+        parents=[create_ff_arg_parser(), create_workers_arg_parser(), create_journal_arg_parser()],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('plan',
+                        help="the jsonl plan file to apply")
+    return parser.parse_args(args)
+
+
+def describe_plan(plan):
+    """Count the planned changes by item type and reason"""
+    counts = Counter((change['item_type'], change.get('reason')) for change in plan.changes.values())
+    lines = ['{} {} {}'.format(n, itype, reason) for (itype, reason), n in sorted(counts.items(), key=str)]
+    if plan.field_deletions:
+        lines.append('{} field deletions'.format(len(plan.field_deletions)))
+    notes = Counter(note.get('reason') for note in plan.notes)
+    lines.extend('{} not changed - {}'.format(n, reason) for reason, n in sorted(notes.items(), key=str))
+    return lines
+
+
+def main():  # pragma: no cover
+    start = datetime.now()
+    print(str(start))
+    args = get_args()
+    plan = DeletionPlan.read(args.plan)
+    for line in describe_plan(plan):
+        print(line)
+    if not args.dbupdate:
+        print("DRY RUN - use --dbupdate to update the database")
+        return
+    auth = authenticate(key=args.key, keyfile=args.keyfile, env=args.env)
+    if args.resume and not args.journal:
+        print("--resume needs the --journal file of the run to resume")
+        sys.exit(1)
+    journal = None
+    if args.journal:
+        journal = WriteJournal(args.journal, resume=args.resume)
+    try:
+        report = apply_deletion_plan(plan, auth, workers=args.workers, journal=journal)
+    finally:
+        if journal is not None:
+            journal.close()
+    print("{} runs, {} files and {} qcs deleted, {} failed".format(
+        len(report['wfrs']), len(report['files']), len(report['qcs']), len(report['errors'])))
+
+    end = datetime.now()
+    print("FINISHED - START: ", str(start), "\tEND: ", str(end))
+
+
+if __name__ == '__main__':
+    main()
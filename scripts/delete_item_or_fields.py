@@ -15,7 +15,7 @@ from functions import script_utils as scu
 
 def get_args(args):
     parser = argparse.ArgumentParser(
-        parents=[scu.create_input_arg_parser(), scu.create_ff_arg_parser()],
+        parents=[scu.create_input_arg_parser(), scu.create_ff_arg_parser(), scu.create_workers_arg_parser()],
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser.add_argument('--fields',
@@ -39,47 +39,44 @@ def main():  # pragma: no cover
         fields = args.fields
         del_flds = ','.join(fields)
     problems = []
-    for iid in id_list:
-        try:
-            get_metadata(iid, auth, add_on='frame=object')
-        except Exception:
-            problems.append(iid)
-            continue
 
-        if del_flds:
-            # we have field(s) that we want to delete from provided items
-            print(f"Will delete {del_flds} from {iid}")
+    def _deletes():
+        for iid in id_list:
             if dry_run:
-                print("DRY RUN")
-            else:
                 try:
-                    res = delete_field(iid, del_flds, auth)
-                    status = res.get('status')
-                    if status.lower() == 'success':
-                        print(status)
-                    else:
-                        print(res)
-                        problems.append(iid)
-                except Exception as e:
-                    print(f"PROBLEM: {e}")
+                    get_metadata(iid, auth, add_on='frame=object')
+                except Exception:
                     problems.append(iid)
-        else:
-            # we want to set the status of the items in id_list to deleted
-            print(f"Will set status of {iid} to DELETED")
+                    continue
+            if del_flds:
+                # we have field(s) that we want to delete from provided items
+                print(f"Will delete {del_flds} from {iid}")
+            else:
+                # we want to set the status of the items in id_list to deleted
+                print(f"Will set status of {iid} to DELETED")
             if dry_run:
                 print("DRY RUN")
             else:
-                try:
-                    res = delete_metadata(iid, auth)
-                    status = res.get('status')
-                    if status.lower() == 'success':
-                        print(status)
-                    else:
-                        print(res)
-                        problems.append(iid)
-                except Exception as e:
-                    print(f"PROBLEM: {e}")
-                    problems.append(iid)
+                yield iid, del_flds
+
+    def _delete(iid, del_flds):
+        # raises if the item can't be found
+        get_metadata(iid, auth, add_on='frame=object')
+        if del_flds:
+            return delete_field(iid, del_flds, auth)
+        return delete_metadata(iid, auth)
+
+    def _report(iid, res, error):
+        if error is not None:
+            print(f"PROBLEM: {error}")
+            problems.append(iid)
+        elif res.get('status').lower() == 'success':
+            print(res.get('status'))
+        else:
+            print(res)
+            problems.append(iid)
+
+    scu.run_patches(_deletes(), auth, action=_delete, workers=args.workers, callback=_report)
 
     if problems:
         print('THERE WAS A PROBLEM DELETING METADATA FOR THE FOLLOWING:')
@@ -1,13 +1,12 @@
 import sys
 import argparse
-from dcicutils import ff_utils as ff
 from functions import script_utils as scu
 
 
 def get_args():  # pragma: no cover
     parser = argparse.ArgumentParser(
         description='Provide a search query suffix and get a list of item uuids',
-        parents=[scu.create_ff_arg_parser(), scu.create_input_arg_parser()],
+        parents=[scu.create_ff_arg_parser(), scu.create_input_arg_parser(), scu.create_workers_arg_parser()],
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     args = parser.parse_args()
@@ -21,20 +20,25 @@ def main():
     itemids = scu.get_item_ids_from_args(args.input, auth, args.search)
     seen = []
     failed = []
-    for itemid in itemids:
-        print("Touching ", itemid)
-        if args.dbupdate:
-            try:
-                res = ff.patch_metadata({}, itemid, auth)
-                print(res.get('status'))
-                if res.get('status') == 'success':
-                    seen.append(itemid)
-            except Exception:
-                print(itemid, ' failed to patch')
-                failed.append(itemid)
-                continue
-        else:
-            print('dry run!')
+
+    def _patches():
+        for itemid in itemids:
+            print("Touching ", itemid)
+            if args.dbupdate:
+                yield itemid, {}
+            else:
+                print('dry run!')
+
+    def _report(itemid, res, error):
+        if error is not None:
+            print(itemid, ' failed to patch')
+            failed.append(itemid)
+            return
+        print(res.get('status'))
+        if res.get('status') == 'success':
+            seen.append(itemid)
+
+    scu.run_patches(_patches(), auth, workers=args.workers, callback=_report)
     for i in seen:
         print(i)
     print("Failures")
@@ -133,6 +133,8 @@ def add_notes_to_tsv(file_meta, auth):
     except Exception as e:
         print(e)
         return "ERROR"
+    finally:
+        scu.invalidate_cached(file_meta.get('uuid'), auth)
     if pres.get('status') == 'success':
         return "SUCCESS"
     return "ERROR"
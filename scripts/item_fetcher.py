@@ -4,9 +4,12 @@ Given a list of item IDs will fetch the items or the fields of those items
 specified in the --fields parameter)
 '''
 import argparse
-from dcicutils.ff_utils import get_metadata
+import re
+from dcicutils.ff_utils import get_metadata, get_es_metadata
 from functions import script_utils as scu
 
+ACCESSION_RE = re.compile(r'^4DN[A-Z]{2}[0-9A-Z]{7}$')
+
 
 def get_args():
     parser = argparse.ArgumentParser(
@@ -20,10 +23,109 @@ def get_args():
                         action='store_true',
                         default='False',
                         help="By default the id provided is the first column of output - this flag removes that column")
+    parser.add_argument('--es',
+                        default=False,
+                        action='store_true',
+                        help="Fetch the items in batches from ES retrieving only the requested --fields. \
+                        Much faster for long lists but output is in the order items are retrieved")
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=200,
+                        help="Number of items to fetch per ES request when using --es. Default 200")
 
     return parser.parse_args()
 
 
+def get_items(id_list, auth):
+    """Generator of (id, item) fetching items one by one in frame=object
+        item is None if there was a problem getting it"""
+    for iid in id_list:
+        try:
+            yield iid, get_metadata(iid, auth, add_on='frame=object')
+        except Exception:
+            yield iid, None
+
+
+def _looks_like(iid):
+    """the field an id that isn't a uuid can be searched by - or None"""
+    if ACCESSION_RE.match(iid):
+        return 'accession'
+    if ':' in iid and '/' not in iid:
+        return 'aliases'
+    return None
+
+
+def resolve_uuids(id_list, auth, chunk_size=100):
+    """dict of id: uuid for the ids that can be found - accessions and aliases are looked
+        up with chunked searches, other ids (eg. @ids) with a GET each"""
+    uuids = {}
+    to_search = []
+    for iid in id_list:
+        if scu.is_uuid(iid):
+            uuids[iid] = iid
+            continue
+        field = _looks_like(iid)
+        if field:
+            to_search.append({field: [iid] if field == 'aliases' else iid})
+        else:
+            try:
+                uuids[iid] = scu.get_item_uuid(iid, auth)
+            except Exception:
+                pass
+    if to_search:
+        found = scu.find_existing_items(auth, 'item', to_search, ['accession', 'aliases'], chunk_size=chunk_size)
+        for (field, val), uuid in found.items():
+            uuids[val] = uuid
+    return {iid: uuid for iid, uuid in uuids.items() if uuid}
+
+
+def get_es_items(id_list, auth, fields=None, chunk_size=200):
+    """Generator of (id, item) fetching items in chunks from ES as they are retrieved
+        only the requested fields of the object frame are transferred
+        ids that can't be found are yielded first (if they can't be resolved to a uuid)
+        or last with None as item. Every input id is yielded - an item reached by several ids
+        (or the same id repeated) is fetched once and yielded for each of them"""
+    uuids = resolve_uuids(id_list, auth)
+    uuid2ids = {}
+    for iid in id_list:
+        if iid in uuids:
+            uuid2ids.setdefault(uuids[iid], []).append(iid)
+        else:
+            yield iid, None
+    sources = ['object.' + f for f in fields] if fields else ['object.*']
+    hits = get_es_metadata(list(uuid2ids), sources=sources + ['uuid'], chunk_size=chunk_size,
+                           is_generator=True, key=auth)
+    for hit in hits:
+        for iid in uuid2ids.pop(hit.get('uuid'), []):
+            yield iid, hit.get('object', {})
+    for ids in uuid2ids.values():
+        for iid in ids:
+            yield iid, None
+
+
+def format_fields(res, fields):
+    """tab separated string of the values of fields in item
+        linked items are given by uuid and lists as comma separated values"""
+    line = ''
+    for f in fields:
+        val = res.get(f)
+        if isinstance(val, dict):
+            val = val.get('uuid')
+        elif isinstance(val, list):
+            vs = ''
+            for v in val:
+                if isinstance(v, dict):
+                    v = v.get('uuid')
+                else:
+                    v = str(v)
+                vs = vs + v + ', '
+            val = vs
+            if val.endswith(', '):
+                val = val[:-2]
+        line = line + str(val) + '\t'
+    return line
+
+
 def main():  # pragma: no cover
     args = get_args()
     auth = scu.authenticate(key=args.key, keyfile=args.keyfile, env=args.env)
@@ -37,44 +139,21 @@ def main():  # pragma: no cover
         if args.noid is True:
             header = header.replace('#id\t', '#')
         print(header)
+    if args.es:
+        items = get_es_items(id_list, auth, args.fields, args.chunk_size)
+    else:
+        items = get_items(id_list, auth)
     problems = []
-    for iid in id_list:
-        try:
-            res = get_metadata(iid, auth, add_on='frame=object')
-        except Exception:
+    for iid, res in items:
+        if res is None:
             problems.append(iid)
             continue
 
         if args.fields:
-            line = ''
-            # counts = {}
-            for f in fields:
-                val = res.get(f)
-                # if val is not None:  # added in for specific use case
-                if isinstance(val, dict):
-                    val = val.get('uuid')
-                elif isinstance(val, list):
-                    # counts[f] = len(val)  # added in for specific use case
-                    # if len(counts) > 1:
-                    #     print(iid, '\t', counts)
-                    # else:
-                    #     cnt = list(counts.values())[0]
-                    #     if cnt > 1:
-                    #         print(iid, '\t', cnt)
-                    vs = ''
-                    for v in val:
-                        if isinstance(v, dict):
-                            v = v.get('uuid')
-                        else:
-                            v = str(v)
-                        vs = vs + v + ', '
-                    val = vs
-                    if val.endswith(', '):
-                        val = val[:-2]
-                line = line + str(val) + '\t'
+            line = format_fields(res, fields)
             if args.noid == 'False':
                 line = iid + '\t' + line
-            print(line)
+            print(line, flush=True)
         else:
             if args.noid is True:
                 print(res)
@@ -10,7 +10,7 @@ from dcicutils.ff_utils import (
     get_metadata,
     patch_metadata,
 )
-from functions.script_utils import create_ff_arg_parser
+from functions import script_utils as scu
 ''' Will attempt to load data from a file into the database using the load_data endpoint if it can
     or post/patch_metadata if not
     The file can be a simple list of json items in which case you need to specify an item type
@@ -103,7 +103,7 @@ ORDER = [
 def get_args():  # pragma: no cover
     parser = argparse.ArgumentParser(
         description='Given a file of item jsons try to load into database',
-        parents=[create_ff_arg_parser()],
+        parents=[scu.create_ff_arg_parser()],
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
 
@@ -161,31 +161,6 @@ def load_file(auth, itype, filename):
         raise
 
 
-def get_item(val, auth):
-    try:
-        return get_metadata(val, auth).get('uuid')
-    except:
-        return None
-
-
-def check_for_existing(item, itype, idfields, auth):
-    uid = None
-    for ifield in idfields:
-        id2chk = item.get(ifield)
-        if id2chk:
-            if ifield == 'aliases':
-                for a in id2chk:
-                    uid = get_item(a, auth)
-                    if uid:
-                        return uid
-            else:
-                chkid = itype + '/' + id2chk
-                uid = get_item(chkid, auth)
-                if uid:
-                    return uid
-    return uid
-
-
 def main():  # pragma: no cover
     start = datetime.now()
     print(str(start))
@@ -222,21 +197,21 @@ def main():  # pragma: no cover
                     schema_path = 'profiles/' + itype + '.json'
                     schema_info = get_metadata(schema_path, auth)
                     identifiers = schema_info.get('identifyingProperties')
-                # checking to see if an item exists
+                # checking to see if an item exists - looked up in bulk for all items
                 # if no can use load_data endpoint
                 # if yes do it the old fashioned way
                 to_patch = []
                 to_post = []
+                existing = scu.find_existing_items(auth, itype, items, identifiers)
                 for item in items:
                     uid = item.get('uuid')
                     if uid:
-                        exists = get_item(uid, auth)
-                        if exists:  # try a patch
+                        if ('uuid', uid) in existing:  # try a patch
                             to_patch.append(item)
                         else:
                             to_post.append(item)
                     else:
-                        uid = check_for_existing(item, itype, identifiers, auth)
+                        uid = scu.get_existing_uuid(item, identifiers, existing)
                         if uid:  # try a patch
                             item['uuid'] = uid
                             to_patch.append(item)
@@ -3,15 +3,21 @@
 import sys
 import argparse
 import json
+import re
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from uuid import uuid4
 from dcicutils.ff_utils import (
     get_authentication_with_server,
     post_metadata,
-    get_metadata,
     patch_metadata,
+    get_schemas as ff_get_schemas,
 )
-from functions.script_utils import create_ff_arg_parser, authenticate
+from functions import script_utils as scu
 ''' Will attempt to load data from a file into the database using the load_data endpoint if it can
     or post/patch_metadata if not
     The file can be a simple list of json items in which case you need to specify an item type
@@ -22,6 +28,11 @@ from functions.script_utils import create_ff_arg_parser, authenticate
     attempt to read the file from the request - no ordering and if there are dependencies to
     linked items those items must either already be loaded or present in the file
     WARNING: currently only works locally or if file is uploaded as part of the app file system
+
+    Item types are loaded after the types they link to (from the linkTo properties of their schemas
+    with ORDER as a fallback) - with --workers > 1 types that don't depend on each other are loaded
+    at the same time and the load_data chunks of a type that doesn't link to itself are posted concurrently
+    - with no more than --workers writes to the database running at once over all the types
 '''
 
 ORDER = [
@@ -104,7 +115,7 @@ ORDER = [
 def get_args():  # pragma: no cover
     parser = argparse.ArgumentParser(
         description='Given a file of item jsons try to load into database',
-        parents=[create_ff_arg_parser()],
+        parents=[scu.create_ff_arg_parser(), scu.create_workers_arg_parser(), scu.create_journal_arg_parser()],
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
 
@@ -125,32 +136,133 @@ def get_args():  # pragma: no cover
     return args
 
 
-def patch_jsons(auth, to_patch):
+def patch_jsons(auth, to_patch, callback=None, slots=None):
+    """callback(items, error) is called after each patch
+        slots is an optional semaphore each patch holds while it runs"""
     for item in to_patch:
         uid = item.get('uuid')
+        error = None
         try:
-            patch_metadata(item, uid, auth)
+            with slots or nullcontext():
+                patch_metadata(item, uid, auth)
         except Exception as e:
             print(e)
+            error = e
+        if callback is not None:
+            callback([item], error)
 
 
-def load_json(auth, itype, item_list, chunk_size=50):
-    list_length = len(item_list)
-    curr_pos = 0
-    while curr_pos < list_length:
-        slice_for = chunk_size if (chunk_size and chunk_size <= (list_length - curr_pos)) else list_length - curr_pos
-        new_end = curr_pos + slice_for
-        chunk = item_list[curr_pos: new_end]
-        store = {itype: chunk}
-        payload = {'store': store, 'overwrite': True}
-        if 'localhost' in auth.get('server', ''):
-            payload['config_uri'] = 'development.ini'
+def _post_chunk(auth, itype, chunk, delay=0, slots=None):
+    """returns the error if the post fails (or None) and how long it took
+        waits delay seconds first - to back off before a retry - and holds
+        one of the slots (a semaphore shared by all writes) while posting"""
+    if delay:
+        time.sleep(delay)
+    store = {itype: chunk}
+    payload = {'store': store, 'overwrite': True}
+    if 'localhost' in auth.get('server', ''):
+        payload['config_uri'] = 'development.ini'
+    with slots or nullcontext():
+        start = time.monotonic()
         try:
             post_metadata(payload, 'load_data', auth)
         except Exception as e:
-            print("PROBLEM WITH POST")
-            print(e)
-        curr_pos = new_end
+            return e, time.monotonic() - start
+        return None, time.monotonic() - start
+
+
+class ChunkSizer(object):
+    """Adapts the number of items posted to load_data at once to how the server copes
+        the size doubles (up to max_size) while posts take less than half of target_secs and
+        halves (down to min_size) when they take longer than target_secs, time out, get a 413 or a 5xx
+    """
+    def __init__(self, size=50, min_size=1, max_size=1000, target_secs=30.0):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_secs = target_secs
+        self.size = max(min_size, min(size, max_size))
+
+    def posted(self, secs, error=None):
+        if error is not None:
+            if scu.is_retryable_error(error) or scu.get_error_status(error) == 413:
+                self.size = max(self.min_size, self.size // 2)
+        elif secs > self.target_secs:
+            self.size = max(self.min_size, self.size // 2)
+        elif secs <= self.target_secs / 2:
+            self.size = min(self.max_size, self.size * 2)
+
+
+# load_data responses for chunks with items that don't validate - the chunk is split to find them
+ITEM_ERROR_STATUSES = (400, 422)
+# no point going on posting
+AUTH_ERROR_STATUSES = (401, 403)
+
+
+def load_json(auth, itype, item_list, chunk_size=50, callback=None, workers=1,
+              max_chunk_size=1000, target_secs=30.0, retries=3, backoff=1.0, slots=None):
+    """Posts the items to load_data in chunks - up to 'workers' chunks at a time.
+        The chunk size starts at chunk_size and is adapted by a ChunkSizer as posts come back.
+        A chunk rejected as invalid (400/422) is split in half and the halves re-posted until
+        the items that can't be loaded are found - only those are reported.
+        A chunk that times out, can't connect, is too large or gets a 5xx is re-posted in pieces
+        of the (shrunk) chunk size up to 'retries' times with exponential backoff - if it still
+        fails, or on an auth error (401/403), nothing more is posted.
+        Other errors fail the whole chunk.
+        If a semaphore is given as slots each post holds it so posts of several load_json
+        running at once (eg. for different item types) can share one limit.
+        callback(items, error) is called in the calling thread for each chunk that is loaded
+        and for each item or chunk that can't be loaded.
+        Returns a list of (item, error) for the items that could not be loaded - including
+        the ones not posted because loading stopped"""
+    size = chunk_size or max(len(item_list), 1)
+    sizer = ChunkSizer(size, max_size=max(size, max_chunk_size), target_secs=target_secs)
+    bad = []
+    to_retry = deque()  # (chunk, tries) - halves of invalid chunks and chunks to post again
+    pos = 0
+    running = {}
+    stop_error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while running or (stop_error is None and (pos < len(item_list) or to_retry)):
+            while stop_error is None and len(running) < workers and (to_retry or pos < len(item_list)):
+                if to_retry:
+                    chunk, tries = to_retry.popleft()
+                else:
+                    chunk, tries = item_list[pos: pos + sizer.size], 0
+                    pos += len(chunk)
+                delay = backoff * 2 ** (tries - 1) if tries else 0
+                running[executor.submit(_post_chunk, auth, itype, chunk, delay, slots)] = (chunk, tries)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk, tries = running.pop(future)
+                error, secs = future.result()
+                sizer.posted(secs, error)
+                if error is not None and stop_error is None:
+                    status = scu.get_error_status(error)
+                    if status in ITEM_ERROR_STATUSES and len(chunk) > 1:
+                        half = len(chunk) // 2
+                        to_retry.extend([(chunk[:half], tries), (chunk[half:], tries)])
+                        continue
+                    can_retry = scu.is_retryable_error(error) or status == 413
+                    if can_retry and tries < retries:
+                        to_retry.extend((chunk[i: i + sizer.size], tries + 1)
+                                        for i in range(0, len(chunk), sizer.size))
+                        continue
+                    if can_retry or status in AUTH_ERROR_STATUSES:
+                        stop_error = error
+                if error is not None:
+                    if len(chunk) == 1:
+                        print("PROBLEM LOADING {} {}".format(itype, chunk[0].get('uuid')))
+                    else:
+                        print("PROBLEM LOADING {} {} items".format(len(chunk), itype))
+                    print(error)
+                    bad.extend((item, error) for item in chunk)
+                if callback is not None:
+                    callback(chunk, error)
+    if stop_error is not None:
+        not_posted = [item for chunk, _ in to_retry for item in chunk] + item_list[pos:]
+        print("STOPPED LOADING {} - {} items not posted".format(itype, len(not_posted)))
+        bad.extend((item, stop_error) for item in not_posted)
+    return bad
 
 
 def load_file(auth, itype, filename):
@@ -163,29 +275,192 @@ def load_file(auth, itype, filename):
         raise
 
 
-def get_item(val, auth):
+def order_index(itype):
+    """position of the type in ORDER - types not in ORDER go last"""
+    return ORDER.index(itype) if itype in ORDER else len(ORDER)
+
+
+def type_name_to_itype(name):
+    """'ExperimentSetReplicate' -> 'experiment_set_replicate'"""
+    return re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', name).lower()
+
+
+def get_schemas(auth, itypes):
+    """dict of item type to schema for all the types of the database - abstract ones too as they
+        are needed for the subtype relations - the given types are always in it, with None if
+        their schema can't be got"""
     try:
-        return get_metadata(val, auth).get('uuid')
-    except:
+        profiles = ff_get_schemas(key=auth)
+    except Exception as e:
+        print("Can't get schemas - {}".format(e))
+        profiles = {}
+    schemas = {type_name_to_itype(name): schema for name, schema in profiles.items()}
+    for itype in itypes:
+        if schemas.get(itype) is None:
+            print("Can't get schema for {}".format(itype))
+            schemas[itype] = None
+    return schemas
+
+
+def get_linked_types(schema_part):
+    """the set of item type names of all the linkTo in a schema or part of one"""
+    linked = set()
+    if isinstance(schema_part, dict):
+        for k, v in schema_part.items():
+            if k == 'linkTo':
+                linked.update([v] if isinstance(v, str) else v)
+            else:
+                linked.update(get_linked_types(v))
+    elif isinstance(schema_part, list):
+        for v in schema_part:
+            linked.update(get_linked_types(v))
+    return linked
+
+
+def get_parent_type(schema):
+    """the item type a schema is a subtype of from its rdfs:subClassOf - None for direct Item subtypes
+        eg. experiment for the ExperimentHiC schema"""
+    parent = (schema or {}).get('rdfs:subClassOf')
+    if not parent:
         return None
+    parent = type_name_to_itype(parent.replace('/profiles/', '').replace('.json', ''))
+    return None if parent == 'item' else parent
 
 
-def check_for_existing(item, itype, idfields, auth):
-    uid = None
-    for ifield in idfields:
-        id2chk = item.get(ifield)
-        if id2chk:
-            if ifield == 'aliases':
-                for a in id2chk:
-                    uid = get_item(a, auth)
-                    if uid:
-                        return uid
+def get_type_ancestors(schemas):
+    """dict of item type to the set of the type and all the types it is a subtype of
+        eg. file_set_calibration: {file_set_calibration, file_set}"""
+    parents = {itype: get_parent_type(schema) for itype, schema in schemas.items()}
+    ancestors = {}
+    for itype in schemas:
+        types = {itype}
+        parent = parents[itype]
+        while parent and parent not in types:
+            types.add(parent)
+            parent = parents.get(parent)
+        ancestors[itype] = types
+    return ancestors
+
+
+def links_to(itype, linked, ancestors=None):
+    """True if the type is one of the linked types or a subtype of one
+        eg. experiment_hi_c for Experiment - ancestors is from get_type_ancestors"""
+    return bool((ancestors or {}).get(itype, {itype}) & linked)
+
+
+def get_type_dependencies(schemas, ancestors=None):
+    """Given a dict of item type to schema return a dict of item type to the set of the other
+        types in the dict that it links to so need to be loaded first.
+        Types without a schema depend on all the types before them in ORDER and
+        links that go against ORDER are dropped so there can be no cycles.
+        Subtypes are found from ancestors (see get_type_ancestors) - by default made from the schemas"""
+    if ancestors is None:
+        ancestors = get_type_ancestors(schemas)
+    deps = {}
+    for itype, schema in schemas.items():
+        if schema is None:
+            deps[itype] = {t for t in schemas if order_index(t) < order_index(itype)}
+            continue
+        linked = {type_name_to_itype(lt) for lt in get_linked_types(schema.get('properties', {}))}
+        deps[itype] = {t for t in schemas
+                       if order_index(t) < order_index(itype) and links_to(t, linked, ancestors)}
+    return deps
+
+
+def links_to_self(itype, schema, ancestors=None):
+    """True if items of the type can link to each other - or if we don't know"""
+    if schema is None:
+        return True
+    if ancestors is None:
+        ancestors = get_type_ancestors({itype: schema})
+    linked = {type_name_to_itype(lt) for lt in get_linked_types(schema.get('properties', {}))}
+    return links_to(itype, linked, ancestors)
+
+
+def run_in_dependency_order(deps, load_type, workers=1):
+    """Calls load_type(itype) for each type in deps once all the types it depends on are done
+        with up to 'workers' types being loaded at once - ties are broken by ORDER"""
+    pending = {itype: set(d) for itype, d in deps.items()}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            ready = sorted((t for t, d in pending.items() if not d), key=order_index)
+            for itype in ready[:workers - len(running)]:
+                del pending[itype]
+                running[executor.submit(load_type, itype)] = itype
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                itype = running.pop(future)
+                future.result()
+                for d in pending.values():
+                    d.discard(itype)
+
+
+def filter_journaled(journal, items):
+    """Remove the items the journal has as already loaded
+        returns the remaining items and a dict of their journal (id, hash) - keyed by id(item)
+        as items get modified (eg. uuid added) before they are loaded"""
+    to_load = []
+    keys = {}
+    for item in items:
+        phash = scu.payload_hash(item)
+        jid = item.get('uuid', phash)
+        if not journal.is_confirmed(jid, phash):
+            keys[id(item)] = (jid, phash)
+            to_load.append(item)
+    return to_load, keys
+
+
+def load_items(auth, itype, items, schema, id_field=None, journal=None, workers=1, slots=None, ancestors=None):
+    """Posts the new items of a type with load_data and patches the existing ones
+        with up to 'workers' concurrent load_data posts - slots is a semaphore that
+        limits the writes of all the types being loaded at once (see main)"""
+    journal_keys = {}
+    if journal is not None:
+        to_load, journal_keys = filter_journaled(journal, items)
+        if len(to_load) < len(items):
+            print('skipping {} {} items already loaded'.format(len(items) - len(to_load), itype))
+        items = to_load
+
+    def record_in_journal(loaded, error):
+        for item in loaded:
+            journal.record(*journal_keys[id(item)], error=error)
+    record = record_in_journal if journal is not None else None
+    if id_field:
+        identifiers = [id_field]
+    else:
+        identifiers = (schema or {}).get('identifyingProperties')
+    # checking to see if an item exists - looked up in bulk for all items
+    # if no can use load_data endpoint
+    # if yes do it the old fashioned way
+    to_patch = []
+    to_post = []
+    existing = scu.find_existing_items(auth, itype, items, identifiers)
+    for item in items:
+        uid = item.get('uuid')
+        if uid:
+            if ('uuid', uid) in existing:  # try a patch
+                to_patch.append(item)
+            else:
+                to_post.append(item)
+        else:
+            uid = scu.get_existing_uuid(item, identifiers, existing)
+            if uid:  # try a patch
+                item['uuid'] = uid
+                to_patch.append(item)
             else:
-                chkid = itype + '/' + id2chk
-                uid = get_item(chkid, auth)
-                if uid:
-                    return uid
-    return uid
+                uid = str(uuid4())
+                item['uuid'] = uid
+                to_post.append(item)
+    if to_post:
+        # chunks of items that can link to each other are loaded one after the other
+        chunk_workers = 1 if links_to_self(itype, schema, ancestors) else workers
+        bad = load_json(auth, itype, to_post, chunk_size=100, callback=record, workers=chunk_workers,
+                        slots=slots)
+        if bad:
+            print('{} of {} {} items could not be loaded'.format(len(bad), len(to_post), itype))
+    if to_patch:
+        patch_jsons(auth, to_patch, callback=record, slots=slots)
 
 
 def main():  # pragma: no cover
@@ -194,6 +469,12 @@ def main():  # pragma: no cover
     args = get_args()
     auth = scu.authenticate(key=args.key, keyfile=args.keyfile, env=args.env)
     print('working on ', auth.get('server'))
+    if args.resume and not args.journal:
+        print("--resume needs the --journal file of the run to resume")
+        sys.exit(1)
+    journal = None
+    if args.journal and args.dbupdate and not args.as_file:
+        journal = scu.WriteJournal(args.journal, resume=args.resume)
     if args.as_file:
         if not args.dbupdate:
             print("DRY RUN - use --dbupdate to update the database")
@@ -214,42 +495,24 @@ def main():  # pragma: no cover
                     print("File is not in correct format")
                     sys.exit(1)
                 item_store = {args.itype: item_store}
-            for itype, items in sorted(item_store.items(), key=lambda x: ORDER.index(x[0])):
-                if not args.dbupdate:
+            if not args.dbupdate:
+                for itype, items in sorted(item_store.items(), key=lambda x: order_index(x[0])):
                     print('DRY RUN - would try to load {} {} items'.format(len(items), itype))
-                    continue
-                if args.id_field:
-                    identifiers = [args.id_field]
-                else:
-                    schema_path = 'profiles/' + itype + '.json'
-                    schema_info = get_metadata(schema_path, auth)
-                    identifiers = schema_info.get('identifyingProperties')
-                # checking to see if an item exists
-                # if no can use load_data endpoint
-                # if yes do it the old fashioned way
-                to_patch = []
-                to_post = []
-                for item in items:
-                    uid = item.get('uuid')
-                    if uid:
-                        exists = get_item(uid, auth)
-                        if exists:  # try a patch
-                            to_patch.append(item)
-                        else:
-                            to_post.append(item)
-                    else:
-                        uid = check_for_existing(item, itype, identifiers, auth)
-                        if uid:  # try a patch
-                            item['uuid'] = uid
-                            to_patch.append(item)
-                        else:
-                            uid = str(uuid4())
-                            item['uuid'] = uid
-                            to_post.append(item)
-                if to_post:
-                    load_json(auth, itype, to_post, chunk_size=1000)
-                if to_patch:
-                    patch_jsons(auth, to_patch)
+            else:
+                all_schemas = get_schemas(auth, item_store.keys())
+                ancestors = get_type_ancestors(all_schemas)
+                schemas = {itype: all_schemas[itype] for itype in item_store}
+                deps = get_type_dependencies(schemas, ancestors)
+                # --workers bounds all the writes - not per type
+                slots = threading.BoundedSemaphore(args.workers)
+
+                def load_type(itype):
+                    load_items(auth, itype, item_store[itype], schemas[itype], id_field=args.id_field,
+                               journal=journal, workers=args.workers, slots=slots, ancestors=ancestors)
+
+                run_in_dependency_order(deps, load_type, workers=args.workers)
+        if journal is not None:
+            journal.close()
     stop = datetime.now()
     print(str(stop))
 
@@ -10,13 +10,13 @@ from dcicutils.ff_utils import (
     patch_metadata,
     post_metadata,
 )
-from functions.script_utils import create_ff_arg_parser, authenticate
+from functions import script_utils as scu
 
 
 def get_args():  # pragma: no cover
     parser = argparse.ArgumentParser(
         description='Given a file of ontology term jsons (one per line) load into db',
-        parents=[create_ff_arg_parser()],
+        parents=[scu.create_ff_arg_parser(), scu.create_workers_arg_parser()],
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
 
@@ -35,6 +35,23 @@ def get_id(term):
     return id_tag
 
 
+def parse_term_line(line):
+    """json for a single term to (term id, term, phase2 json)
+        parents and slim_terms are removed from the term for phase 2 loading"""
+    term = json.loads(line)
+    if not isinstance(term, dict):
+        raise ValueError("expected a json object for the term")
+    id_tag = get_id(term)
+    if id_tag is None:
+        raise ValueError("No Identifier for {}".format(term))
+    tid = '/ontology-terms/' + id_tag
+    phase2json = {}
+    for field in ['parents', 'slim_terms']:
+        if field in term:
+            phase2json[field] = term.pop(field)
+    return tid, term, phase2json
+
+
 def main():  # pragma: no cover
     start = datetime.now()
     print(str(start))
@@ -42,66 +59,65 @@ def main():  # pragma: no cover
     auth = scu.authenticate(key=args.key, keyfile=args.keyfile, env=args.env)
 
     phase2 = {}
+    # in flight terms by input index - the same term id can be in the input more than once
+    tasks = {}
+    malformed = []
     # assumes a single line corresponds to json for single term
     if not args.dbupdate:
         print("DRY RUN - use --dbupdate to update the database")
-    with open(args.infile) as terms:
-        for t in terms:
-            phase2json = {}
-            term = json.loads(t)
-            id_tag = get_id(term)
-            if id_tag is None:
-                print("No Identifier for ", term)
-            else:
-                tid = '/ontology-terms/' + id_tag
-                # look for parents and remove for phase 2 loading if they are there
-                if 'parents' in term:
-                    phase2json['parents'] = term['parents']
-                    del term['parents']
-                if 'slim_terms' in term:
-                    phase2json['slim_terms'] = term['slim_terms']
-                    del term['slim_terms']
-
-                try:
-                    dbterm = get_metadata(tid, auth)
-                except:  # noqa
-                    dbterm = None
-                op = ''
-                if dbterm and 'OntologyTerm' in dbterm.get('@type', []):
-                    if args.dbupdate:
-                        e = patch_metadata(term, dbterm["uuid"], auth)
-                    else:
-                        e = {'status': 'dry run'}
-                    op = 'PATCH'
-                else:
-                    if args.dbupdate:
-                        e = post_metadata(term, 'OntologyTerm', auth)
-                    else:
-                        e = {'status': 'dry run'}
-                    op = 'POST'
-                status = e.get('status')
-                if status and status == 'dry run':
-                    print(op, status)
-                elif status and status == 'success':
-                    print(op, status, e['@graph'][0]['uuid'])
-                    if phase2json:
-                        phase2[e['@graph'][0]['uuid']] = phase2json
-                else:
-                    print('FAILED', tid, e)
 
-    print("START LOADING PHASE2 at ", str(datetime.now()))
-    for tid, data in phase2.items():
-        if args.dbupdate:
-            e = patch_metadata(data, tid, auth)
+    def _terms(lines):
+        parsed = scu.read_input_lines(lines, parse_term_line, malformed)
+        for idx, (tid, term, phase2json) in enumerate(parsed):
+            tasks[idx] = {'tid': tid, 'phase2json': phase2json, 'op': ''}
+            yield idx, term
+
+    def _load(idx, term):
+        task = tasks[idx]
+        try:
+            dbterm = get_metadata(task['tid'], auth)
+        except:  # noqa
+            dbterm = None
+        if dbterm and 'OntologyTerm' in dbterm.get('@type', []):
+            task['op'] = 'PATCH'
+            if args.dbupdate:
+                return patch_metadata(term, dbterm["uuid"], auth)
         else:
-            e = {'status': 'dry run'}
-        status = e.get('status')
+            task['op'] = 'POST'
+            if args.dbupdate:
+                return post_metadata(term, 'OntologyTerm', auth)
+        return {'status': 'dry run'}
+
+    def _report(idx, e, error):
+        task = tasks.pop(idx)
+        op = task['op']
+        status = e.get('status') if error is None else None
         if status and status == 'dry run':
-            print('PATCH', status)
+            print(op, status)
         elif status and status == 'success':
-            print('PATCH', status, e['@graph'][0]['uuid'])
+            print(op, status, e['@graph'][0]['uuid'])
+            if task['phase2json']:
+                phase2[e['@graph'][0]['uuid']] = task['phase2json']
         else:
-            print('FAILED', tid, e)
+            print('FAILED', task['tid'], e if error is None else error)
+
+    with open(args.infile) as terms:
+        scu.run_patches(_terms(terms), auth, action=_load, workers=args.workers, callback=_report)
+
+    print("START LOADING PHASE2 at ", str(datetime.now()))
+    if args.dbupdate:
+        def _report_phase2(tid, e, error):
+            status = e.get('status') if error is None else None
+            if status and status == 'success':
+                print('PATCH', status, e['@graph'][0]['uuid'])
+            else:
+                print('FAILED', tid, e if error is None else error)
+        scu.run_patches(phase2.items(), auth, workers=args.workers, callback=_report_phase2)
+    else:
+        for tid in phase2:
+            print('PATCH', 'dry run')
+    if malformed:
+        print("MALFORMED LINES NOT LOADED:", ', '.join(str(m) for m in malformed))
     end = datetime.now()
     print("FINISHED - START: ", str(start), "\tEND: ", str(end))
 
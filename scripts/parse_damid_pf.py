@@ -27,20 +27,23 @@ PF_BIN = '5kb bin'  # the bin for which a subset of files should be considered p
 
 
 def extract_rows(infile):
-    book, sheets = digest_xlsx(infile)
+    book, sheets = digest_xlsx(infile, read_only=True)
     data = []
-    row = reader(book, sheetname='FileProcessed')
-    fields = next(row)
-    fields = [f.replace('*', '') for f in fields]
-    types = next(row)
-    fields.pop(0)
-    types.pop(0)
-    for values in row:
-        if values[0].startswith('#'):
-            continue
-        values.pop(0)
-        meta = dict(zip(fields, values))
-        data.append(meta)
+    try:
+        row = reader(book, sheetname='FileProcessed')
+        fields = next(row)
+        fields = [f.replace('*', '') for f in fields]
+        types = next(row)
+        fields.pop(0)
+        types.pop(0)
+        for values in row:
+            if values[0].startswith('#'):
+                continue
+            values.pop(0)
+            meta = dict(zip(fields, values))
+            data.append(meta)
+    finally:
+        book.close()
     return data
 
 
@@ -6,7 +6,7 @@ from functions import script_utils as scu
 
 def get_args(args):
     parser = argparse.ArgumentParser(
-        parents=[scu.create_input_arg_parser(), scu.create_ff_arg_parser()],
+        parents=[scu.create_input_arg_parser(), scu.create_ff_arg_parser(), scu.create_workers_arg_parser()],
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser.add_argument('field',
@@ -45,19 +45,29 @@ def main():
             val = int(val)
         elif ntype == 'f':
             val = float(val)
-    for iid in itemids:
-        print("PATCHING", iid, "to", field, "=", val)
-        if (args.dbupdate):
-            # do the patch
-            if val == '*delete*':
-                res = delete_field(iid, field, auth)
-            else:
-                res = patch_metadata({args.field: val}, iid, auth)
-            if res['status'] == 'success':
-                print("SUCCESS!")
-            else:
-                print("FAILED TO PATCH", iid, "RESPONSE STATUS", res['status'], res['description'])
-                # print(res)
+
+    def _patches():
+        for iid in itemids:
+            print("PATCHING", iid, "to", field, "=", val)
+            if args.dbupdate:
+                yield iid, val
+
+    def _patch(iid, val):
+        if val == '*delete*':
+            return delete_field(iid, field, auth)
+        return patch_metadata({field: val}, iid, auth)
+
+    def _report(iid, res, error):
+        if error is not None:
+            print("FAILED TO PATCH", iid, error)
+        elif res['status'] == 'success':
+            print("SUCCESS!")
+        else:
+            print("FAILED TO PATCH", iid, "RESPONSE STATUS", res['status'], res['description'])
+
+    summary = scu.run_patches(_patches(), auth, action=_patch, workers=args.workers, callback=_report)
+    if args.dbupdate:
+        scu.print_patch_summary(summary)
 
 
 if __name__ == '__main__':  # pragma:nocover
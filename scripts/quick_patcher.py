@@ -8,14 +8,22 @@ import sys
 import argparse
 import json
 from datetime import datetime
-from dcicutils.ff_utils import patch_metadata
-from functions.script_utils import create_ff_arg_parser, authenticate
+from functions.script_utils import (
+    create_ff_arg_parser,
+    create_workers_arg_parser,
+    create_journal_arg_parser,
+    authenticate,
+    run_patches,
+    print_patch_summary,
+    WriteJournal,
+    read_input_lines,
+)
 
 
 def get_args():  # pragma: no cover
     parser = argparse.ArgumentParser(
         description='Given a file of uuid<tab>json items (one per line) patch item in db',
-        parents=[create_ff_arg_parser()],
+        parents=[create_ff_arg_parser(), create_workers_arg_parser(), create_journal_arg_parser()],
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
 
@@ -25,6 +33,18 @@ def get_args():  # pragma: no cover
     return args
 
 
+def parse_patch_line(line):
+    """uuid<tab>json payload line to (uuid, payload dict)"""
+    parts = line.split('\t')
+    if len(parts) != 2:
+        raise ValueError("expected 2 tab separated values found {}".format(len(parts)))
+    iid, payload = [t.strip() for t in parts]
+    payload = json.loads(payload)
+    if not iid or not isinstance(payload, dict):
+        raise ValueError("expected an item id and a json object")
+    return iid, payload
+
+
 def main():  # pragma: no cover
     start = datetime.now()
     print(str(start))
@@ -34,21 +54,40 @@ def main():  # pragma: no cover
     # assumes a single line corresponds to json for single term
     if not args.dbupdate:
         print("DRY RUN - use --dbupdate to update the database")
-    with open(args.infile) as items:
-        for i in items:
-            [iid, payload] = [t.strip() for t in i.split('\t')]
-            payload = json.loads(payload)
+
+    malformed = []
+
+    def _patches(items):
+        for iid, payload in read_input_lines(items, parse_patch_line, malformed):
             if args.dbupdate:
-                e = patch_metadata(payload, iid, auth)
+                yield iid, payload
             else:
                 print("DRY RUN\n\tPATCH: ", iid, " TO\n", payload)
-                e = {'status': 'success'}
+                print('success')
 
-            status = e.get('status')
-            if status and status == 'success':
-                print(status)
-            else:
-                print('FAILED', e)
+    def _report(iid, e, error):
+        status = e.get('status') if error is None else None
+        if status and status == 'success':
+            print(status)
+        else:
+            print('FAILED', iid, e if error is None else error)
+
+    if args.resume and not args.journal:
+        print("--resume needs the --journal file of the run to resume")
+        sys.exit(1)
+    journal = None
+    if args.journal and args.dbupdate:
+        journal = WriteJournal(args.journal, resume=args.resume)
+    try:
+        with open(args.infile) as items:
+            summary = run_patches(_patches(items), auth, workers=args.workers, callback=_report, journal=journal)
+    finally:
+        if journal is not None:
+            journal.close()
+    if args.dbupdate:
+        print_patch_summary(summary)
+    if malformed:
+        print("MALFORMED LINES NOT PATCHED:", ', '.join(str(m) for m in malformed))
 
     end = datetime.now()
     print("FINISHED - START: ", str(start), "\tEND: ", str(end))
@@ -106,6 +106,7 @@ def patch_and_report(auth, patch_d, skipped, uuid2patch, dryrun):
         if not dryrun:
             # do the patch
             res = patch_metadata(patch_d, uuid2patch, auth)
+            scu.invalidate_cached(uuid2patch, auth, res)
             if res['status'] == 'success':
                 print("SUCCESS!")
                 return True
@@ -1,6 +1,5 @@
 import sys
 import argparse
-from dcicutils.ff_utils import get_metadata, patch_metadata
 from functions import script_utils as scu
 """ Script to add arbitrary tags to items that can be tagged
 """
@@ -17,7 +16,7 @@ def make_tag_patch(item, tag):
 def get_args():  # pragma: no cover
     parser = argparse.ArgumentParser(
         description='Add a tag to provided items (and optionally their children)',
-        parents=[scu.create_input_arg_parser(), scu.create_ff_arg_parser()],
+        parents=[scu.create_input_arg_parser(), scu.create_ff_arg_parser(), scu.create_workers_arg_parser()],
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser.add_argument('tag',
@@ -61,17 +60,19 @@ def main():  # pragma: no cover
         for i, t in items2tag.items():
             if i not in seen:
                 seen.append(i)
-                item = get_metadata(i, auth)
+                item = scu.get_metadata_cached(i, auth)
                 if not scu.has_field_value(item, 'tags', args.tag):
                     # not already tagged with this tag so make a patch and add 2 dict
                     to_patch[i] = make_tag_patch(item, args.tag)
 
     # now do the patching or reporting
-    for pid, patch in to_patch.items():
-        if args.dbupdate:
-            pres = patch_metadata(patch, pid, auth)
-            print(pres['status'])
-        else:
+    if args.dbupdate:
+        def _report(pid, pres, error):
+            print(pres['status'] if error is None else error)
+        summary = scu.run_patches(to_patch.items(), auth, workers=args.workers, callback=_report)
+        scu.print_patch_summary(summary)
+    else:
+        for pid, patch in to_patch.items():
             print("DRY RUN: patch ", pid, " with ", patch)
 
 
@@ -1,4 +1,5 @@
 import pytest
+from functions.script_utils import METADATA_CACHE
 
 
 @pytest.fixture
@@ -8,3 +9,9 @@ def auth():
         "key": "testkey",
         "secret": "testsecret"
     }
+
+
+@pytest.fixture(autouse=True)
+def clear_metadata_cache():
+    # the cache is process wide so don't let items leak between tests
+    METADATA_CACHE.clear()
@@ -0,0 +1,21 @@
+from functions.cleanup import DeletionPlan
+from scripts import apply_cleanup_plan as acp
+
+
+def test_acp_get_args_defaults():
+    args = acp.get_args(['plan.jsonl'])
+    assert args.plan == 'plan.jsonl'
+    assert not args.dbupdate
+    assert args.workers == 1
+    assert args.journal is None
+
+
+def test_acp_describe_plan():
+    plan = DeletionPlan()
+    plan.add_wfr({'wfr_uuid': 'r1', 'outputs': ['o1', 'o2'], 'qcs': ['q1']}, reason='old style or dub')
+    plan.add_wfr({'wfr_uuid': 'r2', 'outputs': [], 'qcs': []}, reason='deleted file workflow')
+    plan.add_field_deletion('f1', 'quality_metric', reason='deleted file qc')
+    plan.note('r3', 'still running')
+    assert acp.describe_plan(plan) == [
+        '2 file old style or dub', '1 qc old style or dub', '1 wfr deleted file workflow',
+        '1 wfr old style or dub', '1 field deletions', '1 not changed - still running']
@@ -0,0 +1,317 @@
+import json
+import pytest
+from datetime import datetime
+from functions import cleanup
+
+
+@pytest.fixture
+def current_catalog(mocker):
+    """the up to date catalog delete_wfrs checks before planning deletions - empty by default"""
+    return mocker.patch('functions.cleanup.get_workflow_catalog', return_value={})
+
+
+def test_get_wfr_report():
+    wfrs = [
+        {'uuid': 'r2', 'display_title': 'bwa-mem 0.2.6 run 2019-02-01 10:00:00', 'run_status': 'complete',
+         'status': 'released', 'quality_metric': {'uuid': 'q1'},
+         'output_files': [{'value': {'uuid': 'o1'}}, {'value_qc': {'uuid': 'q2'}}]},
+        {'uuid': 'r1', 'display_title': 'bwa-mem 0.2.6 run on 2019-01-01 10:00:00.123', 'run_status': 'error',
+         'status': 'in review by lab'},
+        {'uuid': 'r0', 'display_title': 'bwa-mem run 2018-01-01 10:00:00', 'run_status': 'complete',
+         'status': 'released'}
+    ]
+    report = cleanup.get_wfr_report(wfrs)
+    assert [r['wfr_uuid'] for r in report] == ['r1', 'r2']
+    assert report[0]['wfr_date'] == datetime(2019, 1, 1, 10, 0, 0, 123000)
+    assert report[1] == {
+        'wfr_uuid': 'r2', 'wfr_status': 'complete', 'wfr_name': 'bwa-mem', 'wfr_version': '0.2.6',
+        'wfr_date': datetime(2019, 2, 1, 10), 'run_time': report[1]['run_time'], 'status': 'released',
+        'outputs': ['o1'], 'qcs': ['q1', 'q2']}
+    assert report[1]['run_time'] > 0
+
+
+def _wfr(uuid, title, run_status='complete', status='released to project', outputs=None, qc=None):
+    wfr = {'uuid': uuid, '@id': '/workflow-runs-awsem/{}/'.format(uuid), 'display_title': title,
+           'run_status': run_status, 'status': status,
+           'output_files': [{'value': {'uuid': o}} for o in outputs or []]}
+    if qc:
+        wfr['quality_metric'] = {'uuid': qc}
+    return wfr
+
+
+def test_prefetch_wfrs(mocker, auth):
+    files = [{'workflow_run_inputs': [{'uuid': 'r1'}, {'uuid': 'r2'}]},
+             {'workflow_run_inputs': [{'uuid': 'r2'}, {'uuid': 'r3'}]},
+             {'uuid': 'no runs'}]
+    es = mocker.patch('functions.cleanup.ff_utils.get_es_metadata',
+                      return_value=iter([{'embedded': {'uuid': 'r2'}}, {'embedded': {'uuid': 'r3'}}]))
+    stash = cleanup.prefetch_wfrs(files, auth, chunk_size=10, stash={'r1': {'uuid': 'r1'}})
+    assert es.call_args[0][0] == ['r2', 'r3']
+    assert es.call_args[1]['chunk_size'] == 10
+    assert stash == {'r1': {'uuid': 'r1'}, 'r2': {'uuid': 'r2'}, 'r3': {'uuid': 'r3'}}
+
+
+def test_delete_wfrs_dry_run_with_stash(mocker, capsys, auth):
+    file_resp = {'@id': '/files-processed/4DNFI1/', 'accession': '4DNFI1', 'status': 'uploaded',
+                 'workflow_run_inputs': [{'uuid': 'r1'}, {'uuid': 'r2'}, {'uuid': 'r3'}]}
+    stash = {'r1': _wfr('r1', 'bwa-mem 0.2.6 run 2019-01-01 10:00:00', status='uploaded', outputs=['o1']),
+             'r2': _wfr('r2', 'bwa-mem 0.2.6 run 2019-02-01 10:00:00', outputs=['o2']),
+             'r3': _wfr('r3', 'other-wf 1 run 2019-02-01 10:00:00')}
+    es = mocker.patch('functions.cleanup.ff_utils.get_es_metadata')
+    assert cleanup.delete_wfrs(file_resp, auth, [('bwa-mem', ['0.2.6'], 24)], stash=stash) == []
+    assert not es.called
+    out = capsys.readouterr()[0]
+    assert "Unlisted Workflow ['other-wf'] skipped in 4DNFI1" in out
+    assert 'bwa-mem old style or dub r1 4DNFI1' in out
+
+
+def test_delete_wfrs_needs_a_dict_stash(auth):
+    file_resp = {'@id': '/files-processed/4DNFI1/', 'accession': '4DNFI1', 'status': 'uploaded',
+                 'workflow_run_inputs': [{'uuid': 'r1'}]}
+    with pytest.raises(TypeError):
+        cleanup.delete_wfrs(file_resp, auth, [('bwa-mem', ['0.2.6'], 24)],
+                            stash=[_wfr('r1', 'bwa-mem 0.2.6 run 2019-01-01 10:00:00')])
+
+
+def test_delete_wfrs_fetches_runs_missing_from_stash(mocker, auth):
+    file_resp = {'@id': '/files-processed/4DNFI1/', 'accession': '4DNFI1', 'status': 'uploaded',
+                 'workflow_run_inputs': [{'uuid': 'r1'}, {'uuid': 'r2'}]}
+    stash = {'r1': _wfr('r1', 'bwa-mem 0.2.6 run 2019-01-01 10:00:00')}
+    es = mocker.patch('functions.cleanup.ff_utils.get_es_metadata', return_value=iter(
+        [{'embedded': _wfr('r2', 'bwa-mem 0.2.6 run 2019-02-01 10:00:00')}]))
+    cleanup.delete_wfrs(file_resp, auth, [('bwa-mem', ['0.2.6'], 24)], stash=stash)
+    assert es.call_args[0][0] == ['r2']
+    assert 'r2' in stash
+
+
+def test_deletion_plan_dedupes_items_shared_by_runs():
+    plan = cleanup.DeletionPlan()
+    assert plan.add_wfr({'wfr_uuid': 'r1', 'outputs': ['o1'], 'qcs': ['q1']}) == ['r1', 'o1', 'q1']
+    assert plan.add_wfr({'wfr_uuid': 'r2', 'outputs': ['o1', 'o2'], 'qcs': ['q1']}) == ['r2', 'o2']
+    assert plan.add_wfr({'wfr_uuid': 'r1', 'outputs': ['o1'], 'qcs': ['q1']}) == []
+    assert len(plan) == 5
+    assert plan.uuids('file') == ['o1', 'o2']
+    assert plan.changes['r1']['patch'] == {'description': "This workflow run is deleted", 'status': "deleted"}
+    assert plan.changes['o1']['patch'] == {'status': 'deleted'}
+
+
+def test_apply_deletion_plan(mocker, capsys, auth):
+    plan = cleanup.DeletionPlan()
+    plan.add_wfr({'wfr_uuid': 'r1', 'outputs': ['o1'], 'qcs': ['q1']})
+    plan.add_field_deletion('f1', 'quality_metric')
+    plan.add('q0', 'qc')
+    delete_field = mocker.patch('functions.cleanup.ff_utils.delete_field', return_value={'status': 'success'})
+    patch = mocker.patch('functions.script_utils.patch_metadata',
+                         side_effect=lambda payload, iid, auth: {'status': 'error' if iid == 'o1' else 'success'})
+    report = cleanup.apply_deletion_plan(plan, auth, workers=3, rate=None)
+    delete_field.assert_called_once_with('f1', 'quality_metric', key=auth)
+    assert sorted(c[0][1] for c in patch.call_args_list) == ['o1', 'q0', 'q1', 'r1']
+    assert report['wfrs'] == ['r1']
+    assert report['files'] == []
+    assert sorted(report['qcs']) == ['q0', 'q1']
+    assert list(report['errors']) == ['o1']
+    assert 'failed to delete o1' in capsys.readouterr()[0]
+
+
+def _old_and_new_runs(shared_qc):
+    return {'r1': _wfr('r1', 'bwa-mem 0.2.6 run 2019-01-01 10:00:00', status='uploaded',
+                       outputs=['o1'], qc=shared_qc),
+            'r2': _wfr('r2', 'bwa-mem 0.2.6 run 2019-02-01 10:00:00', outputs=['o2'])}
+
+
+def test_delete_wfrs_with_shared_plan(mocker, auth, current_catalog):
+    files = [{'@id': '/files-processed/4DNFI{}/'.format(i), 'accession': '4DNFI{}'.format(i), 'status': 'uploaded',
+              'workflow_run_inputs': [{'uuid': 'r1'}, {'uuid': 'r2'}]} for i in (1, 2)]
+    stash = _old_and_new_runs('q1')
+    patch = mocker.patch('functions.script_utils.patch_metadata')
+    plan = cleanup.DeletionPlan()
+    assert cleanup.delete_wfrs(files[0], auth, [('bwa-mem', ['0.2.6'], 24)], stash=stash, plan=plan) == [
+        'r1', 'o1', 'q1']
+    # the same runs reached from another file are not planned again
+    assert cleanup.delete_wfrs(files[1], auth, [('bwa-mem', ['0.2.6'], 24)], stash=stash, plan=plan) == []
+    assert not patch.called
+    assert list(plan.changes) == ['r1', 'o1', 'q1']
+
+
+def test_delete_wfrs_delete_applies_plan(mocker, auth, current_catalog):
+    file_resp = {'@id': '/files-processed/4DNFI1/', 'uuid': 'f1', 'accession': '4DNFI1', 'status': 'deleted',
+                 'quality_metric': {'uuid': 'q0'}, 'workflow_run_inputs': [{'uuid': 'r1'}]}
+    stash = _old_and_new_runs('q1')
+    mocker.patch('functions.cleanup.ff_utils.delete_field', return_value={'status': 'success'})
+    patch = mocker.patch('functions.script_utils.patch_metadata', return_value={'status': 'success'})
+    deleted = cleanup.delete_wfrs(file_resp, auth, [('bwa-mem', ['0.2.6'], 24)], delete=True, stash=stash)
+    assert sorted(deleted) == ['o1', 'q0', 'q1', 'r1']
+    assert patch.call_count == 4
+
+
+def test_delete_wfrs_delete_raises_when_deletions_fail(mocker, auth, current_catalog):
+    file_resp = {'@id': '/files-processed/4DNFI1/', 'uuid': 'f1', 'accession': '4DNFI1', 'status': 'deleted',
+                 'quality_metric': {'uuid': 'q0'}, 'workflow_run_inputs': [{'uuid': 'r1'}]}
+    stash = _old_and_new_runs('q1')
+    mocker.patch('functions.cleanup.ff_utils.delete_field', side_effect=Exception(
+        'Bad status code for PATCH request for https://a/f1: 403. Reason: forbidden'))
+    patch = mocker.patch('functions.script_utils.patch_metadata', return_value={'status': 'success'})
+    with pytest.raises(Exception, match='2 deletions failed for 4DNFI1: f1, q0 - deleted: r1, o1, q1'):
+        cleanup.delete_wfrs(file_resp, auth, [('bwa-mem', ['0.2.6'], 24)], delete=True, stash=stash)
+    assert patch.call_count == 3
+
+
+def test_plan_cleanup_writes_reasons_and_plan_round_trips(mocker, tmpdir, auth, current_catalog):
+    files = [{'@id': '/files-processed/4DNFI1/', 'uuid': 'f1', 'accession': '4DNFI1', 'status': 'uploaded',
+              'workflow_run_inputs': [{'uuid': 'r1'}, {'uuid': 'r2'}, {'uuid': 'r3'}]},
+             {'@id': '/files-processed/4DNFI2/', 'uuid': 'f2', 'accession': '4DNFI2', 'status': 'deleted',
+              'quality_metric': {'uuid': 'q0'}, 'workflow_run_inputs': [{'uuid': 'r1'}, {'uuid': 'r2'}]}]
+    runs = _old_and_new_runs('q1')
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    runs['r3'] = _wfr('r3', 'fastqc 1 run ' + now, run_status='running', status='uploaded')
+    es = mocker.patch('functions.cleanup.ff_utils.get_es_metadata',
+                      return_value=iter([{'embedded': r} for r in runs.values()]))
+    patch = mocker.patch('functions.script_utils.patch_metadata')
+    plan = cleanup.plan_cleanup(files, auth, [('bwa-mem', ['0.2.6'], 24), ('fastqc', ['1'], 24)])
+    assert es.call_count == 1
+    assert not patch.called
+    assert plan.changes['r1']['reason'] == 'old style or dub'
+    assert plan.changes['o1'] == {'item_type': 'file', 'patch': {'status': 'deleted'}, 'reason': 'old style or dub',
+                                  'file': '4DNFI1', 'wfr': 'r1'}
+    assert plan.changes['q0']['reason'] == 'deleted file qc'
+    assert plan.field_deletions == {'f2': {'delete_fields': ['quality_metric'], 'reason': 'deleted file qc',
+                                           'file': '4DNFI2'}}
+    assert {'uuid': 'r3', 'item_type': 'wfr', 'reason': 'still running', 'file': '4DNFI1'} in plan.notes
+    assert {'uuid': 'r2', 'item_type': 'wfr', 'reason': 'saved from deletion', 'file': '4DNFI2'} in plan.notes
+
+    path = str(tmpdir.join('plan.jsonl'))
+    plan.write(path)
+    saved = cleanup.DeletionPlan.read(path)
+    assert saved.changes == plan.changes
+    assert saved.field_deletions == plan.field_deletions
+    assert saved.notes == plan.notes
+
+
+def test_apply_deletion_plan_from_file(mocker, tmpdir, auth):
+    plan = cleanup.DeletionPlan()
+    plan.add_wfr({'wfr_uuid': 'r1', 'outputs': ['o1'], 'qcs': []}, reason='old style or dub', file='4DNFI1')
+    plan.note('r2', 'still running', '4DNFI1')
+    path = str(tmpdir.join('plan.jsonl'))
+    plan.write(path)
+    get = mocker.patch('functions.cleanup.ff_utils.get_metadata')
+    es = mocker.patch('functions.cleanup.ff_utils.get_es_metadata')
+    patch = mocker.patch('functions.script_utils.patch_metadata', return_value={'status': 'success'})
+    report = cleanup.apply_deletion_plan(path, auth, workers=2, rate=None)
+    assert report == {'wfrs': ['r1'], 'files': ['o1'], 'qcs': [], 'errors': {}}
+    assert sorted(c[0][1] for c in patch.call_args_list) == ['o1', 'r1']
+    assert not get.called and not es.called
+
+
+WORKFLOWS = [{'app_name': 'bwa-mem', 'app_version': '0.2.6', 'max_runtime': 12},
+             {'app_name': 'bwa-mem', 'app_version': '0.2.5', 'max_runtime': 24},
+             {'app_name': 'md5', 'app_version': '0.2.6'}]
+
+
+def test_get_workflow_details_uses_server_keyed_cache(mocker, tmpdir, auth):
+    cache_file = str(tmpdir.join('catalog.json'))
+    search = mocker.patch('functions.cleanup.ff_utils.search_metadata', return_value=WORKFLOWS)
+    details = cleanup.get_workflow_details(auth, cache_file=cache_file)
+    assert details == [('bwa-mem', ['0.2.6', '0.2.5'], 24), ('md5', ['0.2.6'], 0)]
+    assert cleanup.get_workflow_details(auth, cache_file=cache_file) == details
+    assert search.call_count == 1
+    with open(cache_file) as cached:
+        assert list(json.load(cached)) == [auth['server']]
+    # another server and a refresh on demand search again
+    other = dict(auth, server='https://staging.4dnucleome.org/')
+    cleanup.get_workflow_details(other, cache_file=cache_file)
+    cleanup.get_workflow_details(auth, refresh=True, cache_file=cache_file)
+    assert search.call_count == 3
+    with open(cache_file) as cached:
+        assert sorted(json.load(cached)) == sorted([auth['server'], other['server']])
+
+
+def test_get_workflow_catalog_refreshes_stale_cache(mocker, tmpdir, auth):
+    cache_file = str(tmpdir.join('catalog.json'))
+    with open(cache_file, 'w') as cached:
+        json.dump({auth['server']: {'fetched': 0, 'workflows': {}}}, cached)
+    mocker.patch('functions.cleanup.ff_utils.search_metadata', return_value=WORKFLOWS)
+    catalog = cleanup.get_workflow_catalog(auth, cache_file=cache_file)
+    assert catalog['md5'] == {'accepted_versions': ['0.2.6'], 'run_time': 0}
+
+
+def test_index_workflow_details():
+    index = cleanup.index_workflow_details([('bwa-mem', ['0.2.6', '0.2.5'], 24)])
+    assert index == {'bwa-mem': ({'0.2.6', '0.2.5'}, 24)}
+    assert cleanup.index_workflow_details(index) is index
+    assert cleanup.index_workflow_details({'bwa-mem': {'accepted_versions': ['0.2.6', '0.2.5'], 'run_time': 24}}) == index
+
+
+def test_group_wfr_report_keeps_date_order():
+    report = [{'wfr_name': 'md5', 'wfr_uuid': 'r1'}, {'wfr_name': 'fastqc', 'wfr_uuid': 'r2'},
+              {'wfr_name': 'md5', 'wfr_uuid': 'r3'}]
+    grouped = cleanup.group_wfr_report(report)
+    assert list(grouped) == ['md5', 'fastqc']
+    assert [r['wfr_uuid'] for r in grouped['md5']] == ['r1', 'r3']
+
+
+def test_delete_wfrs_reports_unlisted_once_and_plans_old_runs_per_workflow(mocker, capsys, auth, current_catalog):
+    file_resp = {'@id': '/files-fastq/4DNFI1/', 'accession': '4DNFI1', 'status': 'uploaded',
+                 'workflow_run_inputs': [{'uuid': u} for u in ('m1', 'm2', 'm3', 'x1', 'x2', 'f1')]}
+    stash = {'m1': _wfr('m1', 'md5 0.2.6 run 2019-01-01 10:00:00', status='uploaded'),
+             'm2': _wfr('m2', 'md5 0.2.6 run 2019-01-02 10:00:00', status='uploaded'),
+             'm3': _wfr('m3', 'md5 0.2.6 run 2019-01-03 10:00:00'),
+             'x1': _wfr('x1', 'other-wf 1 run 2019-01-01 10:00:00', status='uploaded'),
+             'x2': _wfr('x2', 'other-wf 1 run 2019-01-02 10:00:00', status='uploaded'),
+             'f1': _wfr('f1', 'fastqc 0.2.0 run 2019-01-01 10:00:00', status='uploaded')}
+    plan = cleanup.DeletionPlan()
+    workflows = cleanup.index_workflow_details([('md5', ['0.2.6'], 12), ('fastqc', ['0.2.1'], 12)])
+    cleanup.delete_wfrs(file_resp, auth, workflows, stash=stash, plan=plan)
+    out = capsys.readouterr()[0]
+    assert "Unlisted Workflow ['other-wf'] skipped in 4DNFI1" in out
+    # older md5 runs and the fastqc run of a version no longer accepted
+    assert sorted(plan.uuids('wfr')) == ['f1', 'm1', 'm2']
+
+
+def test_delete_wfrs_keeps_runs_of_newly_accepted_version(mocker, current_catalog, auth):
+    current_catalog.return_value = {'bwa-mem': {'accepted_versions': ['0.2.7'], 'run_time': 24}}
+    file_resp = {'@id': '/files-processed/4DNFI1/', 'accession': '4DNFI1', 'status': 'uploaded',
+                 'workflow_run_inputs': [{'uuid': 'r1'}, {'uuid': 'r2'}]}
+    stash = {'r1': _wfr('r1', 'bwa-mem 0.2.6 run 2019-01-01 10:00:00', status='uploaded'),
+             'r2': _wfr('r2', 'bwa-mem 0.2.7 run 2019-02-01 10:00:00', status='uploaded')}
+    plan = cleanup.DeletionPlan()
+    # details from a cache made before 0.2.7 was accepted
+    cleanup.delete_wfrs(file_resp, auth, [('bwa-mem', ['0.2.6'], 24)], stash=stash, plan=plan)
+    assert not current_catalog.called
+    assert plan.uuids('wfr') == ['r1', 'r2']
+    plan = cleanup.DeletionPlan()
+    cleanup.delete_wfrs(file_resp, auth, [('bwa-mem', ['0.2.6'], 24)], stash=stash, plan=plan, current_versions=True)
+    assert current_catalog.call_args[1]['max_age'] == cleanup.DELETE_CATALOG_MAX_AGE
+    assert plan.uuids('wfr') == ['r1']
+
+
+def test_plan_cleanup_checks_current_catalog_once(mocker, auth, current_catalog):
+    current_catalog.return_value = {'bwa-mem': {'accepted_versions': ['0.2.5'], 'run_time': 24}}
+    files = [{'@id': '/files-processed/4DNFI{}/'.format(i), 'uuid': 'f{}'.format(i), 'accession': '4DNFI{}'.format(i),
+              'status': 'uploaded', 'workflow_run_inputs': [{'uuid': 'r1'}]} for i in range(5)]
+    runs = {'r1': _wfr('r1', 'bwa-mem 0.2.5 run 2019-01-01 10:00:00', status='uploaded')}
+    index = mocker.spy(cleanup, 'index_workflow_details')
+    plan = cleanup.plan_cleanup(files, auth, [('bwa-mem', ['0.2.6'], 24)], stash=runs)
+    assert current_catalog.call_count == 1
+    # the caller's details and the current catalog are indexed once, not per file
+    assert index.call_count == 2 + len(files)
+    assert all(isinstance(c[0][0], cleanup.WorkflowIndex) for c in index.call_args_list[2:])
+    # 0.2.5 is accepted in the current catalog
+    assert plan.uuids('wfr') == []
+
+
+def test_apply_deletion_plan_skips_qc_when_field_deletion_fails(mocker, capsys, auth):
+    plan = cleanup.DeletionPlan()
+    plan.add_field_deletion('f1', 'quality_metric')
+    plan.add('q0', 'qc', needs=['f1'])
+    plan.add_wfr({'wfr_uuid': 'r1', 'outputs': [], 'qcs': ['q0']})
+    assert plan.changes['q0']['needs'] == ['f1']
+    mocker.patch('functions.cleanup.ff_utils.delete_field', side_effect=Exception(
+        'Bad status code for PATCH request for https://a/f1: 403. Reason: forbidden'))
+    patch = mocker.patch('functions.script_utils.patch_metadata', return_value={'status': 'success'})
+    report = cleanup.apply_deletion_plan(plan, auth, workers=2, rate=None)
+    assert [c[0][1] for c in patch.call_args_list] == ['r1']
+    assert report['wfrs'] == ['r1']
+    assert report['qcs'] == []
+    assert sorted(report['errors']) == ['f1', 'q0']
+    assert report['errors']['q0'] == 'not patched - field deletion failed for f1'
+    assert 'failed to delete q0 not patched' in capsys.readouterr()[0]
@@ -8,6 +8,7 @@ def test_diof_get_args_required_default():
         'env': None,
         'key': None,
         'keyfile': 'keypairs.json',
+        'workers': 1,
         'search': False,
     }
     args = diof.get_args(['i'])
@@ -39,6 +40,7 @@ def mocked_args_dbupd_is_false():
             'keyfile': None,
             'env': 'prod',
             'dbupdate': False,
+            'workers': 1,
             'search': False,
             'input': ['id1', 'id2'],
             'fields': None
@@ -54,6 +56,7 @@ def mocked_args_dbupd_is_true():
             'keyfile': None,
             'env': 'prod',
             'dbupdate': True,
+            'workers': 1,
             'search': False,
             'input': ['id1', 'id2'],
             'fields': None
@@ -69,6 +72,7 @@ def mocked_args_w_fields_dry_run():
             'keyfile': None,
             'env': 'prod',
             'dbupdate': False,
+            'workers': 1,
             'search': False,
             'input': ['id1', 'id2'],
             'fields': ['aliases'],
@@ -84,6 +88,7 @@ def mocked_args_w_fields_dbudate():
             'keyfile': None,
             'env': 'prod',
             'dbupdate': True,
+            'workers': 1,
             'search': False,
             'input': ['id1', 'id2'],
             'fields': ['aliases'],
@@ -2,6 +2,7 @@ import pytest
 import sys
 from copy import deepcopy as cp
 from scripts import generate_wfr_from_pf as gw
+from functions import script_utils as scu
 
 
 def test_filter_none_no_nones(capsys):
@@ -260,6 +261,13 @@ def test_add_notes_to_tsv_success(mocker, auth, fp_data):
     assert res == 'SUCCESS'
 
 
+def test_add_notes_to_tsv_drops_cached_file(mocker, auth, fp_data):
+    scu.METADATA_CACHE.set(auth['server'], fp_data['uuid'], fp_data)
+    mocker.patch('scripts.generate_wfr_from_pf.patch_metadata', return_value={'status': 'success'})
+    gw.add_notes_to_tsv(fp_data, auth)
+    assert scu.METADATA_CACHE.get(auth['server'], fp_data['uuid']) is None
+
+
 def test_add_notes_to_tsv_skip(auth, fp_data):
     note_txt = "This file contains processed results performed outside of the 4DN-DCIC standardized pipelines. The file and the information about its provenance, i.e. which files were used as input to generate this output was provided by or done in collaboration with the lab that did the experiments to generate the raw data. For more information about the specific analysis performed, please contact the submitting lab or refer to the relevant publication if available."
     fp_data['notes_to_tsv'] = [note_txt]
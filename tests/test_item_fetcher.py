@@ -0,0 +1,54 @@
+from scripts import item_fetcher as itf
+
+
+def test_format_fields():
+    res = {
+        'accession': '4DNFI1234567',
+        'lab': {'uuid': 'lab_uuid', 'display_title': 'Some Lab'},
+        'aliases': ['a:1', 'a:2'],
+        'experiments': [{'uuid': 'exp1'}, {'uuid': 'exp2'}]
+    }
+    line = itf.format_fields(res, ['accession', 'lab', 'aliases', 'experiments', 'description'])
+    assert line == '4DNFI1234567\tlab_uuid\ta:1, a:2\texp1, exp2\tNone\t'
+
+
+def test_get_items_w_problem(mocker, auth):
+    mocker.patch('scripts.item_fetcher.get_metadata', side_effect=[{'uuid': 'a'}, Exception('not found')])
+    items = list(itf.get_items(['a', 'b'], auth))
+    assert items == [('a', {'uuid': 'a'}), ('b', None)]
+
+
+def test_get_es_items(mocker, auth):
+    uid1 = '1256801c-9c6e-4563-a97a-a295fccf5f07'
+    uid2 = '2256801c-9c6e-4563-a97a-a295fccf5f07'
+    uid3 = '3256801c-9c6e-4563-a97a-a295fccf5f07'
+    get = mocker.patch('functions.script_utils.get_metadata', side_effect=[Exception('not found')])
+    search = mocker.patch('functions.script_utils.search_metadata', side_effect=lambda q, auth: {
+        'search/?type=Item&accession=4DNFI1234567&field=accession&field=uuid': [
+            {'uuid': uid2, 'accession': '4DNFI1234567'}],
+        'search/?type=Item&aliases=lab%3Aa1&aliases=lab%3Amissing&field=aliases&field=uuid': [
+            {'uuid': uid3, 'aliases': ['lab:a1']}],
+    }.get(q, []))
+    mes = mocker.patch('scripts.item_fetcher.get_es_metadata', return_value=iter([
+        {'uuid': uid2, 'object': {'status': 'released'}}, {'uuid': uid3, 'object': {'status': 'deleted'}},
+    ]))
+    items = list(itf.get_es_items([uid1, '4DNFI1234567', 'lab:a1', 'lab:missing', '/labs/bad_id/'],
+                                  auth, ['status'], chunk_size=2))
+    # accessions and aliases are found with one search each (and one for deleted/replaced)
+    assert search.call_count == 4
+    get.assert_called_once_with('/labs/bad_id/', auth)
+    mes.assert_called_once_with([uid1, uid2, uid3], sources=['object.status', 'uuid'], chunk_size=2,
+                                is_generator=True, key=auth)
+    assert items == [('lab:missing', None), ('/labs/bad_id/', None), ('4DNFI1234567', {'status': 'released'}),
+                     ('lab:a1', {'status': 'deleted'}), (uid1, None)]
+
+
+def test_get_es_items_yields_every_id_of_an_item(mocker, auth):
+    uid = '1256801c-9c6e-4563-a97a-a295fccf5f07'
+    mocker.patch('functions.script_utils.search_metadata', side_effect=lambda q, auth: [
+        {'uuid': uid, 'accession': '4DNFI1234567', 'aliases': ['lab:a1']}] if 'status=' not in q else [])
+    mes = mocker.patch('scripts.item_fetcher.get_es_metadata', return_value=iter([
+        {'uuid': uid, 'object': {'status': 'released'}}]))
+    items = list(itf.get_es_items(['4DNFI1234567', 'lab:a1', uid, 'lab:a1'], auth, ['status']))
+    assert mes.call_args[0][0] == [uid]
+    assert items == [(i, {'status': 'released'}) for i in ('4DNFI1234567', 'lab:a1', uid, 'lab:a1')]
@@ -0,0 +1,247 @@
+import threading
+import time
+from functions import script_utils as scu
+from scripts import load_items_json as lij
+
+
+def test_filter_journaled(tmp_path):
+    items = [{'uuid': 'a', 'title': 'one'}, {'uuid': 'b', 'title': 'two'}, {'title': 'three'}]
+    jpath = str(tmp_path / 'load.journal')
+    with scu.WriteJournal(jpath) as journal:
+        journal.record('a', scu.payload_hash(items[0]))
+        journal.record('b', scu.payload_hash({'uuid': 'b', 'title': 'old'}))
+    with scu.WriteJournal(jpath, resume=True) as journal:
+        to_load, keys = lij.filter_journaled(journal, items)
+    assert to_load == items[1:]
+    assert keys[id(items[1])] == ('b', scu.payload_hash(items[1]))
+    # items without uuid are journaled by the hash of their payload
+    assert keys[id(items[2])] == (scu.payload_hash(items[2]), scu.payload_hash(items[2]))
+
+
+def test_load_json_callback_per_chunk(mocker, auth):
+    mocker.patch('scripts.load_items_json.post_metadata', side_effect=[{}, Exception('bad chunk')])
+    results = []
+    items = [{'uuid': str(i)} for i in range(3)]
+    lij.load_json(auth, 'biosample', items, chunk_size=2, callback=lambda i, e: results.append((i, e)))
+    assert results[0] == (items[:2], None)
+    assert results[1][0] == items[2:]
+    assert str(results[1][1]) == 'bad chunk'
+
+
+def test_type_name_to_itype():
+    assert lij.type_name_to_itype('ExperimentSetReplicate') == 'experiment_set_replicate'
+    assert lij.type_name_to_itype('ExperimentHiC') == 'experiment_hi_c'
+    assert lij.type_name_to_itype('MicroscopeSettingD1') == 'microscope_setting_d1'
+
+
+def test_get_linked_types_nested():
+    props = {
+        'lab': {'type': 'string', 'linkTo': 'Lab'},
+        'files': {'type': 'array', 'items': {'type': 'string', 'linkTo': 'File'}},
+        'other': {'type': 'object', 'properties': {'bio': {'linkTo': ['Biosource', 'Biosample']}}}
+    }
+    assert lij.get_linked_types(props) == {'Lab', 'File', 'Biosource', 'Biosample'}
+
+
+def test_get_type_dependencies():
+    schemas = {
+        'experiment_set': {'properties': {'experiments_in_set': {'items': {'linkTo': 'Experiment'}}}},
+        'experiment_hi_c': {'rdfs:subClassOf': '/profiles/Experiment.json',
+                            'properties': {'biosample': {'linkTo': 'Biosample'},
+                                           'files': {'items': {'linkTo': 'FileFastq'}}}},
+        'experiment_type': {'rdfs:subClassOf': '/profiles/Item.json', 'properties': {}},
+        'biosample': {'properties': {'biosource': {'items': {'linkTo': 'Biosource'}}}},
+        'file_fastq': {'rdfs:subClassOf': '/profiles/File.json',
+                       'properties': {'related_files': {'items': {'linkTo': 'File'}},
+                                      'file_format': {'linkTo': 'FileFormat'}}},
+        'file_format': {'properties': {}},
+        'lab': {'properties': {'pi': {'linkTo': 'User'}}},
+        'biosource': None
+    }
+    deps = lij.get_type_dependencies(schemas)
+    # experiment_type is not an Experiment just because of its name
+    assert deps['experiment_set'] == {'experiment_hi_c'}
+    assert deps['experiment_hi_c'] == {'biosample', 'file_fastq'}
+    assert deps['biosample'] == {'biosource'}
+    assert deps['file_fastq'] == {'file_format'}
+    assert deps['lab'] == set()
+    # no schema - everything before it in ORDER
+    assert deps['biosource'] == {'lab', 'file_format'}
+
+
+def test_get_type_ancestors():
+    schemas = {
+        'file_set_calibration': {'rdfs:subClassOf': '/profiles/FileSet.json'},
+        'file_set': {'rdfs:subClassOf': '/profiles/Item.json'},
+        'quality_metric_fastqc': {'rdfs:subClassOf': '/profiles/QualityMetric.json'},
+        'file_format': {},
+    }
+    ancestors = lij.get_type_ancestors(schemas)
+    assert ancestors['file_set_calibration'] == {'file_set_calibration', 'file_set'}
+    assert ancestors['file_set'] == {'file_set'}
+    assert ancestors['quality_metric_fastqc'] == {'quality_metric_fastqc', 'quality_metric'}
+    assert not lij.links_to('file_format', {'file'}, ancestors)
+    assert lij.links_to('file_set_calibration', {'file_set'}, ancestors)
+
+
+def test_get_schemas_indexes_all_profiles_by_itype(mocker, capsys, auth):
+    mocker.patch('scripts.load_items_json.ff_get_schemas', return_value={
+        'ExperimentHiC': {'rdfs:subClassOf': '/profiles/Experiment.json'}, 'Experiment': {'isAbstract': True}})
+    schemas = lij.get_schemas(auth, ['experiment_hi_c', 'lab'])
+    assert schemas == {'experiment_hi_c': {'rdfs:subClassOf': '/profiles/Experiment.json'},
+                       'experiment': {'isAbstract': True}, 'lab': None}
+    assert "Can't get schema for lab" in capsys.readouterr()[0]
+
+
+def test_links_to_self():
+    assert lij.links_to_self('file_fastq', {'rdfs:subClassOf': '/profiles/File.json',
+                                            'properties': {'related_files': {'items': {'linkTo': 'File'}}}})
+    assert not lij.links_to_self('file_format', {'properties': {'file': {'linkTo': 'File'}}})
+    assert not lij.links_to_self('biosample', {'properties': {'biosource': {'linkTo': 'Biosource'}}})
+    assert lij.links_to_self('biosample', None)
+
+
+def test_run_in_dependency_order():
+    deps = {'experiment_set': {'experiment_hi_c'}, 'experiment_hi_c': {'biosample', 'file_fastq'},
+            'biosample': set(), 'file_fastq': set(), 'lab': set()}
+    loaded = []
+    lij.run_in_dependency_order(deps, loaded.append, workers=3)
+    assert sorted(loaded) == sorted(deps)
+    for itype, needed in deps.items():
+        assert all(loaded.index(n) < loaded.index(itype) for n in needed)
+
+
+def test_run_in_dependency_order_one_worker_follows_order():
+    deps = {'biosample': set(), 'lab': set(), 'experiment_hi_c': {'biosample'}}
+    loaded = []
+    lij.run_in_dependency_order(deps, loaded.append)
+    assert loaded == ['lab', 'biosample', 'experiment_hi_c']
+
+
+def test_load_json_concurrent_chunks(mocker, auth):
+    post = mocker.patch('scripts.load_items_json.post_metadata', return_value={})
+    results = []
+    items = [{'uuid': str(i)} for i in range(5)]
+    lij.load_json(auth, 'biosample', items, chunk_size=2, workers=3, callback=lambda i, e: results.append(i))
+    assert post.call_count == 3
+    assert sorted(results, key=lambda r: r[0]['uuid']) == [items[:2], items[2:4], items[4:]]
+
+
+def test_load_items_posts_new_patches_existing(mocker, auth):
+    mocker.patch('scripts.load_items_json.scu.find_existing_items', return_value={('uuid', 'u1'): 'u1'})
+    load = mocker.patch('scripts.load_items_json.load_json')
+    patch = mocker.patch('scripts.load_items_json.patch_jsons')
+    items = [{'uuid': 'u1'}, {'uuid': 'u2'}]
+    schema = {'identifyingProperties': ['uuid'], 'properties': {}}
+    lij.load_items(auth, 'biosample', items, schema, workers=4)
+    assert load.call_args[0][2] == [{'uuid': 'u2'}]
+    assert load.call_args[1]['workers'] == 4
+    assert patch.call_args[0][1] == [{'uuid': 'u1'}]
+
+
+def test_chunk_sizer():
+    sizer = lij.ChunkSizer(10, max_size=30, target_secs=10)
+    sizer.posted(1)
+    assert sizer.size == 20
+    sizer.posted(1)
+    assert sizer.size == 30
+    sizer.posted(7)  # ok but not fast - keep size
+    assert sizer.size == 30
+    sizer.posted(11)
+    assert sizer.size == 15
+    sizer.posted(1, Exception('Bad status code for POST request for https://a/load_data: 413. Reason: too large'))
+    assert sizer.size == 7
+    sizer.posted(1, Exception('Error with POST request for https://a/load_data: timed out'))
+    assert sizer.size == 3
+    # bad item doesn't change the size
+    sizer.posted(1, Exception('Bad status code for POST request for https://a/load_data: 422. Reason: invalid'))
+    assert sizer.size == 3
+    sizer.posted(1, Exception('Bad status code for POST request for https://a/load_data: 503. Reason: busy'))
+    assert sizer.size == 1
+
+
+def test_load_json_bisects_to_bad_items(mocker, capsys, auth):
+    items = [{'uuid': str(i)} for i in range(8)]
+
+    def post(payload, endpoint, auth):
+        if any(i['uuid'] in ['2', '5'] for i in payload['store']['biosample']):
+            raise Exception('Bad status code for POST request for https://a/load_data: 422. Reason: invalid')
+        return {}
+
+    mocker.patch('scripts.load_items_json.post_metadata', side_effect=post)
+    results = []
+    bad = lij.load_json(auth, 'biosample', items, chunk_size=8, callback=lambda i, e: results.append((i, e)))
+    assert [b[0]['uuid'] for b in bad] == ['2', '5']
+    loaded = [i['uuid'] for chunk, e in results if e is None for i in chunk]
+    assert sorted(loaded) == ['0', '1', '3', '4', '6', '7']
+    out = capsys.readouterr()[0]
+    assert 'PROBLEM LOADING biosample 2' in out
+    assert 'PROBLEM LOADING biosample 5' in out
+    assert 'PROBLEM LOADING biosample 0' not in out
+
+
+def test_load_json_grows_chunks(mocker, auth):
+    post = mocker.patch('scripts.load_items_json.post_metadata', return_value={})
+    items = [{'uuid': str(i)} for i in range(14)]
+    lij.load_json(auth, 'biosample', items, chunk_size=2)
+    sizes = [len(c[0][0]['store']['biosample']) for c in post.call_args_list]
+    assert sizes == [2, 4, 8]
+
+
+def test_load_json_stops_on_auth_error_without_splitting(mocker, capsys, auth):
+    post = mocker.patch('scripts.load_items_json.post_metadata', side_effect=Exception(
+        'Bad status code for POST request for https://a/load_data: 403. Reason: forbidden'))
+    items = [{'uuid': str(i)} for i in range(12)]
+    bad = lij.load_json(auth, 'biosample', items, chunk_size=4)
+    assert post.call_count == 1
+    assert [b[0] for b in bad] == items
+    out = capsys.readouterr()[0]
+    assert 'PROBLEM LOADING 4 biosample items' in out
+    assert 'STOPPED LOADING biosample - 8 items not posted' in out
+
+
+def test_load_json_retries_server_errors_then_stops(mocker, auth):
+    mocker.patch('scripts.load_items_json.time.sleep')
+    post = mocker.patch('scripts.load_items_json.post_metadata', side_effect=Exception(
+        'Bad status code for POST request for https://a/load_data: 502. Reason: bad gateway'))
+    items = [{'uuid': str(i)} for i in range(8)]
+    bad = lij.load_json(auth, 'biosample', items, chunk_size=8, retries=2)
+    # retried at the shrunk size and stopped once a piece used up its retries
+    assert [len(c[0][0]['store']['biosample']) for c in post.call_args_list] == [8, 4, 4, 2]
+    assert sorted(b[0]['uuid'] for b in bad) == sorted(i['uuid'] for i in items)
+
+
+def test_load_json_retries_connection_error(mocker, auth):
+    sleep = mocker.patch('scripts.load_items_json.time.sleep')
+    mocker.patch('scripts.load_items_json.post_metadata', side_effect=[
+        Exception('Error with POST request for https://a/load_data: timed out'), {}, {}])
+    results = []
+    items = [{'uuid': str(i)} for i in range(2)]
+    bad = lij.load_json(auth, 'biosample', items, chunk_size=2, backoff=0.5,
+                        callback=lambda i, e: results.append((i, e)))
+    assert bad == []
+    assert results == [(items[:1], None), (items[1:], None)]
+    sleep.assert_called_with(0.5)
+
+
+def test_load_json_shared_slots_bound_all_posts(mocker, auth):
+    lock = threading.Lock()
+    counts = {'now': 0, 'max': 0}
+
+    def post(payload, endpoint, auth):
+        with lock:
+            counts['now'] += 1
+            counts['max'] = max(counts['max'], counts['now'])
+        time.sleep(0.01)
+        with lock:
+            counts['now'] -= 1
+        return {}
+
+    mocker.patch('scripts.load_items_json.post_metadata', side_effect=post)
+    slots = threading.BoundedSemaphore(2)
+    items = {t: [{'uuid': t + str(i)} for i in range(6)] for t in ['biosample', 'lab']}
+    lij.run_in_dependency_order(
+        {'biosample': set(), 'lab': set()},
+        lambda t: lij.load_json(auth, t, items[t], chunk_size=1, max_chunk_size=1, workers=2, slots=slots),
+        workers=2)
+    assert counts['max'] <= 2
@@ -0,0 +1,123 @@
+import datetime
+import openpyxl
+import pytest
+from functions import notebook_functions as nf
+
+
+@pytest.fixture
+def typed_xlsx(tmp_path):
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'FileFastq'
+    sheet.append(['#Field Name:', 'aliases', 'read_length', 'paired', 'date', 'ratio', 'count'])
+    sheet.append(['', ' lab:f1 ', 100.0, True, datetime.datetime(2020, 1, 2), 0.5, 0])
+    sheet.append(['#', 'lab:f2', 50, False, datetime.datetime(2020, 1, 2, 3, 4, 5), 1.25, None])
+    sheet.append([None] * 7)
+    sheet.append(['', 'lab:after_blank_row'])
+    path = str(tmp_path / 'typed.xlsx')
+    book.save(path)
+    return path
+
+
+def test_typed_value():
+    assert nf.typed_value(None) == ''
+    assert nf.typed_value(3.0) == 3 and isinstance(nf.typed_value(3.0), int)
+    assert nf.typed_value(0) == ''
+    assert nf.typed_value(True) is True
+    assert nf.typed_value(' a ') == 'a'
+    assert nf.typed_value(datetime.datetime(2020, 1, 2)) == '2020-01-02'
+    assert nf.typed_value(datetime.date(2020, 1, 2)) == '2020-01-02'
+
+
+def test_reader_read_only_same_as_full(typed_xlsx):
+    book, sheets = nf.digest_xlsx(typed_xlsx)
+    full_rows = list(nf.reader(book, sheetname='FileFastq'))
+    ro_book, ro_sheets = nf.digest_xlsx(typed_xlsx, read_only=True)
+    ro_rows = list(nf.reader(ro_book, sheetname='FileFastq'))
+    ro_book.close()
+    assert ro_sheets == sheets
+    assert ro_rows == full_rows
+    # stops at the first empty row
+    assert len(ro_rows) == 3
+    assert ro_rows[1] == ['', 'lab:f1', 100, True, '2020-01-02', 0.5, '']
+
+
+@pytest.fixture
+def template_xlsx(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'Biosample'
+    sheet.append(['#Field Name:', 'aliases', 'description', 'biosource'])
+    sheet.append(['#Field Type:', 'array of strings', 'string', 'Item:Biosource'])
+    mic = book.create_sheet('ExperimentMic')
+    mic.append(['#Field Name:', 'aliases', 'imaging_paths.channel', 'imaging_paths.path', 'description'])
+    mic.append(['#Field Type:', 'array of strings', 'string', 'Item:ImagingPath', 'string'])
+    book.save('template.xlsx')
+    return 'template.xlsx'
+
+
+def test_append_items_to_xlsx(template_xlsx):
+    items = {
+        'biosample': [{'aliases': ['lab:bs1'], 'description': 'a sample', 'biosource': [{'@id': '/biosources/b1/'}]}],
+        'experiment_mic': [{'aliases': ['lab:e1'], 'description': 'an expt',
+                            'imaging_paths': [{'channel': 'ch00', 'path': 'lab:p0',
+                                               'channel-1': 'ch01', 'path-1': 'lab:p1'}]}]
+    }
+    schema_names = {'Biosample': 'biosample', 'ExperimentMic': 'experiment_mic'}
+    nf.append_items_to_xlsx(template_xlsx, items, schema_names)
+    book = openpyxl.load_workbook('template_with_items.xlsx')
+    assert book.sheetnames == ['Biosample', 'ExperimentMic']
+    assert list(book['Biosample'].values) == [
+        ('#Field Name:', 'aliases', 'description', 'biosource'),
+        ('#Field Type:', 'array of strings', 'string', 'Item:Biosource'),
+        ('#', 'lab:bs1', 'a sample', '/biosources/b1/')
+    ]
+    assert list(book['ExperimentMic'].values) == [
+        ('#Field Name:', 'aliases', 'imaging_paths.channel', 'imaging_paths.path',
+         'imaging_paths.channel-1', 'imaging_paths.path-1', 'description'),
+        ('#Field Type:', 'array of strings', 'string', 'Item:ImagingPath', 'string', 'Item:ImagingPath', 'string'),
+        ('#', 'lab:e1', 'ch00', 'lab:p0', 'ch01', 'lab:p1', 'an expt')
+    ]
+
+
+def test_format_items():
+    fields = ['#Field Name:', '*aliases', 'biosource', 'imaging_paths.channel', 'attachment', 'description', 'number']
+    items = [
+        {'aliases': ['lab:a', 'lab:b'], 'biosource': [{'@id': '/biosources/b1/'}], 'attachment': {'href': 'x'},
+         'imaging_paths': [{'channel': 'ch00'}], 'description': 'some', 'number': 3},
+        {'biosource': {'@id': '/biosources/b2/'}, 'imaging_paths': [], 'description': ''}
+    ]
+    assert nf.format_items(items, fields, True) == [
+        ['#', 'lab:a,lab:b', '/biosources/b1/', 'ch00', '', 'some', 3],
+        ['#', '', '/biosources/b2/', '', '', '', '']
+    ]
+    assert nf.format_items(items[1:], fields, False)[0][0] == ''
+
+
+def test_get_column_plan_is_shared():
+    fields = ['#Field Name:', 'aliases']
+    plan = nf.get_column_plan(fields, True)
+    assert nf.get_column_plan(list(fields), True) is plan
+    assert nf.get_column_plan(fields, False) is not plan
+    assert nf.format_items([{'aliases': ['a']}], None, True, plan=plan) == [['#', 'a']]
+
+
+def test_add_extra_path_columns():
+    titles = ['#Field Name:', 'imaging_paths.channel', 'imaging_paths.path', 'description']
+    rows = iter([['#Field Type:', 'string', 'Item:ImagingPath', 'string'], ['', 'c', 'p']])
+    items = [{'aliases': ['a']},
+             {'imaging_paths': [{'channel': 'ch00', 'path': 'p0', 'channel-1': 'ch01', 'path-1': 'p1'}]}]
+    new_rows, new_titles = nf.add_extra_path_columns(rows, titles, items)
+    assert new_titles == ['#Field Name:', 'imaging_paths.channel', 'imaging_paths.path',
+                          'imaging_paths.channel-1', 'imaging_paths.path-1', 'description']
+    assert list(new_rows) == [['#Field Type:', 'string', 'Item:ImagingPath', 'string', 'Item:ImagingPath', 'string'],
+                              ['', 'c', 'p', 'c', 'p', None]]
+    # titles passed in are left alone
+    assert len(titles) == 4
+
+
+def test_add_extra_path_columns_nothing_to_add():
+    titles = ['#Field Name:', 'aliases']
+    rows = [['#Field Type:', 'array of strings']]
+    assert nf.add_extra_path_columns(rows, titles, [{'imaging_paths': [{'channel': 'c', 'path': 'p'}]}]) == (rows, titles)
@@ -1,3 +1,4 @@
+import pytest
 from scripts import ontology_term_loader as otl
 
 
@@ -29,3 +30,36 @@ def test_get_id_w_all():
     term = {'uuid': 1, 'term_id': '4DN:0000001', 'term_name': 'joey'}
     idtag = otl.get_id(term)
     assert idtag == 1
+
+
+def test_parse_term_line_w_phase2_fields():
+    line = '{"term_id": "EFO:0000322", "term_name": "cell line", "parents": ["p1"], "slim_terms": ["s1"]}\n'
+    tid, term, phase2json = otl.parse_term_line(line)
+    assert tid == '/ontology-terms/EFO:0000322'
+    assert term == {'term_id': 'EFO:0000322', 'term_name': 'cell line'}
+    assert phase2json == {'parents': ['p1'], 'slim_terms': ['s1']}
+
+
+def test_parse_term_line_no_id():
+    with pytest.raises(ValueError, match='No Identifier'):
+        otl.parse_term_line('{"definition": "no ids here"}')
+
+
+def test_parse_term_line_not_json():
+    with pytest.raises(ValueError):
+        otl.parse_term_line('{"term_id": "EFO:0000322", ')
+
+
+def test_main_keeps_phase2_of_repeated_term(mocker, tmpdir, auth):
+    infile = tmpdir.join('terms.jsonl')
+    infile.write('{"term_id": "EFO:1", "parents": ["p1"]}\n{"term_id": "EFO:1", "parents": ["p2"]}\n')
+    mocker.patch('scripts.ontology_term_loader.get_args', return_value=mocker.Mock(
+        infile=str(infile), dbupdate=True, workers=2, key=None, keyfile=None, env=None))
+    mocker.patch('scripts.ontology_term_loader.scu.authenticate', return_value=auth)
+    mocker.patch('scripts.ontology_term_loader.get_metadata', side_effect=Exception('not found'))
+    mocker.patch('scripts.ontology_term_loader.post_metadata', side_effect=[
+        {'status': 'success', '@graph': [{'uuid': u}]} for u in ('u1', 'u2')])
+    patch = mocker.patch('functions.script_utils.patch_metadata', side_effect=lambda body, iid, key: {
+        'status': 'success', '@graph': [{'uuid': iid}]})
+    otl.main()
+    assert sorted((c[0][1], c[0][0]['parents']) for c in patch.call_args_list) == [('u1', ['p1']), ('u2', ['p2'])]
@@ -8,6 +8,7 @@ def test_pffmi_get_args_required_default():
         'env': None,
         'key': None,
         'keyfile': 'keypairs.json',
+        'workers': 1,
         'search': False,
         'isarray': False,
         'field': 'status',
@@ -43,6 +44,7 @@ def mocked_args_dbupd_is_false():
             'keyfile': None,
             'env': 'prod',
             'dbupdate': False,
+            'workers': 1,
             'search': False,
             'isarray': False,
             'numtype': None,
@@ -62,6 +64,7 @@ def mocked_args_dbupd_is_true():
             'keyfile': None,
             'env': 'prod',
             'dbupdate': True,
+            'workers': 1,
             'search': False,
             'numtype': None,
             'isarray': False,
@@ -81,6 +84,7 @@ def mocked_args_is_array():
             'keyfile': None,
             'env': 'prod',
             'dbupdate': False,
+            'workers': 1,
             'search': False,
             'isarray': True,
             'input': ['id1', 'id2'],
@@ -99,6 +103,7 @@ def mocked_args_w_delete():
             'keyfile': None,
             'env': 'prod',
             'dbupdate': True,
+            'workers': 1,
             'search': False,
             'isarray': False,
             'input': ['id1', 'id2'],
@@ -0,0 +1,20 @@
+import pytest
+from scripts import quick_patcher as qp
+
+
+def test_parse_patch_line():
+    iid, payload = qp.parse_patch_line('4DNFI1234567\t{"status": "released"}\n')
+    assert iid == '4DNFI1234567'
+    assert payload == {'status': 'released'}
+
+
+@pytest.mark.parametrize('line', [
+    '4DNFI1234567 {"status": "released"}',
+    '4DNFI1234567\t{"status": "released"\n',
+    '4DNFI1234567\t["released"]',
+    '\t{"status": "released"}',
+    'a\tb\tc',
+])
+def test_parse_patch_line_malformed(line):
+    with pytest.raises(ValueError):
+        qp.parse_patch_line(line)
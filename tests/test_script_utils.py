@@ -453,3 +453,315 @@ def test_get_item_if_you_can_w_fakename_and_itype_no_item(mocker, auth):
     mocker.patch('functions.script_utils.get_metadata', side_effect=[None, None])
     result = scu.get_item_if_you_can(auth, 'fake name', 'OntologyTerm')
     assert result is None
+
+
+@pytest.fixture
+def lab_json():
+    return {
+        'uuid': '828cd4fe-ebb0-4b36-a94a-d2e3a36cc989',
+        '@id': '/labs/4dn-dcic-lab/',
+        '@type': ['Lab', 'Item'],
+        'title': '4DN DCIC, HMS'
+    }
+
+
+def test_metadata_cache_hit_by_alias(lab_json):
+    cache = scu.MetadataCache()
+    cache.set('server', lab_json['uuid'], lab_json)
+    assert cache.get('server', '/labs/4dn-dcic-lab/') == lab_json
+    assert cache.get('server', 'labs/4dn-dcic-lab') == lab_json
+    assert cache.get('server', lab_json['uuid']) == lab_json
+    assert cache.stats() == {'hits': 3, 'misses': 0, 'size': 1}
+
+
+def test_metadata_cache_keyed_by_server_and_frame(lab_json):
+    cache = scu.MetadataCache()
+    cache.set('server', lab_json['uuid'], lab_json)
+    assert cache.get('other_server', lab_json['uuid']) is None
+    assert cache.get('server', lab_json['uuid'], frame='raw') is None
+    assert cache.misses == 2
+
+
+def test_metadata_cache_returns_copies(lab_json):
+    cache = scu.MetadataCache()
+    cache.set('server', lab_json['uuid'], lab_json)
+    cache.get('server', lab_json['uuid'])['@type'].pop(0)
+    assert cache.get('server', lab_json['uuid'])['@type'][0] == 'Lab'
+
+
+def test_metadata_cache_lru_eviction():
+    cache = scu.MetadataCache(maxsize=2)
+    for uid in ['a', 'b']:
+        cache.set('server', uid, {'uuid': uid})
+    cache.get('server', 'a')  # b is now least recently used
+    cache.set('server', 'c', {'uuid': 'c'})
+    assert cache.get('server', 'b') is None
+    assert cache.get('server', 'a') == {'uuid': 'a'}
+    assert cache.get('server', 'c') == {'uuid': 'c'}
+
+
+def test_metadata_cache_ttl_expired(mocker, lab_json):
+    cache = scu.MetadataCache(ttl=10)
+    mt = mocker.patch('functions.script_utils.time.monotonic', return_value=100)
+    cache.set('server', lab_json['uuid'], lab_json)
+    mt.return_value = 111
+    assert cache.get('server', lab_json['uuid']) is None
+    assert cache.stats() == {'hits': 0, 'misses': 1, 'size': 0}
+
+
+def test_metadata_cache_no_uuid_not_cached():
+    cache = scu.MetadataCache()
+    cache.set('server', 'bad_id', {'status': 'error'})
+    cache.set('server', 'bad_id', None)
+    assert cache.stats()['size'] == 0
+
+
+def test_get_metadata_cached_only_fetches_once(mocker, auth, lab_json):
+    mt = mocker.patch('functions.script_utils.get_metadata', return_value=lab_json)
+    assert scu.get_metadata_cached(lab_json['uuid'], auth) == lab_json
+    assert scu.get_metadata_cached('/labs/4dn-dcic-lab/', auth) == lab_json
+    mt.assert_called_once_with(lab_json['uuid'], auth)
+    assert scu.METADATA_CACHE.hits == 1
+
+
+def test_get_metadata_cached_w_frame(mocker, auth, lab_json):
+    mt = mocker.patch('functions.script_utils.get_metadata', return_value=lab_json)
+    scu.get_metadata_cached(lab_json['uuid'], auth, frame='raw')
+    mt.assert_called_once_with(lab_json['uuid'], auth, add_on='frame=raw')
+
+
+def test_metadata_cache_invalidate_all_ids_and_frames(lab_json):
+    cache = scu.MetadataCache()
+    cache.set('server', lab_json['uuid'], lab_json)
+    cache.set('server', lab_json['uuid'], lab_json, frame='raw')
+    cache.set('other_server', lab_json['uuid'], lab_json)
+    cache.invalidate('server', '/labs/4dn-dcic-lab/')
+    assert cache.get('server', lab_json['uuid']) is None
+    assert cache.get('server', lab_json['uuid'], frame='raw') is None
+    assert cache.get('other_server', lab_json['uuid']) == lab_json
+
+
+def test_run_patches_invalidates_written_items(mocker, auth, lab_json):
+    mocker.patch('functions.script_utils.get_metadata', return_value=lab_json)
+    scu.get_metadata_cached(lab_json['uuid'], auth)
+    mocker.patch('functions.script_utils.patch_metadata', return_value={
+        'status': 'success', '@graph': [{'uuid': lab_json['uuid']}]})
+    # written by an id it wasn't cached with - found from the response
+    scu.run_patches([('4dn-dcic-lab:alias', {'title': 'new'})], auth, rate=None)
+    assert scu.METADATA_CACHE.get(auth['server'], lab_json['uuid']) is None
+
+
+@pytest.fixture
+def linked_graph():
+    """raw and embedded frames for a small item graph: set -> 2 exps -> shared biosample"""
+    u = ['%d256801c-9c6e-4563-a97a-a295fccf5f07' % i for i in range(1, 5)]
+    raw = {
+        u[0]: {'status': 'released', 'experiments_in_set': [u[1], u[2]]},
+        u[1]: {'status': 'released', 'biosample': u[3]},
+        u[2]: {'status': 'released', 'biosample': u[3]},
+        u[3]: {'status': 'released'},
+    }
+    types = {u[0]: 'ExperimentSetReplicate', u[1]: 'ExperimentHiC', u[2]: 'ExperimentHiC', u[3]: 'Biosample'}
+
+    def get_frame(iid, auth, add_on=''):
+        if add_on == 'frame=raw':
+            return raw[iid]
+        return {'@type': [types[iid], 'Item']}
+    return u, types, get_frame
+
+
+def test_get_linked_items_walks_all_levels(auth, mocker, linked_graph):
+    uuids, types, get_frame = linked_graph
+    mt = mocker.patch('functions.script_utils.get_metadata', side_effect=get_frame)
+    iids = scu.get_linked_items(auth, uuids[0])
+    assert iids == types
+    # the shared biosample is only fetched once in each frame
+    assert mt.call_count == 8
+
+
+def test_get_linked_items_w_max_depth(auth, mocker, linked_graph):
+    uuids, types, get_frame = linked_graph
+    mocker.patch('functions.script_utils.get_metadata', side_effect=get_frame)
+    iids = scu.get_linked_items(auth, uuids[0], max_depth=1)
+    assert sorted(iids) == sorted(uuids[:3])
+
+
+def test_get_linked_items_w_max_items(auth, mocker, capsys, linked_graph):
+    uuids, types, get_frame = linked_graph
+    mocker.patch('functions.script_utils.get_metadata', side_effect=get_frame)
+    iids = scu.get_linked_items(auth, uuids[0], max_items=2)
+    assert sorted(iids) == sorted(uuids[:2])
+    assert 'Reached limit of 2 linked items' in capsys.readouterr()[0]
+
+
+def test_get_linked_items_w_no_children_arg(auth, mocker, linked_graph):
+    uuids, types, get_frame = linked_graph
+    mocker.patch('functions.script_utils.get_metadata', side_effect=get_frame)
+    iids = scu.get_linked_items(auth, uuids[0], no_children=['ExperimentHiC'])
+    assert sorted(iids) == sorted(uuids[:3])
+    assert scu.NO_CHILDREN == ['Publication', 'Lab', 'User', 'Award']
+
+
+def test_get_linked_items_adds_input_wfrs(auth, mocker):
+    fid = '1256801c-9c6e-4563-a97a-a295fccf5f07'
+    mocker.patch('functions.script_utils.get_metadata', side_effect=[
+        {'status': 'uploaded'},
+        {'@type': ['FileFastq'], 'workflow_run_inputs': [{'uuid': 'wfr_uuid'}]}
+    ])
+    iids = scu.get_linked_items(auth, fid)
+    assert iids == {fid: 'FileFastq', 'wfr_uuid': 'WorkflowRun'}
+
+
+def test_create_workers_arg_parser():
+    parser = scu.create_workers_arg_parser()
+    assert parser.parse_args([]).workers == 1
+    assert parser.parse_args(['--workers', '4']).workers == 4
+
+
+def test_is_retryable_error():
+    retry = [
+        Exception('Error with PATCH request for https://test_portal/a: Read timed out.'),
+        Exception('Bad status code for PATCH request for https://test_portal/a: 502. Reason: Bad Gateway'),
+    ]
+    no_retry = [
+        Exception('Bad status code for PATCH request for https://test_portal/a: 422. Reason: {}'),
+        KeyError('status')
+    ]
+    assert all(scu.is_retryable_error(e) for e in retry)
+    assert not any(scu.is_retryable_error(e) for e in no_retry)
+
+
+def test_rate_limiter_spaces_calls(mocker):
+    mocker.patch('functions.script_utils.time.monotonic', return_value=100)
+    sleep = mocker.patch('functions.script_utils.time.sleep')
+    limiter = scu.RateLimiter(rate=4)
+    for _ in range(3):
+        limiter.wait()
+    assert [c[0][0] for c in sleep.call_args_list] == [0.25, 0.5]
+
+
+def test_run_patches_summary(mocker, auth):
+    mocker.patch('functions.script_utils.time.sleep')
+    responses = {
+        'id1': [{'status': 'success'}],
+        'id2': [{'status': 'error', 'description': 'access denied'}],
+        'id3': [Exception('Error with PATCH request for id3: timeout'), {'status': 'success'}],
+        'id4': [Exception('Bad status code for PATCH request for id4: 422. Reason: invalid')],
+    }
+
+    def patch(payload, iid, auth):
+        res = responses[iid].pop(0)
+        if isinstance(res, Exception):
+            raise res
+        return res
+    mocker.patch('functions.script_utils.patch_metadata', side_effect=patch)
+    reported = []
+    summary = scu.run_patches([(i, {'status': 'deleted'}) for i in responses], auth, workers=2,
+                              callback=lambda i, r, e: reported.append(i))
+    assert sorted(summary['success']) == ['id1', 'id3']
+    assert sorted(summary['failed']) == ['id2', 'id4']
+    assert summary['errors']['id2'] == {'status': 'error', 'description': 'access denied'}
+    assert isinstance(summary['errors']['id4'], Exception)
+    assert summary['retries'] == 1
+    assert sorted(reported) == sorted(responses)
+
+
+def test_run_patches_w_action_gives_up_after_retries(mocker, auth):
+    sleep = mocker.patch('functions.script_utils.time.sleep')
+    action = mocker.Mock(side_effect=Exception('Bad status code for PATCH request for a: 503. Reason: busy'))
+    summary = scu.run_patches([('a', {})], auth, action=action, rate=None, retries=2, backoff=1)
+    assert action.call_count == 3
+    assert [c[0][0] for c in sleep.call_args_list] == [1, 2]
+    assert summary['failed'] == ['a']
+    assert summary['retries'] == 2
+
+
+def test_payload_hash_ignores_key_order():
+    assert scu.payload_hash({'a': 1, 'b': [1, 2]}) == scu.payload_hash({'b': [1, 2], 'a': 1})
+    assert scu.payload_hash({'a': 1}) != scu.payload_hash({'a': 2})
+
+
+def test_write_journal_resume(tmp_path):
+    jpath = str(tmp_path / 'patch.journal')
+    with scu.WriteJournal(jpath) as journal:
+        journal.record('id1', 'h1')
+        journal.record('id2', 'h2', error=Exception('timeout'))
+    with open(jpath, 'a') as jfile:
+        jfile.write('{"id": "id3", "ha')  # died mid write
+    journal = scu.WriteJournal(jpath, resume=True)
+    assert journal.confirmed == {('id1', 'h1')}
+    assert journal.is_confirmed('id1', 'h1')
+    assert not journal.is_confirmed('id1', 'changed_payload')
+    journal.close()
+    # without resume nothing is confirmed
+    with scu.WriteJournal(jpath) as journal:
+        assert not journal.is_confirmed('id1', 'h1')
+
+
+def test_write_journal_fsync_batching(mocker, tmp_path):
+    fsync = mocker.patch('functions.script_utils.os.fsync')
+    with scu.WriteJournal(str(tmp_path / 'j'), sync_every=2) as journal:
+        for i in range(5):
+            journal.record(str(i), 'h')
+        assert fsync.call_count == 2
+    assert fsync.call_count == 3
+
+
+def test_run_patches_w_journal(mocker, auth, tmp_path):
+    jpath = str(tmp_path / 'patch.journal')
+    patches = [('id1', {'status': 'released'}), ('id2', {'status': 'released'})]
+    with scu.WriteJournal(jpath) as journal:
+        journal.record('id1', scu.payload_hash({'status': 'released'}))
+    mp = mocker.patch('functions.script_utils.patch_metadata',
+                      side_effect=[{'status': 'success'}, {'status': 'success'}])
+    with scu.WriteJournal(jpath, resume=True) as journal:
+        summary = scu.run_patches(patches, auth, rate=None, journal=journal)
+    mp.assert_called_once_with({'status': 'released'}, 'id2', auth)
+    assert summary['skipped'] == ['id1']
+    assert summary['success'] == ['id2']
+    with open(jpath) as jfile:
+        assert len(jfile.readlines()) == 2
+
+
+def test_read_input_lines_reports_malformed(capsys):
+    lines = ['1\n', 'two\n', '\n', '3\n', '[4]\n']
+    problems = []
+    parsed = list(scu.read_input_lines(iter(lines), lambda line: int(line), problems))
+    assert parsed == [1, 3]
+    assert problems == [2, 5]
+    out = capsys.readouterr()[0]
+    assert 'MALFORMED LINE 2: ' in out
+    assert 'MALFORMED LINE 5: ' in out
+
+
+def test_search_type_name():
+    assert scu.search_type_name('experiment_hi_c') == 'ExperimentHiC'
+    assert scu.search_type_name('ontology_term') == 'OntologyTerm'
+
+
+def test_find_existing_items(mocker, auth):
+    items = [
+        {'uuid': 'u1', 'aliases': ['lab:a1']},
+        {'aliases': ['lab:a2', 'lab:a3'], 'term_id': 'T:1'},
+        {'aliases': ['lab:a4']},
+    ]
+    found = {
+        'search/?type=OntologyTerm&uuid=u1&field=uuid': [{'uuid': 'u1'}],
+        'search/?type=OntologyTerm&aliases=lab%3Aa1&aliases=lab%3Aa2&field=aliases&field=uuid': [
+            {'uuid': 'u2', 'aliases': ['lab:a3', 'lab:other']}],
+        'search/?type=OntologyTerm&aliases=lab%3Aa3&aliases=lab%3Aa4&field=aliases&field=uuid': [
+            {'uuid': 'u2', 'aliases': ['lab:a3']}],
+        # a deleted item only found when asked for
+        'search/?type=OntologyTerm&aliases=lab%3Aa3&aliases=lab%3Aa4&field=aliases&field=uuid'
+        '&status=deleted&status=replaced': [{'uuid': 'u4', 'aliases': ['lab:a4']}],
+    }
+    ms = mocker.patch('functions.script_utils.search_metadata', side_effect=lambda q, auth: found.get(q, []))
+    index = scu.find_existing_items(auth, 'ontology_term', items, ['aliases', 'term_id'], chunk_size=2)
+    assert index == {('uuid', 'u1'): 'u1', ('aliases', 'lab:a3'): 'u2', ('aliases', 'lab:a4'): 'u4'}
+    queries = [c[0][0] for c in ms.call_args_list]
+    assert len(queries) == 8
+    assert queries[-2:] == ['search/?type=OntologyTerm&term_id=T%3A1&field=term_id&field=uuid',
+                            'search/?type=OntologyTerm&term_id=T%3A1&field=term_id&field=uuid'
+                            '&status=deleted&status=replaced']
+    assert scu.get_existing_uuid(items[1], ['aliases', 'term_id'], index) == 'u2'
+    assert scu.get_existing_uuid(items[2], ['aliases', 'term_id'], index) == 'u4'
@@ -0,0 +1,351 @@
+import pytest
+from datetime import datetime
+from functions import wfr
+
+R2 = 'a2b2c2d2-0000-4000-8000-000000000002'
+R5 = 'a5b5c5d5-0000-4000-8000-000000000005'
+
+
+@pytest.fixture
+def wfr_files():
+    return {
+        'f1': {'uuid': 'f1', 'workflow_run_inputs': [
+            {'uuid': 'r1', 'display_title': 'bwa-mem 0.2.6 run 2019-01-01 10:00:00.123456'},
+            {'uuid': R2, 'display_title': 'bwa-mem 0.2.6 run 2019-02-01 10:00:00'},
+            {'uuid': 'r3', 'display_title': 'bwa-mem 0.2.5 run 2019-03-01 10:00:00'},
+            {'uuid': 'r4', 'display_title': 'md5 0.2.6 run 2019-04-01 10:00:00'}]},
+        'f2': {'uuid': 'f2', 'workflow_run_inputs': [
+            {'uuid': R5, 'display_title': 'bwa-mem 0.2.6 run on 2019-01-01 10:00:00'}]},
+        'f3': {'uuid': 'f3', 'workflow_run_inputs': [
+            {'uuid': 'r6', 'display_title': 'bwa-mem 0.2.5 run 2019-01-01 10:00:00'}]},
+        'f4': {'uuid': 'f4', 'workflow_run_inputs': []},
+    }
+
+
+@pytest.fixture
+def wfr_runs():
+    return {
+        R2: {'uuid': R2, 'run_status': 'complete', 'output_files': [
+            {'workflow_argument_name': 'out_bam', 'format': '/file-formats/bam/',
+             'value': {'@id': '/files-processed/4DNFIBAM/'}}]},
+        R5: {'uuid': R5, 'run_status': 'error'},
+    }
+
+
+def test_get_wfr_out_and_file(mocker, auth, wfr_files, wfr_runs):
+    every = dict(wfr_files, **wfr_runs)
+    mocker.patch('functions.wfr.ff_utils.get_metadata', side_effect=lambda i, key: every[i])
+    assert wfr.get_wfr_out('f1', 'bwa-mem', auth, ['0.2.6']) == {
+        'bam': '/files-processed/4DNFIBAM/', 'status': 'complete'}
+    assert wfr.get_wfr_out_file('f1', 'bwa-mem', auth, ['0.2.6']) == {
+        'out_bam': '/files-processed/4DNFIBAM/', 'status': 'complete'}
+    assert wfr.get_wfr_out('f1', 'bwa-mem', auth, ['0.2.6'], md_qc=True) == {'status': 'complete'}
+    assert wfr.get_wfr_out('f2', 'bwa-mem', auth, ['0.2.6']) == {'status': 'no completed run'}
+    assert wfr.get_wfr_out('f3', 'bwa-mem', auth, ['0.2.6']) == {
+        'status': 'no workflow in file with accepted version'}
+    assert wfr.get_wfr_out('f4', 'bwa-mem', auth, ['0.2.6']) == {'status': 'no workflow in file'}
+
+
+def test_get_wfr_out_batch(mocker, auth, wfr_files, wfr_runs):
+    def get_metadata(iid, key):
+        if iid == 'bad':
+            raise Exception('not found')
+        return dict(wfr_files, **wfr_runs)[iid]
+
+    getter = mocker.patch('functions.wfr.ff_utils.get_metadata', side_effect=get_metadata)
+    # r5 is not indexed yet
+    es = mocker.patch('functions.wfr.ff_utils.get_es_metadata', return_value=[{'embedded': wfr_runs[R2]}])
+    res = wfr.get_wfr_out_batch(['f1', 'f2', 'f3', 'f4', 'f1', 'bad'], 'bwa-mem', auth, ['0.2.6'])
+    assert res == {
+        'f1': {'bam': '/files-processed/4DNFIBAM/', 'status': 'complete'},
+        'f2': {'status': 'no completed run'},
+        'f3': {'status': 'no workflow in file with accepted version'},
+        'f4': {'status': 'no workflow in file'},
+        'bad': {'status': 'file not found'}
+    }
+    assert sorted(es.call_args[0][0]) == [R2, R5]
+    assert es.call_args[1]['sources'] == ['embedded.uuid', 'embedded.run_status', 'embedded.output_files']
+    # 5 files and the run missing from ES
+    assert getter.call_count == 6
+
+
+def test_parse_wfr_title():
+    title = wfr.parse_wfr_title('bwa-mem 0.2.6 run 2019-01-01 10:00:00.5')
+    assert title.name == 'bwa-mem'
+    assert title.version == '0.2.6'
+    assert title.timestamp == datetime(2019, 1, 1, 10, 0, 0, 500000)
+    assert wfr.parse_wfr_title('md5 0.0.4 run on 2019-01-01 10:00:00') == wfr.WfrTitle(
+        'md5', '0.0.4', datetime(2019, 1, 1, 10, 0, 0))
+    assert title.run_hours(now=datetime(2019, 1, 1, 12, 0, 0, 500000)) == 2
+    with pytest.raises(AttributeError):
+        title.extra = 1
+
+
+@pytest.mark.parametrize('title', [
+    'hi-c-processing-bam run 2018-01-01 10:00:00',  # old style without version
+    'File Provenance Tracking',
+    'bwa-mem 0.2.6 run 2019-13-01 10:00:00'
+])
+def test_parse_wfr_title_not_parsed(title):
+    assert wfr.parse_wfr_title(title) is None
+
+
+def test_parse_wfr_title_cached():
+    title = 'bwa-mem 0.2.6 run 2019-01-01 10:00:00'
+    assert wfr.parse_wfr_title(title) is wfr.parse_wfr_title(title)
+
+
+@pytest.fixture
+def hic_rep_set():
+    def exp(acc, files):
+        return {'accession': acc, 'files': [{'uuid': f} for f in files],
+                'digestion_enzyme': {'display_title': 'MboI'},
+                'biosample': {'biosource': [{'individual': {'organism': {'name': 'human'}}}]}}
+    return {'accession': '4DNESET', 'lab': {'@id': '/labs/a-lab/'},
+            'experiments_in_set': [exp('4DNEX1', ['a1', 'a2']), exp('4DNEX2', ['b1', 'b2', 'c1'])]}
+
+
+@pytest.fixture
+def hic_fastqs():
+    gb = 1024 * 1024 * 1024
+
+    def fastq(uuid, pair, end, **kwargs):
+        fq = {'uuid': uuid, '@id': '/files-fastq/{}/'.format(uuid), 'accession': uuid, 'status': 'uploaded',
+              'file_size': gb, 'filename': uuid + '.fastq.gz', 'upload_key': uuid + '/key', 'paired_end': end,
+              'related_files': [{'relationship_type': 'paired with', 'file': {'@id': '/files-fastq/{}/'.format(pair)}}]}
+        fq.update(kwargs)
+        return fq
+    return {
+        'a1': fastq('a1', 'a2', '1'), 'a2': fastq('a2', 'a1', '2'),
+        'b1': fastq('b1', 'b2', '1'), 'b2': fastq('b2', 'b1', '2'),
+        'c1': fastq('c1', 'c2', '1', upload_key='c1/not_on_s3')
+    }
+
+
+class FakeS3(object):
+    """stands in for s3_utils with a set of keys on the raw file bucket"""
+    raw_file_bucket = 'raw-bucket'
+    outfile_bucket = 'out-bucket'
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.heads = []
+
+    def does_key_exist(self, key, bucket):
+        self.heads.append(key)
+        return {'ContentLength': 1} if (bucket, key) in self.keys else False
+
+
+def test_find_pairs(mocker, auth, hic_rep_set, hic_fastqs):
+    s3 = FakeS3({('raw-bucket', k + '/key') for k in ['a1', 'b1']})
+    mocker.patch('functions.wfr._S3_KEYS_FOUND', set())
+    mocker.patch('functions.wfr._ENV_CONTEXTS', {})
+    mocker.patch('functions.wfr.ff_utils.get_authentication_with_server', return_value=auth)
+    mocker.patch('functions.wfr.s3_utils', return_value=s3)
+    getter = mocker.patch('functions.wfr.ff_utils.get_metadata', side_effect=lambda i, key: hic_fastqs[i])
+    res = wfr.find_pairs(hic_rep_set, 'data')
+    report, organism, enz, bwa, chrsize, enz_file, size, lab = res
+    assert report == {'4DNEX1': [('/files-fastq/a1/', '/files-fastq/a2/')],
+                      '4DNEX2': [('/files-fastq/b1/', '/files-fastq/b2/')]}
+    assert (organism, enz, bwa, chrsize, enz_file) == (
+        'human', 'MboI', wfr.bwa_index['human'], wfr.chr_size['human'], wfr.re_nz['human']['MboI'])
+    assert size == 5
+    assert lab == ['/labs/a-lab/']
+    assert getter.call_count == 5
+    # no s3 checks for the second files of pairs
+    assert sorted(s3.heads) == ['a1/key', 'b1/key', 'c1/not_on_s3']
+    # found keys are not checked again in the session
+    s3.heads = []
+    wfr.find_pairs(hic_rep_set, 'data')
+    assert s3.heads == ['c1/not_on_s3']
+
+
+def test_find_pairs_only_checks_s3_for_files_it_uses(mocker, auth, hic_rep_set, hic_fastqs):
+    hic_rep_set['experiments_in_set'][1]['files'].extend([{'uuid': 'd1'}, {'uuid': 'e1'}])
+    hic_fastqs['d1'] = dict(hic_fastqs['b1'], uuid='d1', upload_key='d1/key', instrument='Illumina MiSeq')
+    hic_fastqs['e1'] = dict(hic_fastqs['b1'], uuid='e1', upload_key='e1/key', status='deleted')
+    s3 = FakeS3({('raw-bucket', k + '/key') for k in ['a1', 'b1']})
+    mocker.patch('functions.wfr._S3_KEYS_FOUND', set())
+    mocker.patch('functions.wfr._ENV_CONTEXTS', {})
+    mocker.patch('functions.wfr.ff_utils.get_authentication_with_server', return_value=auth)
+    mocker.patch('functions.wfr.s3_utils', return_value=s3)
+    mocker.patch('functions.wfr.ff_utils.get_metadata', side_effect=lambda i, key: hic_fastqs[i])
+    wfr.find_pairs(hic_rep_set, 'data')
+    assert sorted(s3.heads) == ['a1/key', 'b1/key', 'c1/not_on_s3']
+    # with more than one organism the loop stops at once - nothing is checked
+    s3.heads = []
+    hic_rep_set['experiments_in_set'][0]['biosample']['biosource'].append(
+        {'individual': {'organism': {'name': 'mouse'}}})
+    wfr.find_pairs(hic_rep_set, 'data')
+    assert s3.heads == []
+
+
+@pytest.fixture
+def fake_env(mocker, auth):
+    mocker.patch('functions.wfr._ENV_CONTEXTS', {})
+    return {
+        'auth': mocker.patch('functions.wfr.ff_utils.get_authentication_with_server', return_value=auth),
+        's3': mocker.patch('functions.wfr.s3_utils', return_value=FakeS3(set()))
+    }
+
+
+def test_get_env_context_cached(fake_env, auth):
+    ctx = wfr.get_env_context('data')
+    assert wfr.get_env_context('data') is ctx
+    assert wfr.get_env_context(ctx) is ctx
+    assert (ctx.env, ctx.raw_bucket, ctx.out_bucket) == ('data', 'raw-bucket', 'out-bucket')
+    fake_env['s3'].assert_called_once_with(env='data')
+    # auth only looked up when needed
+    assert not fake_env['auth'].called
+    assert ctx.auth == auth and ctx.auth == auth
+    fake_env['auth'].assert_called_once_with({}, ff_env='data')
+
+
+def test_extract_file_info_and_run_json_share_context(mocker, fake_env, auth):
+    files = {'f1': {'display_title': '4DNF1.bed.gz', 'uuid': 'u1', '@type': ['FileProcessed', 'File']},
+             'f2': {'display_title': '4DNF2.fastq.gz', 'uuid': 'u2', '@type': ['FileFastq', 'File']}}
+    mocker.patch('functions.wfr.ff_utils.get_metadata', side_effect=lambda i, key: files[i])
+    inp1 = wfr.extract_file_info('f1', 'input_bed', 'data', rename=['bed', 'tagAlign'])
+    inp2 = wfr.extract_file_info(['f2'], 'fastqs', 'data')
+    assert inp1 == {'workflow_argument_name': 'input_bed', 'object_key': '4DNF1.bed.gz', 'uuid': 'u1',
+                    'bucket_name': 'out-bucket', 'rename': '4DNF1.tagAlign.gz'}
+    assert inp2 == {'workflow_argument_name': 'fastqs', 'object_key': ['4DNF2.fastq.gz'], 'uuid': ['u2'],
+                    'bucket_name': 'raw-bucket'}
+    wf_info = {'wf_uuid': 'wf', 'wf_name': 'bed2x', 'wfr_meta': {}, 'parameters': {}}
+    run = wfr.run_json([inp1, inp2], 'data', wf_info, 'a run')
+    assert run['output_bucket'] == 'out-bucket'
+    assert run['_tibanna'] == {'env': 'data', 'run_type': 'bed2x', 'run_id': 'a run'}
+    assert fake_env['s3'].call_count == 1
+    assert fake_env['auth'].call_count == 1
+
+
+@pytest.fixture
+def run_jsons(fake_env):
+    wf_info = {'wf_uuid': 'wf', 'wf_name': 'bed2x', 'wfr_meta': {}, 'parameters': {}}
+    good = wfr.run_json([{'workflow_argument_name': 'input_bed', 'object_key': '4DNF1.bed.gz', 'uuid': 'u1',
+                          'bucket_name': 'out-bucket'},
+                         {'workflow_argument_name': 'fastqs', 'object_key': [['4DNF2.fastq.gz', '4DNF3.fastq.gz']],
+                          'uuid': [['u2', 'u3']], 'bucket_name': 'raw-bucket'}], 'data', wf_info, 'run 1')
+    wrong_bucket = wfr.run_json([{'workflow_argument_name': 'input_bed', 'object_key': '4DNF1.bed.gz', 'uuid': 'u1',
+                                  'bucket_name': 'raw-bucket'}], 'data', wf_info, 'run 2')
+    missing = wfr.run_json([None, {'workflow_argument_name': 'ref', 'object_key': 'wrong.txt', 'uuid': 'u4',
+                                   'bucket_name': 'raw-bucket'}], 'data', wf_info, 'run 3')
+    return [good, wrong_bucket, missing]
+
+
+@pytest.fixture
+def run_files():
+    return {
+        'u1': {'uuid': 'u1', 'display_title': '4DNF1.bed.gz', '@type': ['FileProcessed', 'File']},
+        'u2': {'uuid': 'u2', 'display_title': '4DNF2.fastq.gz', '@type': ['FileFastq', 'File']},
+        'u3': {'uuid': 'u3', 'display_title': '4DNF3.fastq.gz', '@type': ['FileFastq', 'File']},
+        'u4': {'uuid': 'u4', 'display_title': '4DNF4.txt', '@type': ['FileReference', 'File']},
+    }
+
+
+def test_validate_run_jsons(mocker, auth, run_jsons, run_files):
+    es = mocker.patch('functions.wfr.ff_utils.get_es_metadata',
+                      return_value=[{'embedded': f} for k, f in run_files.items() if k != 'u3'])
+    mocker.patch('functions.wfr.ff_utils.get_metadata', side_effect=lambda i, key: run_files[i])
+    problems = wfr.validate_run_jsons(run_jsons, auth)
+    assert sorted(es.call_args[0][0]) == ['u1', 'u2', 'u3', 'u4']
+    assert problems == {
+        1: ['file 4DNF1.bed.gz is not in raw-bucket'],
+        2: ['missing input files (files from different buckets?)', 'object key wrong.txt is not the file u4']
+    }
+
+
+def test_submit_runs(mocker, auth, run_jsons, run_files):
+    mocker.patch('functions.wfr.ff_utils.get_es_metadata', return_value=[{'embedded': f} for f in run_files.values()])
+    good2 = dict(run_jsons[0], _tibanna={'env': 'data', 'run_type': 'bed2x', 'run_id': 'run 4'})
+    post = mocker.patch('functions.wfr.ff_utils.post_metadata', side_effect=[
+        {'status': 'SUCCEEDED', 'input': '{"_tibanna": {"url": "https://run/1"}}'},
+        Exception('Error with POST request for https://a/WorkflowRun/run: timed out')])
+    summary = wfr.submit_runs(run_jsons + [None, good2], auth, workers=1, rate=None)
+    assert post.call_count == 2
+    assert [(r['run_id'], r['status']) for r in summary] == [
+        ('run 1', 'SUCCEEDED'), ('run 2', 'invalid'), ('run 3', 'invalid'), ('run 4', 'error')]
+    assert summary[0]['url'] == 'https://run/1'
+    assert 'timed out' in summary[3]['problem']
+
+
+def test_submit_runs_reports_unexpected_responses(mocker, auth, run_jsons, run_files):
+    mocker.patch('functions.wfr.ff_utils.get_es_metadata', return_value=[{'embedded': f} for f in run_files.values()])
+    runs = [dict(run_jsons[0], _tibanna={'env': 'data', 'run_type': 'bed2x', 'run_id': 'run %s' % i})
+            for i in range(4)]
+    mocker.patch('functions.wfr.ff_utils.post_metadata', side_effect=[
+        {'status': 'error', 'description': 'denied'}, {'status': 'SUCCEEDED', 'input': 'not json'},
+        {'status': 'SUCCEEDED', 'input': '{"other": 1}'},
+        {'status': 'SUCCEEDED', 'input': '{"_tibanna": {"url": "https://run/4"}}'}])
+    summary = wfr.submit_runs(runs, auth, workers=1, rate=None)
+    assert [r['status'] for r in summary] == ['error', 'SUCCEEDED', 'SUCCEEDED', 'SUCCEEDED']
+    assert all(r['problem'].startswith('no run url in response') for r in summary[:3])
+    assert summary[3]['url'] == 'https://run/4'
+
+
+def test_reference_registry_tables():
+    assert wfr.bwa_index['human'] == '4DNFIZQZ39L9'
+    assert wfr.chr_size['fruit-fly'] == '4DNFIBEEN92C'
+    assert wfr.re_nz['mouse']['DpnII'] == '/files-reference/4DNFI3HVC1SE/'
+    assert wfr.REFERENCE_FILES.get('mouse', 'atac', 'gensz') == 'mm'
+    assert wfr.REFERENCE_FILES.get('chicken', 'chip', 'gensz') is None
+
+
+def test_reference_registry_input_files(fake_env):
+    registry = wfr.ReferenceRegistry.from_file()
+    inputs = registry.input_files('human', 'chip', 'data')
+    assert inputs == [
+        {"object_key": "4DNFIZQB369V.bwaIndex.tar",
+         "rename": "GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta.tar",
+         "bucket_name": 'raw-bucket', "workflow_argument_name": "chip.bwa_idx_tar",
+         "uuid": "38077b98-3862-45cd-b4be-8e28e9494549"},
+        {"object_key": "4DNFIZ1TGJZR.bed.gz", "bucket_name": 'raw-bucket',
+         "workflow_argument_name": "chip.blacklist", "uuid": "9562ffbd-9f7a-4bd7-9c10-c335137d8966"},
+        {"object_key": "4DNFIZJB62D1.chrom.sizes", "bucket_name": 'raw-bucket',
+         "workflow_argument_name": "chip.chrsz", "uuid": "9866d158-da3c-4d9b-96a9-1d59632eabeb"}]
+    # callers can change what they get
+    inputs.append({})
+    inputs[0]['uuid'] = 'changed'
+    assert len(registry.input_files('human', 'chip', 'data')) == 3
+    assert registry.input_files('human', 'chip', 'data')[0]['uuid'] == "38077b98-3862-45cd-b4be-8e28e9494549"
+    assert [i['workflow_argument_name'] for i in registry.input_files(
+        'mouse', 'atac', 'data', arguments=['atac.blacklist', 'atac.chrsz'])] == ['atac.blacklist', 'atac.chrsz']
+    assert registry.input_files('chicken', 'atac', 'data') == []
+
+
+def test_run_missing_atac1_no_launch(fake_env, auth):
+    wf_info = {'wf_uuid': 'wf', 'wf_name': 'encode-atacseq-aln', 'wfr_meta': {}, 'config': {},
+               'custom_pf_fields': {}}
+    run = wfr.run_missing_atac1(wf_info, 'mouse', 'single', [['u1']], [['4DNF1.fastq.gz']], 'data', auth,
+                                'a run', launch=False)
+    assert [i['workflow_argument_name'] for i in run['input_files']] == [
+        'atac.bowtie2_idx_tar', 'atac.blacklist', 'atac.chrsz', 'atac.fastqs']
+    assert run['parameters']['atac.gensz'] == 'mm'
+    assert run['parameters']['atac.fraglen'] == [300]
+    assert run['_tibanna']['env'] == 'data'
+    assert wfr.run_missing_atac1(wf_info, 'chicken', 'single', [['u1']], [['4DNF1.fastq.gz']], 'data', auth,
+                                 'a run', launch=False) is None
+
+
+def test_select_best_2(mocker, capsys, auth):
+    fuuids = ['f{}f{}f{}f{}-0000-4000-8000-000000000000'.format(i, i, i, i) for i in range(4)]
+    quuids = ['e' + f[1:] for f in fuuids]
+    files = {f: {'uuid': f, 'quality_metric': {'uuid': q}} for f, q in zip(fuuids, quuids)}
+    qcs = {q: {'uuid': q, 'nodup_flagstat_qc': [{'mapped': m}]} for q, m in zip(quuids, [10, 30, 20, 30])}
+    qcs[quuids[2]] = {'uuid': quuids[2], 'ctl_nodup_flagstat_qc': [{'mapped': 40}]}
+    es = mocker.patch('functions.wfr.ff_utils.get_es_metadata', side_effect=[
+        [{'embedded': f} for f in files.values()], [{'embedded': q} for q in qcs.values()]])
+    getter = mocker.patch('functions.wfr.ff_utils.get_metadata')
+    assert wfr.select_best_2(fuuids, auth) == [fuuids[2], fuuids[1]]
+    assert es.call_count == 2
+    assert not getter.called
+    out = capsys.readouterr()[0]
+    for f, m in zip(fuuids, [10, 30, 40, 30]):
+        assert '{} {}'.format(f, m) in out
+
+
+def test_select_best_2_short_list_or_missing_qc(mocker, capsys, auth):
+    assert wfr.select_best_2(['a', 'b'], auth) == ['a', 'b']
+    mocker.patch('functions.wfr.ff_utils.get_metadata', side_effect=lambda i, key: {'uuid': i})
+    assert wfr.select_best_2(['a', 'b', 'c'], auth) is None
+    assert 'No qc found on file a' in capsys.readouterr()[0]